@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ztf-variable-marshal'))
+
+from utils import gather_with_concurrency
+
+
+class FakeCursor(object):
+    """
+        Stand-in for a Motor cursor returning nothing after a fixed round-trip latency
+    """
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def to_list(self, length=None):
+        await asyncio.sleep(self.latency)
+        return []
+
+
+class FakeCollection(object):
+    def __init__(self, latency):
+        self.latency = latency
+
+    def find(self, *args, **kwargs):
+        return FakeCursor(self.latency)
+
+
+async def sequential(collection, n):
+    return [await collection.find({}).to_list(length=None) for _ in range(n)]
+
+
+async def concurrent(collection, n, parallelism):
+    async def find_object():
+        return await collection.find({}).to_list(length=None)
+
+    return await gather_with_concurrency(parallelism, *(find_object() for _ in range(n)))
+
+
+if __name__ == '__main__':
+    # per-object cone search fan-out: sequential awaits vs. bounded concurrency
+    latency = 0.002
+    parallelism = 16
+
+    collection = FakeCollection(latency)
+
+    print(f'simulated round trip: {latency*1e3:.1f} ms, parallelism: {parallelism}')
+    for n in (10, 100, 1000):
+        tic = time.perf_counter()
+        asyncio.run(sequential(collection, n))
+        t_seq = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        asyncio.run(concurrent(collection, n, parallelism))
+        t_con = time.perf_counter() - tic
+
+        print(f'{n:5d} positions: sequential {t_seq:.3f} s, concurrent {t_con:.3f} s, '
+              f'speed-up x{t_seq / t_con:.1f}')
@@ -0,0 +1,68 @@
+import io
+import os
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ztf-variable-marshal'))
+
+from hr_diagram import HRDiagram
+
+background = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          'ztf-variable-marshal', 'static', 'img', 'hr_plot.png')
+
+
+def render_hr_pyplot(bp_rp=None, abs_g=None):
+    """
+        What the HR handlers used to do on every request
+    """
+    img = plt.imread(background)
+    buff = io.BytesIO()
+    fig = plt.figure(figsize=(4, 4), dpi=200)
+    ax = fig.add_subplot(111)
+    if (bp_rp is not None) and (abs_g is not None):
+        ax.plot(bp_rp, abs_g, 'o', markersize=8, c='#f22f29')
+    ax.imshow(img, extent=[-1, 5, 17, -5])
+    ax.set_aspect(1 / 4)
+    ax.set_ylabel('G')
+    ax.set_xlabel('BP-RP')
+    plt.tight_layout(pad=0, h_pad=0, w_pad=0)
+    plt.savefig(buff, dpi=200, bbox_inches='tight')
+    plt.close('all')
+    return buff.getvalue()
+
+
+def requests_per_second(render, sources, min_time=3.0):
+    n, tic = 0, time.perf_counter()
+    while time.perf_counter() - tic < min_time:
+        render(*sources[n % len(sources)])
+        n += 1
+    return n / (time.perf_counter() - tic)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    sources = list(zip(rng.uniform(0, 3, 100), rng.uniform(-2, 14, 100)))
+    no_match = [(None, None)]
+
+    tic = time.perf_counter()
+    hr = HRDiagram(background=background)
+    print(f'base raster: {time.perf_counter() - tic:.3f} s, empty png {len(hr.empty_png)} bytes')
+
+    for name, before, after in (('marked', render_hr_pyplot, hr.render),
+                                ('no Gaia match', render_hr_pyplot, hr.render)):
+        _sources = sources if name == 'marked' else no_match
+        rps_before = requests_per_second(before, _sources)
+        rps_after = requests_per_second(after, _sources)
+        print(f'{name:14s} before: {rps_before:8.1f} req/s, after: {rps_after:8.1f} req/s, '
+              f'speedup x{rps_after / rps_before:.1f}')
+
+    if len(sys.argv) > 1:
+        # dump both versions for a visual check
+        for name, png in (('before', render_hr_pyplot(*sources[0])), ('after', hr.render(*sources[0]))):
+            with open(os.path.join(sys.argv[1], f'hr_{name}.png'), 'wb') as f:
+                f.write(png)
@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ztf-variable-marshal'))
+
+from utils import pack_columns, series_columns, series_records
+from bench_lc_preprocessing import synthetic_lc
+
+
+def timeit(f, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+if __name__ == '__main__':
+    # BSON size and the cost of getting from the wire format to what the read paths need:
+    # columns (source page, images) and records (?format=json)
+    for n in (1000, 10000, 100000):
+        data = synthetic_lc(n)
+        layouts = {'records': {'lc': [{'id': 1, 'data': data}]},
+                   'columnar': {'lc': [{'id': 1, 'data_format': 'columnar', 'data': pack_columns(data)}]}}
+
+        print(f'{n} points:')
+        for layout, doc in layouts.items():
+            raw = bson.encode(doc)
+            t_encode = timeit(lambda: bson.encode(doc))
+            t_decode = timeit(lambda: bson.decode(raw))
+            lc = bson.decode(raw)['lc'][0]
+            t_columns = timeit(lambda: series_columns(lc))
+            t_records = timeit(lambda: series_records(lc))
+
+            print(f'  {layout:8s}: {len(raw) / 1024:9.1f} KiB, encode {t_encode * 1e3:7.2f} ms, '
+                  f'decode {t_decode * 1e3:7.2f} ms, to columns {t_columns * 1e3:7.2f} ms, '
+                  f'to records {t_records * 1e3:7.2f} ms')
@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ztf-variable-marshal'))
+
+from period_search import period_search_methods, periodogram, top_peaks
+
+
+def synthetic_lc(n, method, seed=42):
+    """
+        ZTF-like sampling over 1500 days: a sinusoid for ls and ce, a detached eclipse for bls
+    """
+    rng = np.random.default_rng(seed)
+    t = 2458200 + np.sort(rng.uniform(0, 1500, n))
+    if method == 'bls':
+        period = 2.7371
+        mag = 17 + np.where((t / period) % 1 < 0.05, 0.5, 0.0) + rng.normal(0, 0.02, n)
+    else:
+        period = 0.3123
+        mag = 17 + 0.3 * np.sin(2 * np.pi * t / period) + rng.normal(0, 0.05, n)
+    return t, mag, np.full(n, 0.05), period
+
+
+if __name__ == '__main__':
+    n_freq = 100000
+
+    for method in period_search_methods:
+        # compile
+        t, mag, magerr, _ = synthetic_lc(50, method)
+        periodogram(t, mag, magerr, method=method, n_freq=100)
+
+        for n in (300, 1000, 3000):
+            t, mag, magerr, period = synthetic_lc(n, method)
+
+            tic = time.perf_counter()
+            freqs, power = periodogram(t, mag, magerr, method=method, f_min=0.01, f_max=10, n_freq=n_freq)
+            t_run = time.perf_counter() - tic
+
+            best = 1 / freqs[top_peaks(freqs, power, n_peaks=1)[0]]
+            print(f'{method:3s} {n:5d} points, {n_freq} frequencies: {t_run:.3f} s, '
+                  f'best period {best:.5f} d (true {period} d)')
@@ -0,0 +1,79 @@
+import argparse
+import json
+import pymongo
+from utils import lc_stats, series_columns, utc_now
+
+
+''' load config and secrets '''
+with open('/app/config.json') as cjson:
+    config = json.load(cjson)
+
+with open('/app/secrets.json') as sjson:
+    secrets = json.load(sjson)
+
+for k in secrets:
+    if k in config:
+        config[k].update(secrets.get(k, {}))
+    else:
+        config[k] = secrets[k]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute lc[].stats for saved sources. '
+                                                 'Progress is checkpointed in the stats collection, '
+                                                 'so interrupted runs resume where they stopped')
+    parser.add_argument('--batch_size', type=int, default=100, help='sources per bulk write')
+    parser.add_argument('--force', action='store_true', help='recompute existing stats')
+    parser.add_argument('--restart', action='store_true', help='ignore checkpoint and start over')
+
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(host=config['database']['host'],
+                                 port=config['database']['port'])
+
+    db = client[config['database']['db']]
+    db.authenticate(name=config['database']['user'], password=config['database']['pwd'])
+
+    checkpoint_id = 'backfill_lc_stats'
+    stats = db[config['database']['collection_stats']]
+
+    checkpoint = stats.find_one({'_id': checkpoint_id})
+    last_id = checkpoint['last_id'] if (checkpoint is not None) and (not args.restart) else None
+    if last_id is not None:
+        print(f'resuming after {last_id}')
+
+    n_updated = 0
+
+    while True:
+        _filter = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        if not args.force:
+            _filter['lc'] = {'$elemMatch': {'stats': {'$exists': False}}}
+        sources = list(db['sources'].find(_filter, {'lc': 1}).sort('_id', pymongo.ASCENDING).limit(args.batch_size))
+        if len(sources) == 0:
+            break
+
+        requests = []
+        for source in sources:
+            for lc in source['lc']:
+                if '_id' not in lc:
+                    print(f'{source["_id"]}: light curve {lc.get("id", None)} has no _id, run add_lc_id.py first')
+                    continue
+                if args.force or ('stats' not in lc):
+                    # address light curves by their _id as the array may change in the meantime
+                    requests.append(pymongo.UpdateOne({'_id': source['_id'], 'lc._id': lc['_id']},
+                                                      {'$set': {'lc.$.stats': lc_stats(series_columns(lc))}}))
+
+        if len(requests) > 0:
+            result = db['sources'].bulk_write(requests, ordered=False)
+            n_updated += result.modified_count
+            # let the servers know their cached query results are stale
+            db[config['database']['collection_versions']].update_one({'_id': 'sources'},
+                                                                     {'$inc': {'version': 1}}, upsert=True)
+
+        last_id = sources[-1]['_id']
+        stats.update_one({'_id': checkpoint_id},
+                         {'$set': {'last_id': last_id, 'last_modified': utc_now()}}, upsert=True)
+        print(f'{last_id}: {n_updated} light curves updated')
+
+    stats.update_one({'_id': checkpoint_id}, {'$set': {'last_id': None, 'finished': utc_now()}}, upsert=True)
+    print(f'done: {n_updated} light curves updated')
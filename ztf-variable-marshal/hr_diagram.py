@@ -0,0 +1,94 @@
+import functools
+import io
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.image as mpimg
+import numpy as np
+
+
+''' HR diagram with a source marked on top of the Gaia DR2 background
+
+    the background, axes and labels are drawn once per process on an Agg canvas.
+    a source is then marked by restoring the saved base raster and drawing just the marker on top of it
+'''
+
+hr_background = '/app/static/img/hr_plot.png'
+
+
+class HRDiagram(object):
+
+    def __init__(self, background: str = hr_background, dpi: int = 200):
+        self.dpi = dpi
+
+        self.fig = Figure(figsize=(4, 4), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+        self.ax.imshow(mpimg.imread(background), extent=[-1, 5, 17, -5])
+        self.ax.set_aspect(1 / 4)
+        self.ax.set_ylabel('G')
+        self.ax.set_xlabel('BP-RP')
+        self.fig.tight_layout(pad=0, h_pad=0, w_pad=0)
+
+        # animated artists are skipped by canvas.draw() and only drawn explicitly with ax.draw_artist
+        self.marker, = self.ax.plot([], [], 'o', markersize=8, c='#f22f29', animated=True)
+
+        # do once what savefig(bbox_inches='tight') does on every call: fit the figure to the padded tight bbox
+        self.canvas.draw()
+        bbox = self.fig.get_tightbbox(self.canvas.get_renderer()).padded(0.1)
+        w, h = self.fig.get_size_inches()
+        pos = self.ax.get_position()
+        self.ax.set_position([(pos.x0 * w - bbox.x0) / bbox.width, (pos.y0 * h - bbox.y0) / bbox.height,
+                              pos.width * w / bbox.width, pos.height * h / bbox.height])
+        self.fig.set_size_inches(bbox.width, bbox.height)
+
+        self.canvas.draw()
+        self.base = self.canvas.copy_from_bbox(self.fig.bbox)
+
+        self.empty_png = self.png()
+
+    def png(self):
+        """
+            Encode the current state of the canvas
+        :return: PNG bytes
+        """
+        buff = io.BytesIO()
+        mpimg.imsave(buff, np.asarray(self.canvas.buffer_rgba()), format='png')
+        return buff.getvalue()
+
+    def render(self, bp_rp=None, abs_g=None):
+        """
+            Mark a source on the diagram
+        :param bp_rp: color, don't mark anything if None
+        :param abs_g: absolute G magnitude
+        :return: PNG bytes
+        """
+        if (bp_rp is None) or (abs_g is None):
+            return self.empty_png
+
+        self.canvas.restore_region(self.base)
+        self.marker.set_data([bp_rp], [abs_g])
+        self.ax.draw_artist(self.marker)
+        png = self.png()
+        # leave a clean base for the next call
+        self.canvas.restore_region(self.base)
+
+        return png
+
+
+@functools.lru_cache(maxsize=1)
+def hr_diagram():
+    """
+        HRDiagram of this process, built on first use
+    """
+    return HRDiagram()
+
+
+def render_hr(bp_rp=None, abs_g=None):
+    """
+        HR diagram with a source marked on top of the Gaia DR2 background
+    :param bp_rp: color, don't mark anything if None
+    :param abs_g: absolute G magnitude
+    :return: PNG bytes
+    """
+    return hr_diagram().render(bp_rp, abs_g)
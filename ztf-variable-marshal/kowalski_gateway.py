@@ -0,0 +1,103 @@
+from async_timeout import timeout
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from penquins import Kowalski
+import threading
+
+
+''' non-blocking access to Kowalski '''
+
+
+class KowalskiGateway(object):
+    """
+        Run penquins calls in a thread pool so that they do not block the event loop.
+
+        Each pool thread keeps its own authenticated penquins client (and thus its own HTTP connection),
+        created on first use. Calls are limited to timeout seconds, as are the client's HTTP requests
+        (logging in included), so that threads of calls that were given up on are freed too
+        (penquins retries a request up to 3 times).
+        When a call fails and the client no longer answers pings, the client is replaced and the call is retried once
+    """
+    def __init__(self, protocol: str = 'https', host: str = 'localhost', port: int = 443,
+                 username: str = None, password: str = None, max_workers: int = 8, timeout: float = 60.0):
+        self.credentials = {'protocol': protocol, 'host': host, 'port': port,
+                            'username': username, 'password': password}
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='kowalski')
+        self.local = threading.local()
+
+        # metrics
+        self.calls = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.reconnects = 0
+
+    def client(self):
+        """
+            penquins client of the current pool thread
+        """
+        if getattr(self.local, 'kowalski', None) is None:
+            self.local.kowalski = Kowalski(**self.credentials, timeout=self.timeout)
+        return self.local.kowalski
+
+    def call(self, method: str, *args, **kwargs):
+        """
+            Call penquins client method in the current pool thread, reconnecting once if the connection was lost
+        :return: result, whether the client was replaced
+        """
+        kowalski = self.client()
+        try:
+            return getattr(kowalski, method)(*args, **kwargs), False
+        except Exception:
+            try:
+                alive = kowalski.ping()
+            except Exception:
+                alive = False
+            if alive:
+                raise
+            print('Apparently lost connection to Kowalski, trying to reset')
+            self.local.kowalski = None
+            return getattr(self.client(), method)(*args, **kwargs), True
+
+    async def run(self, method: str, *args, _timeout: float = None, **kwargs):
+        loop = asyncio.get_event_loop()
+        self.calls += 1
+        try:
+            async with timeout(_timeout if _timeout is not None else self.timeout):
+                # the pool thread finishes the call in the background if we time out
+                result, reconnected = await loop.run_in_executor(self.executor,
+                                                                 lambda: self.call(method, *args, **kwargs))
+            # metrics are only updated on the event loop
+            if reconnected:
+                self.reconnects += 1
+            return result
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.failures += 1
+            raise
+
+    async def query(self, query, _timeout: float = None):
+        """
+            Run Kowalski query
+        :param query: penquins query
+        :param _timeout: [s], gateway default if None
+        :return: Kowalski response
+        """
+        return await self.run('query', query, _timeout=_timeout)
+
+    async def ping(self, _timeout: float = None):
+        return await self.run('ping', _timeout=_timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def metrics(self):
+        return {'max_workers': self.max_workers,
+                'calls': self.calls,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+                'reconnects': self.reconnects}
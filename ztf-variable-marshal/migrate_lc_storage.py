@@ -0,0 +1,94 @@
+import argparse
+import json
+import pymongo
+from utils import pack_columns, unpack_records, utc_now
+
+
+''' load config and secrets '''
+with open('/app/config.json') as cjson:
+    config = json.load(cjson)
+
+with open('/app/secrets.json') as sjson:
+    secrets = json.load(sjson)
+
+for k in secrets:
+    if k in config:
+        config[k].update(secrets.get(k, {}))
+    else:
+        config[k] = secrets[k]
+
+
+def convert(entry, data_format):
+    """
+        Convert light curve or spectrum to data_format ('records' or 'columnar')
+    :return: True if converted, False if already in data_format
+    """
+    if entry.get('data_format', 'records') == data_format:
+        return False
+    if data_format == 'columnar':
+        entry['data'] = pack_columns(entry['data'])
+        entry['data_format'] = 'columnar'
+    else:
+        entry['data'] = unpack_records(entry['data'])
+        entry.pop('data_format', None)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert lc/spec data of saved sources to another storage layout. '
+                                                 'Progress is checkpointed in the stats collection, '
+                                                 'so interrupted runs resume where they stopped')
+    parser.add_argument('--to', choices=('columnar', 'records'), default='columnar', help='target layout')
+    parser.add_argument('--batch_size', type=int, default=100, help='sources per bulk write')
+    parser.add_argument('--restart', action='store_true', help='ignore checkpoint and start over')
+
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(host=config['database']['host'],
+                                 port=config['database']['port'])
+
+    db = client[config['database']['db']]
+    db.authenticate(name=config['database']['user'], password=config['database']['pwd'])
+
+    checkpoint_id = f'migrate_lc_storage_{args.to}'
+    stats = db[config['database']['collection_stats']]
+
+    checkpoint = stats.find_one({'_id': checkpoint_id})
+    last_id = checkpoint['last_id'] if (checkpoint is not None) and (not args.restart) else None
+    if last_id is not None:
+        print(f'resuming after {last_id}')
+
+    n_converted, n_skipped = 0, 0
+
+    while True:
+        _filter = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        sources = list(db['sources'].find(_filter, {'lc': 1, 'spec': 1, 'last_modified': 1}).
+                       sort('_id', pymongo.ASCENDING).limit(args.batch_size))
+        if len(sources) == 0:
+            break
+
+        requests = []
+        for source in sources:
+            changed = [convert(entry, args.to) for series in ('lc', 'spec') for entry in source.get(series, [])]
+            if any(changed):
+                # do not overwrite sources modified since they were read; re-run to pick them up
+                requests.append(pymongo.UpdateOne({'_id': source['_id'],
+                                                   'last_modified': source.get('last_modified', None)},
+                                                  {'$set': {'lc': source.get('lc', []),
+                                                            'spec': source.get('spec', [])}}))
+
+        if len(requests) > 0:
+            result = db['sources'].bulk_write(requests, ordered=False)
+            n_converted += result.modified_count
+            n_skipped += len(requests) - result.matched_count
+            # let the servers know their cached query results are stale
+            db[config['database']['collection_versions']].update_one({'_id': 'sources'},
+                                                                     {'$inc': {'version': 1}}, upsert=True)
+
+        last_id = sources[-1]['_id']
+        stats.update_one({'_id': checkpoint_id},
+                         {'$set': {'last_id': last_id, 'last_modified': utc_now()}}, upsert=True)
+        print(f'{last_id}: {n_converted} sources converted, {n_skipped} modified concurrently and skipped')
+
+    stats.update_one({'_id': checkpoint_id}, {'$set': {'last_id': None, 'finished': utc_now()}}, upsert=True)
+    print(f'done: {n_converted} sources converted, {n_skipped} skipped')
@@ -0,0 +1,338 @@
+import numpy as np
+from numba import jit
+
+from utils import decimate_minmax, series_columns
+
+
+''' period search over saved light curves
+
+    periodograms are evaluated over uniform frequency grids [1/day] with numba:
+    ls: generalized (floating-mean) Lomb-Scargle power, Zechmeister & Kürster 2009
+    ce: conditional entropy of the phase-folded light curve, Graham et al. 2013, reported as 1 - H / ln(n_mag_bins)
+    bls: box least squares signal residue normalized by the light curve variance, Kovács et al. 2002
+
+    ce and bls bin every point at every frequency and cost 3-4x as much as ls (~1 s for 3000 points and 1e5
+    frequencies, see dev/bench_period_search.py). their grids are not coarsened: binned statistics need
+    frequency steps below (bin width) / baseline, finer than ls does
+'''
+
+period_search_methods = ('ls', 'ce', 'bls')
+
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def _lomb_scargle(t, y, w, f_min, df, n_freq):
+    """
+        Generalized Lomb-Scargle power. cos/sin of 2 pi f t are advanced along the grid
+        by rotation and recomputed every 1024 frequencies to keep the rounding errors in check
+    :param t: times, relative to the first one
+    :param y: magnitudes, minus their weighted mean
+    :param w: weights, normalized to unit sum
+    :return:
+    """
+    n = t.shape[0]
+    power = np.zeros(n_freq)
+
+    yy = 0.0
+    for i in range(n):
+        yy += w[i] * y[i] * y[i]
+    if yy <= 0:
+        return power
+
+    c = np.empty(n)
+    s = np.empty(n)
+    dc = np.cos(2 * np.pi * df * t)
+    ds = np.sin(2 * np.pi * df * t)
+
+    for k in range(n_freq):
+        if k % 1024 == 0:
+            for i in range(n):
+                c[i] = np.cos(2 * np.pi * (f_min + k * df) * t[i])
+                s[i] = np.sin(2 * np.pi * (f_min + k * df) * t[i])
+
+        cs, ss, ycs, yss, ccs, css = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
+        for i in range(n):
+            cs += w[i] * c[i]
+            ss += w[i] * s[i]
+            ycs += w[i] * y[i] * c[i]
+            yss += w[i] * y[i] * s[i]
+            ccs += w[i] * c[i] * c[i]
+            css += w[i] * c[i] * s[i]
+            # advance to the next frequency
+            c_next = c[i] * dc[i] - s[i] * ds[i]
+            s[i] = s[i] * dc[i] + c[i] * ds[i]
+            c[i] = c_next
+
+        cc = ccs - cs * cs
+        ss_ = 1.0 - ccs - ss * ss
+        cs_ = css - cs * ss
+        d = cc * ss_ - cs_ * cs_
+        if d > 0:
+            power[k] = (ss_ * ycs * ycs + cc * yss * yss - 2 * cs_ * ycs * yss) / (yy * d)
+
+    return power
+
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def _conditional_entropy(t, m, f_min, df, n_freq, n_phase_bins, n_mag_bins):
+    """
+        Conditional entropy of magnitude given phase. Phases are advanced along the grid
+        and recomputed every 1024 frequencies. Bin counts are integers, so x ln x is looked up in a table
+        instead of taking n_phase_bins * n_mag_bins logarithms per frequency
+    :param t: times, relative to the first one
+    :param m: magnitudes, scaled to [0, 1]
+    :return:
+    """
+    n = t.shape[0]
+    entropy = np.zeros(n_freq)
+    counts = np.zeros(n_phase_bins * n_mag_bins, dtype=np.int64)
+
+    xlogx = np.zeros(n + 1)
+    for x in range(2, n + 1):
+        xlogx[x] = x * np.log(x)
+
+    m_bin = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        m_bin[i] = min(int(m[i] * n_mag_bins), n_mag_bins - 1)
+
+    phase = np.empty(n)
+    d_phase = t * df
+    d_phase -= np.floor(d_phase)
+
+    for k in range(n_freq):
+        if k % 1024 == 0:
+            for i in range(n):
+                phase[i] = t[i] * (f_min + k * df)
+                phase[i] -= np.floor(phase[i])
+
+        counts[:] = 0
+        for i in range(n):
+            counts[min(int(phase[i] * n_phase_bins), n_phase_bins - 1) * n_mag_bins + m_bin[i]] += 1
+            # advance to the next frequency
+            phase[i] += d_phase[i]
+            if phase[i] >= 1.0:
+                phase[i] -= 1.0
+
+        # sum of c ln(column / c) over the bins of each phase column
+        h = 0.0
+        for ip in range(n_phase_bins):
+            column = 0
+            for im in range(n_mag_bins):
+                column += counts[ip * n_mag_bins + im]
+                h -= xlogx[counts[ip * n_mag_bins + im]]
+            h += xlogx[column]
+        entropy[k] = h / n
+
+    return entropy
+
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def _box_least_squares(t, y, w, f_min, df, n_freq, n_bins, q_min, q_max):
+    """
+        Binned box least squares signal residue for dimming events (positive y).
+        Boxes are evaluated from cumulative sums over the phase bins taken twice to wrap around
+    :param t: times, relative to the first one
+    :param y: magnitudes, minus their weighted mean
+    :param w: weights, normalized to unit sum
+    :param q_min: minimum box width, fraction of the period
+    :param q_max: maximum box width, fraction of the period
+    :return:
+    """
+    n = t.shape[0]
+    power = np.zeros(n_freq)
+    y_bins = np.empty(n_bins)
+    w_bins = np.empty(n_bins)
+    y_cum = np.zeros(2 * n_bins + 1)
+    w_cum = np.zeros(2 * n_bins + 1)
+
+    k_min = max(1, int(q_min * n_bins))
+    k_max = min(max(k_min, int(q_max * n_bins)), n_bins - 1)
+
+    phase = np.empty(n)
+    d_phase = t * df
+    d_phase -= np.floor(d_phase)
+
+    for k in range(n_freq):
+        if k % 1024 == 0:
+            for i in range(n):
+                phase[i] = t[i] * (f_min + k * df)
+                phase[i] -= np.floor(phase[i])
+
+        y_bins[:] = 0.0
+        w_bins[:] = 0.0
+        for i in range(n):
+            ib = min(int(phase[i] * n_bins), n_bins - 1)
+            y_bins[ib] += w[i] * y[i]
+            w_bins[ib] += w[i]
+            # advance to the next frequency
+            phase[i] += d_phase[i]
+            if phase[i] >= 1.0:
+                phase[i] -= 1.0
+
+        for j in range(n_bins):
+            y_cum[j + 1] = y_cum[j] + y_bins[j]
+            w_cum[j + 1] = w_cum[j] + w_bins[j]
+        for j in range(n_bins):
+            y_cum[n_bins + j + 1] = y_cum[n_bins + j] + y_bins[j]
+            w_cum[n_bins + j + 1] = w_cum[n_bins + j] + w_bins[j]
+
+        best = 0.0
+        for width in range(k_min, k_max + 1):
+            for start in range(n_bins):
+                sy = y_cum[start + width] - y_cum[start]
+                r = w_cum[start + width] - w_cum[start]
+                # only dimming counts; r * (1 - r) > 0 unless the box holds none or all of the weight
+                sy = max(sy, 0.0)
+                best = max(best, sy * sy / max(r * (1.0 - r), 1e-12))
+        power[k] = best
+
+    return power
+
+
+def periodogram(t, mag, magerr, method: str = 'ls', f_min: float = 0.001, f_max: float = 48.0,
+                n_freq: int = 100000, n_phase_bins: int = 10, n_mag_bins: int = 5,
+                n_bls_bins: int = 50, q_min: float = 0.02, q_max: float = 0.1):
+    """
+        Evaluate periodogram over a uniform frequency grid, higher is better for all methods
+    :param t: times [days]
+    :param mag:
+    :param magerr: errors, ignored by ce
+    :param method: 'ls', 'ce', or 'bls'
+    :param f_min: [1/day]
+    :param f_max: [1/day]
+    :param n_freq: number of frequencies in the grid
+    :return: frequencies, power
+    """
+    assert method in period_search_methods, f'method {method} not in {period_search_methods}'
+    assert 0 < f_min < f_max, 'bad frequency range'
+    assert n_freq >= 2, 'bad frequency grid'
+
+    t = np.asarray(t, dtype=np.float64)
+    mag = np.asarray(mag, dtype=np.float64)
+    magerr = np.asarray(magerr, dtype=np.float64)
+
+    freqs = np.linspace(f_min, f_max, n_freq)
+    df = freqs[1] - freqs[0]
+    t = t - t.min()
+
+    if method == 'ce':
+        m = (mag - mag.min()) / max(mag.max() - mag.min(), 1e-9)
+        entropy = _conditional_entropy(t, m, f_min, df, n_freq, n_phase_bins, n_mag_bins)
+        return freqs, 1.0 - entropy / np.log(n_mag_bins)
+
+    w = 1.0 / magerr ** 2
+    w /= w.sum()
+    y = mag - np.sum(w * mag)
+
+    if method == 'ls':
+        return freqs, _lomb_scargle(t, y, w, f_min, df, n_freq)
+
+    power = _box_least_squares(t, y, w, f_min, df, n_freq, n_bls_bins, q_min, q_max)
+    return freqs, power / np.sum(w * y ** 2)
+
+
+def top_peaks(freqs, power, n_peaks: int = 5, min_separation: float = 0.0):
+    """
+        Find highest local maxima of a periodogram at least min_separation apart in frequency
+    :param freqs:
+    :param power:
+    :param n_peaks:
+    :param min_separation: [1/day], e.g. 1/baseline
+    :return: indices of the peaks, highest first
+    """
+    if len(power) < 3:
+        candidates = np.arange(len(power))
+    else:
+        local_max = np.r_[power[0] > power[1],
+                          (power[1:-1] >= power[:-2]) & (power[1:-1] >= power[2:]),
+                          power[-1] > power[-2]]
+        candidates = np.flatnonzero(local_max & np.isfinite(power))
+    candidates = candidates[np.argsort(power[candidates], kind='stable')[::-1]]
+
+    peaks = []
+    for i in candidates:
+        if all(abs(freqs[i] - freqs[j]) > min_separation for j in peaks):
+            peaks.append(i)
+            if len(peaks) == n_peaks:
+                break
+
+    return np.array(peaks, dtype=np.int64)
+
+
+def filter_light_curves(lcs, min_points: int = 10):
+    """
+        Merge good detections (mag > 0 and catflags == 0 if available) of temporal light curves by filter.
+        The weighted median magnitude of each light curve is subtracted to take out zero-point offsets
+        between fields and instruments
+    :param lcs: source['lc']
+    :param min_points: skip filters with fewer good detections
+    :return: {filter: (hjd, mag, magerr)}
+    """
+    merged = dict()
+    for lc in lcs:
+        if lc.get('lc_type', 'temporal') != 'temporal':
+            continue
+        columns = series_columns(lc)
+
+        def numeric(name):
+            column = np.asarray(columns[name], dtype=np.float64)
+            return np.where(np.isnan(column), 0.0, column)
+
+        if 'mag' not in columns:
+            continue
+        mag = numeric('mag')
+        hjd = numeric('hjd') if 'hjd' in columns else numeric('mjd') + 2400000.5
+        magerr = numeric('magerr') if 'magerr' in columns else np.zeros_like(mag)
+
+        good = (mag > 0) & np.isfinite(hjd)
+        if 'catflags' in columns:
+            good &= numeric('catflags') == 0
+        if good.sum() == 0:
+            continue
+        hjd, mag, magerr = hjd[good], mag[good], magerr[good]
+
+        # missing or bad errors: use the typical error of the light curve
+        bad_err = ~(magerr > 0)
+        if bad_err.any():
+            magerr[bad_err] = np.median(magerr[~bad_err]) if (~bad_err).any() else 1.0
+
+        merged.setdefault(lc['filter'], []).append((hjd, mag - np.median(mag), magerr))
+
+    return {filt: tuple(np.concatenate(column) for column in zip(*parts))
+            for filt, parts in merged.items() if sum(len(part[0]) for part in parts) >= min_points}
+
+
+def period_search(lcs, method: str = 'ls', f_min: float = 0.001, f_max: float = 48.0, n_freq: int = 100000,
+                  n_peaks: int = 5, min_points: int = 10, periodogram_points: int = 0):
+    """
+        Run period search on the light curves of a source, merged by filter.
+        CPU-bound, meant to be run in a process pool
+    :param lcs: source['lc']
+    :param method: 'ls', 'ce', or 'bls'
+    :param f_min: [1/day]
+    :param f_max: [1/day]
+    :param n_freq:
+    :param n_peaks: number of peaks to report per filter
+    :param min_points: skip filters with fewer good detections
+    :param periodogram_points: also return the periodogram decimated to about this many points if > 0
+    :return: [{'filter', 'n', 'baseline', 'peaks': [{'period', 'period_unit', 'frequency', 'power'}],
+               <'periodogram': {'frequency': [], 'power': []}>}]
+    """
+    results = []
+    for filt, (hjd, mag, magerr) in sorted(filter_light_curves(lcs, min_points=min_points).items()):
+        freqs, power = periodogram(hjd, mag, magerr, method=method, f_min=f_min, f_max=f_max, n_freq=n_freq)
+
+        baseline = float(hjd.max() - hjd.min())
+        peaks = top_peaks(freqs, power, n_peaks=n_peaks,
+                          min_separation=1.0 / baseline if baseline > 0 else 0.0)
+
+        result = {'filter': filt,
+                  'n': int(len(hjd)),
+                  'baseline': baseline,
+                  'peaks': [{'period': float(1.0 / freqs[i]), 'period_unit': 'Days',
+                             'frequency': float(freqs[i]), 'power': float(power[i])} for i in peaks]}
+        if periodogram_points > 0:
+            index = decimate_minmax(freqs, power, periodogram_points)
+            result['periodogram'] = {'frequency': freqs[index].tolist(), 'power': power[index].tolist()}
+        results.append(result)
+
+    return results
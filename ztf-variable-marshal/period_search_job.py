@@ -0,0 +1,255 @@
+import argparse
+from bson.json_util import dumps, loads
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import json
+import pymongo
+import threading
+import traceback
+from period_search import period_search, period_search_methods
+from utils import compute_hash, utc_now
+
+
+''' load config and secrets '''
+with open('/app/config.json') as cjson:
+    config = json.load(cjson)
+
+with open('/app/secrets.json') as sjson:
+    secrets = json.load(sjson)
+
+for k in secrets:
+    if k in config:
+        config[k].update(secrets.get(k, {}))
+    else:
+        config[k] = secrets[k]
+
+
+def search_source(source, params):
+    """
+        Run period search on a source in a worker process
+    :return: source _id, results or None, error or None
+    """
+    try:
+        return source['_id'], period_search(source.get('lc', []), **params), None
+    except Exception as e:
+        return source['_id'], None, str(e)
+
+
+def result_update(source_id, results, params, user, time_tag, previous=None):
+    """
+        Make bulk write request storing period search results in source['period_search'][method].
+        A history note is only added if the results changed
+    :param previous: source['period_search'][method] from an earlier run, if any
+    :return: pymongo.UpdateOne or None if neither the results nor the parameters changed
+    """
+    doc = {**params, 'results': results, 'user': user, 'created': time_tag}
+    update = {'$set': {f"period_search.{params['method']}": doc,
+                       'last_modified': time_tag}}
+
+    if (previous is not None) and (previous.get('results', None) == results):
+        if all(previous.get(k, None) == v for k, v in params.items()):
+            return None
+    else:
+        best = ', '.join(f"{result['filter']}: {result['peaks'][0]['period']:.6f} Days"
+                         for result in results if len(result['peaks']) > 0)
+        h = {'note_type': 'period_search',
+             'time_tag': time_tag,
+             'user': user,
+             'note': f"{params['method']} {best}"}
+        update['$push'] = {'history': h}
+
+    return pymongo.UpdateOne({'_id': source_id}, update)
+
+
+def keep_lease(collection, job_filter, lease, stop):
+    """
+        Renew the job's lease every lease/3 seconds until stop is set,
+        so that the server marks the job as failed if this process dies
+    """
+    while not stop.wait(lease / 3):
+        try:
+            collection.update_one(job_filter, {'$set': {'lease_until': utc_now() + datetime.timedelta(seconds=lease)}})
+        except Exception as e:
+            print(f'failed to renew job lease: {str(e)}')
+
+
+if __name__ == '__main__':
+    defaults = config['misc']['period_search']
+
+    parser = argparse.ArgumentParser(description='Run period search over the saved sources of a program. '
+                                                 'Progress is reported and checkpointed in the queries collection, '
+                                                 'so re-running the same job resumes where it stopped')
+    parser.add_argument('program_id', type=int, help='zvm_program_id')
+    parser.add_argument('--filter', type=str, default='{}',
+                        help='additional sources filter, MongoDB extended json')
+    parser.add_argument('--method', choices=period_search_methods, default=defaults['method'])
+    parser.add_argument('--f_min', type=float, default=defaults['f_min'], help='[1/day]')
+    parser.add_argument('--f_max', type=float, default=defaults['f_max'], help='[1/day]')
+    parser.add_argument('--n_freq', type=int, default=defaults['n_freq'])
+    parser.add_argument('--n_peaks', type=int, default=defaults['n_peaks'])
+    parser.add_argument('--min_points', type=int, default=defaults['min_points'])
+    parser.add_argument('--batch_size', type=int, default=200, help='sources per bulk write and checkpoint')
+    parser.add_argument('--max_workers', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--user', type=str, default=config['server']['admin_username'],
+                        help='owner of the job in the queries collection')
+    parser.add_argument('--restart', action='store_true', help='ignore checkpoint and start over')
+    parser.add_argument('--retry_failed', '--retry-failed', action='store_true',
+                        help='only re-run the sources that failed in earlier runs of the job')
+
+    args = parser.parse_args()
+
+    source_filter = loads(args.filter)
+    assert isinstance(source_filter, dict), 'filter must be a json object'
+    source_filter['zvm_program_id'] = args.program_id
+
+    params = {'method': args.method, 'f_min': args.f_min, 'f_max': args.f_max, 'n_freq': args.n_freq,
+              'n_peaks': args.n_peaks, 'min_points': args.min_points}
+
+    client = pymongo.MongoClient(host=config['database']['host'],
+                                 port=config['database']['port'])
+
+    db = client[config['database']['db']]
+    db.authenticate(name=config['database']['user'], password=config['database']['pwd'])
+
+    # the same job on the same sources gets the same id, so that it can be resumed
+    job_id = compute_hash(dumps({'type': 'period_search_job', 'filter': source_filter, 'params': params}))
+
+    job = db['queries'].find_one({'task_id': job_id, 'user': args.user})
+    if args.retry_failed:
+        if job is None:
+            print(f'job {job_id} not found')
+            raise SystemExit(1)
+        failed_ids = job['progress'].get('failed_ids', [])
+        print(f'retrying {len(failed_ids)} failed sources of job {job_id}')
+    elif (job is not None) and (not args.restart):
+        if job['status'] == 'done':
+            print(f'job {job_id} already done, use --restart to re-run it')
+            raise SystemExit(0)
+        last_id = job['progress']['last_id']
+        print(f'resuming job {job_id} after {last_id}')
+    else:
+        last_id = None
+        n_total = db['sources'].count_documents(source_filter)
+        # job docs look like saved queries without task/result files, so that they can be
+        # polled and deleted through /query; deleting a job stops it
+        db['queries'].replace_one({'task_id': job_id, 'user': args.user},
+                                  {'task_id': job_id, 'user': args.user,
+                                   'query_type': 'period_search_job',
+                                   'query': {'filter': dumps(source_filter), 'params': params},
+                                   'task': None,
+                                   'status': 'running',
+                                   'progress': {'n_total': n_total, 'n_done': 0, 'n_failed': 0, 'last_id': None,
+                                                'failed_ids': []},
+                                   'created': utc_now(),
+                                   'last_modified': utc_now()},
+                                  upsert=True)
+        print(f'started job {job_id} on {n_total} sources')
+
+    # a retry leaves the job's status and checkpoint alone
+    stop_lease = threading.Event()
+    if not args.retry_failed:
+        lease = float(config['misc']['query_lease'])
+        db['queries'].update_one({'task_id': job_id, 'user': args.user},
+                                 {'$set': {'status': 'running', 'last_modified': utc_now(),
+                                           'lease_until': utc_now() + datetime.timedelta(seconds=lease)}})
+        threading.Thread(target=keep_lease,
+                         args=(db['queries'], {'task_id': job_id, 'user': args.user}, lease, stop_lease),
+                         daemon=True).start()
+
+    # previous results are compared with the new ones to only note changes in the history
+    projection = {'lc': 1, f"period_search.{params['method']}": 1}
+
+    def batches():
+        if args.retry_failed:
+            for i in range(0, len(failed_ids), args.batch_size):
+                batch_ids = failed_ids[i:i + args.batch_size]
+                batch = list(db['sources'].find({'_id': {'$in': batch_ids}}, projection))
+                # sources deleted since they failed cannot be retried
+                found = {source['_id'] for source in batch}
+                missing = [_id for _id in batch_ids if _id not in found]
+                if len(missing) > 0:
+                    db['queries'].update_one({'task_id': job_id, 'user': args.user},
+                                             {'$set': {'last_modified': utc_now()},
+                                              '$pull': {'progress.failed_ids': {'$in': missing}},
+                                              '$inc': {'progress.n_failed': -len(missing)}})
+                    print(f'{len(missing)} failed sources no longer exist')
+                if len(batch) > 0:
+                    yield batch
+        else:
+            after = last_id
+            while True:
+                _filter = {**source_filter, '_id': {'$gt': after}} if after is not None else source_filter
+                batch = list(db['sources'].find(_filter, projection).sort('_id', pymongo.ASCENDING)
+                             .limit(args.batch_size))
+                if len(batch) == 0:
+                    return
+                after = batch[-1]['_id']
+                yield batch
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.max_workers) as executor:
+            source_batches = batches()
+            sources = next(source_batches, [])
+
+            while len(sources) > 0:
+                previous = {source['_id']: source.pop('period_search', dict()).get(params['method'], None)
+                            for source in sources}
+                futures = [executor.submit(search_source, source, params) for source in sources]
+                last_id = sources[-1]['_id']
+                # read the next batch while the workers are busy
+                sources = next(source_batches, [])
+
+                time_tag = utc_now()
+                requests = []
+                failed, succeeded = [], []
+                for future in futures:
+                    source_id, results, error = future.result()
+                    if error is not None:
+                        print(f'{source_id}: {error}')
+                        failed.append(source_id)
+                        continue
+                    succeeded.append(source_id)
+                    request = result_update(source_id, results, params, args.user, time_tag,
+                                            previous=previous[source_id])
+                    if request is not None:
+                        requests.append(request)
+
+                if len(requests) > 0:
+                    db['sources'].bulk_write(requests, ordered=False)
+                    # let the servers know their cached query results are stale
+                    db[config['database']['collection_versions']].update_one({'_id': 'sources'},
+                                                                             {'$inc': {'version': 1}}, upsert=True)
+
+                # checkpoint
+                if args.retry_failed:
+                    job_update = db['queries'].update_one({'task_id': job_id, 'user': args.user},
+                                                          {'$set': {'last_modified': utc_now()},
+                                                           '$pull': {'progress.failed_ids': {'$in': succeeded}},
+                                                           '$inc': {'progress.n_failed': -len(succeeded)}})
+                else:
+                    job_update = db['queries'].update_one({'task_id': job_id, 'user': args.user},
+                                                          {'$set': {'progress.last_id': last_id,
+                                                                    'last_modified': utc_now()},
+                                                           '$inc': {'progress.n_done': len(futures),
+                                                                    'progress.n_failed': len(failed)},
+                                                           '$addToSet': {'progress.failed_ids': {'$each': failed}}})
+                if job_update.matched_count == 0:
+                    print(f'job {job_id} deleted, stopping')
+                    raise SystemExit(1)
+
+                print(f'{last_id}: {len(futures)} sources processed, {len(failed)} failed, '
+                      f'{len(futures) - len(failed) - len(requests)} unchanged')
+
+    except Exception as e:
+        print(traceback.format_exc())
+        db['queries'].update_one({'task_id': job_id, 'user': args.user},
+                                 {'$set': {'status': 'failed', 'message': str(e), 'last_modified': utc_now()}})
+        raise
+
+    finally:
+        stop_lease.set()
+
+    if not args.retry_failed:
+        db['queries'].update_one({'task_id': job_id, 'user': args.user},
+                                 {'$set': {'status': 'done', 'last_modified': utc_now()}})
+    print(f'job {job_id} done')
@@ -0,0 +1,122 @@
+import aiohttp
+import asyncio
+
+from utils import DiskCache, PANSTARRS_SOURCE, build_panstarrs_link, build_rgb_ps_stamp_url, parse_ps_filenames
+
+
+''' Pan-STARRS1 color cutouts '''
+
+
+class PS1Cutouts(object):
+    """
+        Fetch PS1 RGB cutouts from STScI without blocking the event loop.
+
+        All requests go through one shared aiohttp.ClientSession, at most max_concurrent sources are fetched at a time.
+        PNGs are cached on disk under (ra, dec) rounded to precision decimal places, size and colors;
+        identical requests arriving while a fetch is in progress wait for that fetch instead of starting another one.
+        Positions outside of the PS1 footprint are cached as empty images
+    """
+    def __init__(self, cache: DiskCache, source: str = PANSTARRS_SOURCE, timeout: float = 10,
+                 max_concurrent: int = 16, precision: int = 5):
+        self.cache = cache
+        self.source = source
+        self.timeout = timeout
+        self.precision = precision
+
+        self.session = None
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        # cache key -> asyncio.Task
+        self.in_flight = dict()
+
+        # metrics
+        self.fetched = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def key(self, ra, dec, size, color):
+        return round(float(ra), self.precision), round(float(dec), self.precision), int(size), ''.join(color)
+
+    async def fetch(self, ra, dec, size, color):
+        """
+            Look up file names and download the cutout
+        :return: PNG bytes, b'' if there is no PS1 data at (ra, dec)
+        """
+        async with self.semaphore:
+            async with self.session.get(build_panstarrs_link(ra, dec, source=self.source)) as resp:
+                resp.raise_for_status()
+                try:
+                    file_names = parse_ps_filenames(await resp.text(), color=color)
+                except ValueError:
+                    # some of the colors are missing
+                    return b''
+
+            if len(file_names) != 3:
+                return b''
+            red, blue, green = file_names
+
+            async with self.session.get(build_rgb_ps_stamp_url(ra, dec, red, blue, green,
+                                                               size=size, source=self.source)) as resp:
+                resp.raise_for_status()
+                return await resp.read()
+
+    async def fetch_and_cache(self, key):
+        """
+            Fetch the rounded position, so that all requests with the same key get the same image, and cache it
+        """
+        try:
+            png = await self.fetch(*key)
+            self.fetched += 1
+            self.cache.put('ps1', key, png)
+            return png
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight.pop(key, None)
+
+    async def get(self, ra, dec, size: int = 240, color=('y', 'g', 'i')):
+        """
+            Get cutout centered on (ra, dec) [deg, deg]
+        :param ra:
+        :param dec:
+        :param size: [pix]
+        :param color: PS1 filters for R, G, B
+        :return: PNG bytes, b'' if there is no PS1 data at (ra, dec)
+        """
+        key = self.key(ra, dec, size, color)
+
+        png = self.cache.get('ps1', key)
+        if png is not None:
+            return png
+
+        if key in self.in_flight:
+            self.coalesced += 1
+        else:
+            self.in_flight[key] = asyncio.ensure_future(self.fetch_and_cache(key))
+
+        # don't let a cancelled request cancel the fetch for everyone else
+        return await asyncio.shield(self.in_flight[key])
+
+    async def get_many(self, coordinates, size: int = 240, color=('y', 'g', 'i')):
+        """
+            Get cutouts for many positions concurrently
+        :param coordinates: [(ra, dec)]
+        :return: [PNG bytes or None if fetching failed]
+        """
+        results = await asyncio.gather(*[self.get(ra, dec, size=size, color=color) for ra, dec in coordinates],
+                                       return_exceptions=True)
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    def metrics(self):
+        return {'in_flight': len(self.in_flight),
+                'fetched': self.fetched,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+                'cache': self.cache.metrics()}
@@ -0,0 +1,370 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import io
+import time
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+import matplotlib.image as mpimg
+import numpy as np
+import pandas as pd
+
+from utils import decimate_merged, lc_colors, series_columns
+
+
+''' plots for the source pages
+
+    render_* functions build figures with the object-oriented Agg API (no pyplot global state)
+    and return PNG bytes. they are CPU-bound and meant to be run in worker processes through RenderService.
+    the HR diagram lives in hr_diagram.py
+'''
+
+
+def figure_png(fig, tight_layout: bool = True):
+    """
+        Render figure to PNG
+    :param fig: matplotlib.figure.Figure
+    :param tight_layout:
+    :return: bytes
+    """
+    FigureCanvasAgg(fig)
+    if tight_layout:
+        fig.tight_layout(pad=0, h_pad=0, w_pad=0)
+    buff = io.BytesIO()
+    fig.savefig(buff, dpi=200, bbox_inches='tight')
+    return buff.getvalue()
+
+
+def lc_frame(lc):
+    df_plc = pd.DataFrame(series_columns(lc))
+
+    if 'mjd' not in df_plc:
+        df_plc['mjd'] = df_plc['hjd'] - 2400000.5
+    if 'hjd' not in df_plc:
+        df_plc['hjd'] = df_plc['mjd'] + 2400000.5
+
+    return df_plc
+
+
+def decimate_by_filter(lcs, frames, subset, x: str, max_points: int):
+    """
+        Decimate the points of the light curves selected by subset merged by filter
+    :param lcs: source['lc']
+    :param frames: lc_frame's of lcs
+    :param subset: function of a frame returning a boolean mask of the points to consider
+    :param x: column to decimate along
+    :param max_points: target number of points per filter
+    :return: [boolean mask of the points to plot] for each light curve
+    """
+    masks = [np.asarray(subset(df_plc), dtype=bool) for df_plc in frames]
+
+    filters = dict()
+    for i, lc in enumerate(lcs):
+        filters.setdefault(lc['filter'], []).append(i)
+
+    for members in filters.values():
+        indexes = decimate_merged([frames[i][x].values[masks[i]] for i in members],
+                                  [frames[i]['mag'].values[masks[i]] for i in members], max_points)
+        for i, index in zip(members, indexes):
+            mask = np.zeros(len(masks[i]), dtype=bool)
+            mask[np.flatnonzero(masks[i])[index]] = True
+            masks[i] = mask
+
+    return masks
+
+
+def render_lc(source_id, lcs, w: float = 10, h: float = 4, hist: bool = False, bins='auto',
+              period=None, units: str = 'days', plot_twice: bool = False, max_points: int = 0):
+    """
+        Light curve plot, optionally phase-folded and with a histogram of magnitudes on the right-hand side
+    :param source_id:
+    :param lcs: source['lc']
+    :param w: width [inch]
+    :param h: height [inch]
+    :param hist:
+    :param bins: histogram bins
+    :param period: phase-fold at period [days] if not None
+    :param units: units the period was given in, for the title
+    :param plot_twice: plot two periods
+    :param max_points: decimate light curves merged by filter to about max_points per filter and data subset
+    :return: PNG bytes
+    """
+    fig = Figure(figsize=(w, h), dpi=200)
+
+    if not hist:
+        ax_plc = fig.add_subplot(111)
+    else:
+        # definitions for the axes
+        left, width = 0.1, 0.65
+        bottom, height = 0.1, 0.65
+        spacing = 0.005
+
+        rect_scatter = [left, bottom, width, height]
+        rect_histy = [left + width + spacing, bottom, 0.2, height]
+
+        ax_plc = fig.add_axes(rect_scatter)
+        ax_plc.tick_params(direction='in', top=True, right=True)
+        ax_histy = fig.add_axes(rect_histy)
+        ax_histy.tick_params(direction='in', labelleft=False)
+
+    if period is None:
+        ax_plc.title.set_text(f'Photometric light curve for {source_id}')
+    else:
+        ax_plc.title.set_text(f'Phase-folded light curve for {source_id} with ' r"$\bf{"
+                              f'p={period}\\:{units}' "}$")
+
+    def is_good(df_plc):
+        return (df_plc['catflags'] == 0) if 'catflags' in df_plc else (df_plc['mag'] != 0)
+
+    def is_flagged(df_plc):
+        return (df_plc['catflags'] != 0) if 'catflags' in df_plc else np.zeros(len(df_plc), dtype=bool)
+
+    def is_good_detection(df_plc):
+        return ((df_plc['mag'] != 0) & (df_plc['catflags'] == 0)) if 'catflags' in df_plc else (df_plc['mag'] != 0)
+
+    frames = [lc_frame(lc) for lc in lcs]
+
+    if period is None:
+        good = decimate_by_filter(lcs, frames, is_good, 'hjd', max_points)
+        flagged = decimate_by_filter(lcs, frames, is_flagged, 'hjd', max_points)
+    else:
+        # phase-folded lc:
+        for df_plc in frames:
+            df_plc['phase'] = (df_plc['hjd'] / period) % 1
+
+        # decimate in phase to preserve the shape of the folded light curve
+        det = decimate_by_filter(lcs, frames, is_good_detection, 'phase', max_points)
+
+    lc_color_indexes = dict()
+
+    for i, (lc, df_plc) in enumerate(zip(lcs, frames)):
+        filt = lc['filter']
+        lc_color_indexes[filt] = lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
+        c = lc_colors(filt, lc_color_indexes[filt])
+
+        if period is None:
+            if np.sum(good[i]) > 0:
+                ax_plc.errorbar(df_plc.loc[good[i], 'hjd'], df_plc.loc[good[i], 'mag'],
+                                yerr=df_plc.loc[good[i], 'magerr'], elinewidth=0.4,
+                                marker='.', c=c, lw=0, label=f'filter: {filt}')
+
+            if np.sum(flagged[i]) > 0:
+                ax_plc.errorbar(df_plc.loc[flagged[i], 'hjd'], df_plc.loc[flagged[i], 'mag'],
+                                yerr=df_plc.loc[flagged[i], 'magerr'], elinewidth=0.4,
+                                marker='x', alpha=0.5, c=c, lw=0, label=f'filter: {filt}, flagged')
+
+        else:
+            t, mag, mag_error = df_plc.loc[det[i], 'phase'].values, df_plc.loc[det[i], 'mag'].values, \
+                                df_plc.loc[det[i], 'magerr'].values
+            if plot_twice:
+                t, mag, mag_error = np.hstack((t, t + 1)), np.hstack((mag, mag)), \
+                                    np.hstack((mag_error, mag_error))
+
+            ax_plc.errorbar(t, mag, yerr=mag_error, elinewidth=0.4,
+                            marker='.', c=c, lw=0, label=f'filter: {filt}')
+
+        if hist:
+            if (period is not None) and ('catflags' in df_plc):
+                w_det = (df_plc['mag'] != 0) & (df_plc['catflags'] == 0)
+            else:
+                w_det = df_plc['mag'] != 0
+            mag = df_plc.loc[w_det, 'mag']
+            ax_histy.hist(mag, bins=bins, color=c, alpha=0.5, label=f'filter: {filt}', orientation='horizontal')
+
+    ax_plc.invert_yaxis()
+    ax_plc.grid(True, lw=0.3)
+    ax_plc.set_ylabel('mag')
+
+    if not hist:
+        ax_plc.legend(bbox_to_anchor=(1, 1), loc='upper left', ncol=1, fontsize='x-small')
+    else:
+        ax_histy.invert_yaxis()
+        ax_histy.grid(True, lw=0.3)
+        ax_histy.legend(bbox_to_anchor=(1, 1), loc='upper left', ncol=1, fontsize='x-small')
+
+    # manually placed axes do not get along with tight_layout
+    return figure_png(fig, tight_layout=not hist)
+
+
+def render_maghist(source_id, lcs, w: float = 4.3, h: float = 4, bins='auto'):
+    """
+        Histogram of magnitudes of good detections
+    :param source_id:
+    :param lcs: source['lc']
+    :param w: width [inch]
+    :param h: height [inch]
+    :param bins:
+    :return: PNG bytes
+    """
+    fig = Figure(figsize=(w, h), dpi=200)
+    ax_plc = fig.add_subplot(111)
+    ax_plc.title.set_text(f'Histogram of magnitudes for {source_id}')
+
+    lc_color_indexes = dict()
+
+    for lc in lcs:
+        filt = lc['filter']
+        lc_color_indexes[filt] = lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
+        c = lc_colors(filt, lc_color_indexes[filt])
+
+        df_plc = lc_frame(lc)
+
+        if 'catflags' in df_plc:
+            w_det = (df_plc['mag'] != 0) & (df_plc['catflags'] == 0)
+        else:
+            w_det = df_plc['mag'] != 0
+
+        ax_plc.hist(df_plc.loc[w_det, 'mag'], bins=bins, color=c, alpha=0.5, label=f'filter: {filt}')
+
+    ax_plc.grid(True, lw=0.3)
+    ax_plc.set_xlabel('mag')
+    ax_plc.legend(loc='best', ncol=1, fontsize='x-small')
+
+    return figure_png(fig)
+
+
+def render_sparklines(lcs_list, w: int = 120, h: int = 24, point_size: int = 2):
+    """
+        Tiny light curve thumbnails stacked into one sprite sheet, rasterized with numpy in one pass over
+        the detections of all sources: time and magnitude are scaled to each source's time span and to
+        its 1-99th magnitude percentiles, brighter is up
+    :param lcs_list: [source['lc']], may contain empty lists
+    :param w: thumbnail width [pix]
+    :param h: thumbnail height [pix]
+    :param point_size: [pix]
+    :return: PNG bytes, w x len(lcs_list) * h pixels, thumbnail i in rows i * h to (i + 1) * h
+    """
+    t, mag, src, rgba = [], [], [], []
+
+    for i, lcs in enumerate(lcs_list):
+        lc_color_indexes = dict()
+        for lc in lcs:
+            filt = lc.get('filter', None)
+            lc_color_indexes[filt] = lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
+
+            columns = series_columns(lc)
+            if ('mag' not in columns) or (('hjd' not in columns) and ('mjd' not in columns)):
+                continue
+            _t = np.asarray(columns['hjd'] if 'hjd' in columns else columns['mjd'], dtype=np.float64)
+            _mag = np.asarray(columns['mag'], dtype=np.float64)
+
+            w_det = np.isfinite(_t) & np.isfinite(_mag) & (_mag != 0)
+            if 'catflags' in columns:
+                w_det &= np.asarray(columns['catflags'], dtype=np.float64) == 0
+
+            n = int(np.sum(w_det))
+            t.append(_t[w_det])
+            mag.append(_mag[w_det])
+            src.append(np.full(n, i, dtype=np.int64))
+            rgba.append(np.tile(np.array(to_rgba(lc_colors(filt, lc_color_indexes[filt]))) * 255, (n, 1)))
+
+    n_sources = len(lcs_list)
+    img = np.zeros((n_sources * h, w, 4), dtype=np.uint8)
+
+    if len(t) > 0 and sum(len(_t) for _t in t) > 0:
+        t, mag, src = np.concatenate(t), np.concatenate(mag), np.concatenate(src)
+        rgba = np.concatenate(rgba).astype(np.uint8)
+
+        # per-source limits, vectorized over groups of points sorted by source
+        order = np.lexsort((t, src))
+        sources, starts, counts = np.unique(src[order], return_index=True, return_counts=True)
+        t_lo, t_hi = np.zeros(n_sources), np.ones(n_sources)
+        t_lo[sources] = t[order][starts]
+        t_hi[sources] = t[order][starts + counts - 1]
+
+        order = np.lexsort((mag, src))
+        mag_lo, mag_hi = np.zeros(n_sources), np.ones(n_sources)
+        mag_lo[sources] = mag[order][starts + np.floor(0.01 * (counts - 1)).astype(np.int64)]
+        mag_hi[sources] = mag[order][starts + np.ceil(0.99 * (counts - 1)).astype(np.int64)]
+
+        t_span = np.where(t_hi > t_lo, t_hi - t_lo, 1)[src]
+        mag_span = np.where(mag_hi > mag_lo, mag_hi - mag_lo, 1)[src]
+        x = np.clip((t - t_lo[src]) / t_span * (w - point_size), 0, w - point_size).astype(np.int64)
+        y = np.clip((mag - mag_lo[src]) / mag_span * (h - point_size), 0, h - point_size).astype(np.int64)
+        row = src * h + y
+
+        for dy in range(point_size):
+            for dx in range(point_size):
+                img[row + dy, x + dx] = rgba
+
+    buff = io.BytesIO()
+    mpimg.imsave(buff, img, format='png')
+    return buff.getvalue()
+
+
+class RenderService(object):
+    """
+        Run render_* functions in a bounded process pool so that they do not block the event loop.
+        At most max_concurrent renders are submitted at a time, the rest wait for a slot;
+        renders that take longer than timeout seconds (including the wait) raise asyncio.TimeoutError
+        but keep their slot until the worker process is done with them
+    """
+    def __init__(self, max_workers: int = 2, max_concurrent: int = 8, timeout: float = 30.0):
+        self.max_workers = max_workers
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+
+        # metrics
+        self.in_flight = 0
+        self.rendered = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.render_time_total = 0.0
+
+    def release(self, future):
+        """
+            Free the slot of a finished render. The result is retrieved so that renders
+            nobody waits for anymore do not log unretrieved exceptions
+        """
+        self.semaphore.release()
+        if not future.cancelled():
+            future.exception()
+
+    async def render(self, func, *args, **kwargs):
+        """
+            Run func(*args, **kwargs) in the pool
+        :return: PNG bytes
+        """
+        loop = asyncio.get_event_loop()
+        tic = time.monotonic()
+        self.in_flight += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+            future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+            # the slot stays taken until the worker process is done, even if we time out or get cancelled:
+            # the future is shielded, so that it only completes when the render does
+            future.add_done_callback(self.release)
+
+            png = await asyncio.wait_for(asyncio.shield(future), max(self.timeout - (time.monotonic() - tic), 0))
+            self.rendered += 1
+            self.render_time_total += time.monotonic() - tic
+            return png
+
+        except asyncio.TimeoutError:
+            # the worker finishes the render in the background, the result is discarded
+            self.timed_out += 1
+            raise
+
+        except Exception:
+            self.failed += 1
+            raise
+
+        finally:
+            self.in_flight -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def metrics(self):
+        return {'max_workers': self.max_workers,
+                'max_concurrent': self.max_concurrent,
+                'in_flight': self.in_flight,
+                'rendered': self.rendered,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+                'render_time_mean': self.render_time_total / self.rendered if self.rendered > 0 else None}
@@ -12,27 +12,33 @@ import asyncio
 import base64
 from bson.json_util import loads, dumps
 from collections import Mapping
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+from email.utils import format_datetime
 import jinja2
 import json
 import jwt
-import matplotlib.pyplot as plt
+import msgpack
 from misaka import Markdown, HtmlRenderer
 from motor.motor_asyncio import AsyncIOMotorClient
 import numpy as np
 import os
-import pandas as pd
 import pathlib
-from penquins import Kowalski
+import pyarrow as pa
 import pymongo
 import random
-import re
 import shutil
 import string
 import time
 import traceback
+from urllib.parse import parse_qsl
 
 from utils import *
+from period_search import period_search, period_search_methods
+from render import RenderService, render_lc, render_maghist, render_sparklines
+from hr_diagram import render_hr
+from ps1 import PS1Cutouts
+from kowalski_gateway import KowalskiGateway
 
 
 ''' markdown rendering '''
@@ -201,6 +207,48 @@ def login_required(func):
     return wrapper
 
 
+def invalidates_query_cache(*collections):
+    """
+        Wrapper to drop cached query results that depend on the collections modified by the handler,
+        in this process right away and in the other ones by bumping the collection versions
+    :param collections:
+    :return:
+    """
+    def decorator(func):
+        async def wrapper(request):
+            try:
+                return await func(request)
+            finally:
+                for collection in collections:
+                    request.app['query_cache'].invalidate(collection)
+                    await bump_collection_version(request.app['mongo'], collection)
+        return wrapper
+    return decorator
+
+
+async def bump_collection_version(db, collection: str):
+    """
+        Increment the version of collection, telling the query caches of all processes that it was modified
+    :param db: motor database
+    :param collection: collection name
+    :return:
+    """
+    await db[config['database']['collection_versions']].update_one({'_id': collection},
+                                                                    {'$inc': {'version': 1}}, upsert=True)
+
+
+async def collection_versions(db, collections=None):
+    """
+        Get current versions of collections
+    :param db: motor database
+    :param collections: collection names, all if None
+    :return: {collection: version}
+    """
+    _filter = {'_id': {'$in': list(collections)}} if collections is not None else {}
+    cursor = db[config['database']['collection_versions']].find(_filter, {'version': 1})
+    return {doc['_id']: doc['version'] async for doc in cursor}
+
+
 async def token_ok(request, jwt_token):
     try:
         payload = jwt.decode(jwt_token, request.app['JWT']['JWT_SECRET'],
@@ -603,6 +651,7 @@ async def programs_get_handler(request):
 
 @routes.put('/programs')
 @login_required
+@invalidates_query_cache('programs')
 async def programs_put_handler(request):
     """
         Add new program to DB
@@ -646,9 +695,29 @@ async def programs_put_handler(request):
 ''' query API'''
 
 
-regex = dict()
-regex['collection_main'] = re.compile(r"db\[['\"](.*?)['\"]\]")
-regex['aggregate'] = re.compile(r"aggregate\((\[(?s:.*)\])")
+def route_general_search(plan):
+    """
+        Map compiled general_search plan onto the equivalent convenience query type if there is one,
+        so that it is executed by the same (streaming, paginating, caching) machinery
+    :param plan:
+    :return: query_type, query, kwargs or None
+    """
+    params = plan['params']
+
+    if plan['method'] == 'find':
+        query = {'catalog': plan['catalog'],
+                 'filter': params.get('filter', None) or dict(),
+                 'projection': params.get('projection', None) or dict()}
+        kwargs = {kk: params[kk] for kk in ('skip', 'limit', 'sort', 'hint') if kk in params}
+        return 'find', query, kwargs
+
+    elif (plan['method'] == 'aggregate') and (set(params.keys()) <= {'pipeline', 'allowDiskUse'}):
+        return 'aggregate', {'catalog': plan['catalog'], 'pipeline': params['pipeline']}, dict()
+
+    elif (plan['method'] in ('find_one', 'count_documents')) and (set(params.keys()) <= {'filter'}):
+        return plan['method'], {'catalog': plan['catalog'], 'filter': params.get('filter', None) or dict()}, dict()
+
+    return None
 
 
 def parse_query(task, save: bool = False):
@@ -663,64 +732,35 @@ def parse_query(task, save: bool = False):
     #     task_reduced['kwargs']['_id'] = ''.join(random.choices(string.ascii_letters + string.digits, k=32))
 
     if task['query_type'] == 'general_search':
-        # specify task type:
-        task_reduced['query_type'] = 'general_search'
-        # nothing dubious to start with?
-        if task['user'] != config['server']['admin_username']:
-            go_on = True in [s in str(task['query']) for s in ['.aggregate(',
-                                                               '.map_reduce(',
-                                                               '.distinct(',
-                                                               '.estimated_document_count(',
-                                                               '.count_documents(',
-                                                               '.index_information(',
-                                                               '.find_one(',
-                                                               '.find(']] and \
-                    True not in [s in str(task['query']) for s in ['import',
-                                                                   'pymongo.',
-                                                                   'shutil.',
-                                                                   'command(',
-                                                                   'bulk_write(',
-                                                                   'exec(',
-                                                                   'spawn(',
-                                                                   'subprocess(',
-                                                                   'call(',
-                                                                   'insert(',
-                                                                   'update(',
-                                                                   'delete(',
-                                                                   'create_index(',
-                                                                   'create_collection(',
-                                                                   'run(',
-                                                                   'popen(',
-                                                                   'Popen(']] and \
-                    str(task['query']).strip()[0] not in ('"', "'", '[', '(', '{', '\\')
-        else:
-            go_on = True
+        # compile query into a plan. only whitelisted read-only collection methods with literal arguments
+        # are allowed, see utils.general_search_methods
+        plan = compile_general_search(str(task['query']))
 
         # TODO: check access permissions:
         # TODO: for now, only check on admin stuff
         if task['user'] != config['server']['admin_username']:
             prohibited_collections = ('users', 'stats', 'queries')
 
-            # get the main collection that is being queried:
-            main_collection = regex['collection_main'].search(str(task['query'])).group(1)
-            # print(main_collection)
+            collections = {plan['catalog']}
+            # aggregating?
+            if plan['method'] == 'aggregate':
+                collections = query_collections({'query_type': 'aggregate',
+                                                 'query': {'catalog': plan['catalog'],
+                                                           'pipeline': plan['params'].get('pipeline', [])}})
 
-            if main_collection in prohibited_collections:
-                go_on = False
+            if len(collections.intersection(prohibited_collections)) > 0:
+                raise Exception('Atata!')
 
-            # aggregating?
-            if '.aggregate(' in str(task['query']):
-                pipeline = literal_eval(regex['aggregate'].search(str(task['query'])).group(1))
-                # pipeline = literal_eval(self.regex['aggregate'].search(str(task['query'])).group(1))
-                lookups = [_ip for (_ip, _pp) in enumerate(pipeline) if '$lookup' in _pp]
-                for _l in lookups:
-                    if pipeline[_l]['$lookup']['from'] in prohibited_collections:
-                        go_on = False
+        # run as a convenience query type?
+        route = route_general_search(plan)
+        if route is not None:
+            query_type, query, route_kwargs = route
+            return parse_query({**task, 'query_type': query_type, 'query': query,
+                                'kwargs': {**kwargs, **route_kwargs}}, save=save)
 
-        if go_on:
-            task_reduced['query'] = task['query']
-        else:
-            raise Exception('Atata!')
+        # specify task type:
+        task_reduced['query_type'] = 'general_search'
+        task_reduced['query'] = task['query']
 
     elif task['query_type'] == 'find':
         # specify task type:
@@ -1006,14 +1046,348 @@ def parse_query(task, save: bool = False):
         return '', task_reduced, {}
 
 
+def query_collections(task_reduced):
+    """
+        Get names of the collections a reduced query reads from
+    :param task_reduced:
+    :return: set of collection names or None if the query may depend on any collection
+    """
+    query = task_reduced['query']
+
+    if task_reduced['query_type'] == 'cone_search':
+        return set(query.keys())
+
+    elif task_reduced['query_type'] in ('find', 'find_one', 'count_documents'):
+        return {query['catalog']}
+
+    elif task_reduced['query_type'] == 'aggregate':
+        collections = {query['catalog']}
+        for stage in query['pipeline']:
+            for operator in ('$lookup', '$graphLookup'):
+                if operator in stage:
+                    collections.add(stage[operator]['from'])
+            if '$unionWith' in stage:
+                union = stage['$unionWith']
+                collections.add(union if isinstance(union, str) else union['coll'])
+        return collections
+
+    elif (task_reduced['query_type'] == 'info') and ('catalog' in query):
+        return {query['catalog']}
+
+    return None
+
+
+def query_result_count(query_type, query_data):
+    """
+        Count documents in the result data of a query
+    :param query_type:
+    :param query_data: {'query_result': ...} or, for cone_search, {catalog: {object: [docs]}}
+    :return:
+    """
+    if query_type == 'cone_search':
+        return sum(len(docs) for objects in query_data.values() for docs in objects.values())
+    query_result = query_data.get('query_result', None)
+    if isinstance(query_result, list):
+        return len(query_result)
+    return 0 if query_result is None else 1
+
+
+def query_explain_command(query):
+    """
+        Build the command to explain() for a reduced query.
+        For cone searches, the query for the first object is taken as representative
+    :param query:
+    :return: command dict or None if the query type cannot be explained
+    """
+    kwargs = query['kwargs']
+
+    if query['query_type'] == 'cone_search':
+        for catalog in query['query']:
+            for _filter, _projection in query['query'][catalog].values():
+                command = {'find': catalog, 'filter': _filter}
+                if len(_projection) > 0:
+                    command['projection'] = _projection
+                return command
+        return None
+
+    elif query['query_type'] in ('find', 'find_one'):
+        command = {'find': query['query']['catalog'], 'filter': query['query']['filter']}
+        if len(query['query'].get('projection', dict())) > 0:
+            command['projection'] = query['query']['projection']
+        if 'sort' in kwargs:
+            command['sort'] = dict(kwargs['sort']) if isinstance(kwargs['sort'], list) else kwargs['sort']
+        if 'hint' in kwargs:
+            command['hint'] = dict(kwargs['hint']) if isinstance(kwargs['hint'], list) else kwargs['hint']
+        for kk in ('skip', 'limit'):
+            if kk in kwargs:
+                command[kk] = int(kwargs[kk])
+        if query['query_type'] == 'find_one':
+            command['limit'] = 1
+        return command
+
+    elif query['query_type'] == 'count_documents':
+        return {'count': query['query']['catalog'], 'query': query['query']['filter']}
+
+    elif query['query_type'] == 'aggregate':
+        return {'aggregate': query['query']['catalog'], 'pipeline': query['query']['pipeline'], 'cursor': {}}
+
+    return None
+
+
+# keep references to the running background tasks so that they are not garbage collected
+slow_query_tasks = set()
+
+
+async def record_slow_query(db, query, elapsed_ms: float, n_results: int, status: str):
+    """
+        Explain slow query and save a record about it into the stats collection
+    :param db:
+    :param query: reduced query
+    :param elapsed_ms:
+    :param n_results:
+    :param status: 'done' | 'failed'
+    :return:
+    """
+    try:
+        # queries are stored as json strings, as they may contain keys starting with $
+        query_json = dumps(query['query'])
+        collections = query_collections(query)
+
+        doc = {'type': 'slow_query',
+               'user': query['user'],
+               'query_type': query['query_type'],
+               'collections': sorted(collections) if collections is not None else None,
+               'query': query_json,
+               'query_hash': compute_hash(query_json),
+               'elapsed_ms': elapsed_ms,
+               'n_results': n_results,
+               'status': status,
+               'created': utc_now()}
+
+        command = query_explain_command(query)
+        if command is not None:
+            try:
+                explain = await db.command('explain', command, verbosity='queryPlanner')
+                plan_stages, plan_indexes = plan_summary(explain)
+                doc['plan_stages'] = plan_stages
+                doc['plan_indexes'] = plan_indexes
+                doc['collscan'] = 'COLLSCAN' in plan_stages
+                doc['explain'] = dumps(explain.get('queryPlanner', explain))
+            except Exception as _e:
+                doc['explain_error'] = str(_e)
+
+        await db[config['database']['collection_stats']].insert_one(doc)
+
+    except Exception as e:
+        print(f'Failed to record slow query: {str(e)}')
+
+
+def log_slow_query(db, query, elapsed_ms: float, n_results: int = 0, status: str = 'done'):
+    """
+        Record query in the stats collection if it took longer than config['misc']['slow_query_threshold_ms'].
+        The explain() plan is captured in the background, so this does not delay the response
+    :param db:
+    :param query: reduced query
+    :param elapsed_ms:
+    :param n_results:
+    :param status:
+    :return:
+    """
+    threshold_ms = float(config['misc']['slow_query_threshold_ms'])
+    if (threshold_ms <= 0) or (elapsed_ms < threshold_ms):
+        return
+
+    task = asyncio.ensure_future(record_slow_query(db, query, elapsed_ms, n_results, status))
+    slow_query_tasks.add(task)
+    task.add_done_callback(slow_query_tasks.discard)
+
+
+def keyset_page(query):
+    """
+        Set up keyset pagination for a find or aggregate query.
+        Documents are ordered by (kwargs.sort_key, _id) and a page starts right after the document
+        encoded in the opaque kwargs.cursor token returned with the previous page.
+        Documents with null or missing sort_key sort before all others, as in MongoDB
+
+    :param query: reduced task with kwargs.page_size and optionally sort_key, sort_direction and cursor
+    :return: page spec: range predicate, sort, projection, page size
+    """
+    kwargs = query['kwargs']
+
+    page_size = int(kwargs['page_size'])
+    assert page_size >= 1, 'bad page_size, must be int>=1'
+    sort_key = str(kwargs.get('sort_key', '_id'))
+    sort_direction = int(kwargs.get('sort_direction', 1))
+    assert sort_direction in (1, -1), 'bad sort_direction, must be 1 or -1'
+
+    # tokens are only valid for the query they were issued for
+    fingerprint = compute_hash(dumps({'query': query['query'], 'sort_key': sort_key,
+                                      'sort_direction': sort_direction}))
+
+    predicate = dict()
+    if kwargs.get('cursor', None):
+        try:
+            token = loads(base64.urlsafe_b64decode(str(kwargs['cursor']).encode('utf-8')).decode('utf-8'))
+        except Exception:
+            raise ValueError('malformed cursor')
+        if token.get('f', None) != fingerprint:
+            raise ValueError('cursor does not match query')
+
+        op = '$gt' if sort_direction == 1 else '$lt'
+        if sort_key == '_id':
+            predicate = {'_id': {op: token['i']}}
+        elif token.get('n', False):
+            # the last document had null/missing sort_key: finish that group, then go on to the non-null values
+            # ({sort_key: None} matches both null and missing). range queries on None would match nothing
+            predicate = {'$or': [{sort_key: None, '_id': {op: token['i']}}]}
+            if sort_direction == 1:
+                predicate['$or'].append({sort_key: {'$ne': None}})
+        else:
+            predicate = {'$or': [{sort_key: {op: token['v']}},
+                                 {sort_key: token['v'], '_id': {op: token['i']}}]}
+            if sort_direction == -1:
+                predicate['$or'].append({sort_key: None})
+
+    sort = [(sort_key, sort_direction)]
+    if sort_key != '_id':
+        sort.append(('_id', sort_direction))
+
+    # make sure the sort key and _id are returned
+    projection = dict(query['query'].get('projection', dict()))
+    strip = []
+    if len(projection) > 0:
+        inclusion = any(bool(v) for k, v in projection.items() if (k != '_id') and not isinstance(v, dict))
+        for key in {sort_key, '_id'}:
+            if (key in projection) and not projection[key]:
+                projection.pop(key)
+                strip.append(key)
+            if inclusion and (key != '_id') and (key not in projection):
+                projection[key] = 1
+                if key not in strip:
+                    strip.append(key)
+
+    return {'page_size': page_size, 'sort_key': sort_key, 'fingerprint': fingerprint,
+            'filter': predicate, 'sort': sort, 'projection': projection, 'strip': strip}
+
+
+def keyset_next(page, docs):
+    """
+        Trim documents to page and make cursor token for the next page
+    :param page: as returned by keyset_page
+    :param docs: up to page_size + 1 documents
+    :return: documents, token or None if this is the last page
+    """
+    next_cursor = None
+
+    if len(docs) > page['page_size']:
+        docs = docs[:page['page_size']]
+        last = docs[-1]
+        value = last
+        for key in page['sort_key'].split('.'):
+            value = value.get(key, None) if isinstance(value, Mapping) else None
+        token = {'f': page['fingerprint'], 'i': last['_id'], 'v': value, 'n': value is None}
+        next_cursor = base64.urlsafe_b64encode(dumps(token).encode('utf-8')).decode('utf-8')
+
+    for doc in docs:
+        for key in page['strip']:
+            keys = key.split('.')
+            parent = doc
+            for k in keys[:-1]:
+                parent = parent.get(k, dict()) if isinstance(parent, Mapping) else dict()
+            if isinstance(parent, Mapping):
+                parent.pop(keys[-1], None)
+
+    return docs, next_cursor
+
+
+async def cone_search_batched(db, catalog, object_queries, max_time_ms: int, comment: str,
+                              parallelism: int = 16, tile_size: float = 1.0, max_positions: int = 256):
+    """
+        Batched single-pass cone search over a catalog:
+        group the object positions into sky tiles, issue one $or query per tile
+        and assign the returned documents to the positions client-side
+
+    :param db:
+    :param catalog:
+    :param object_queries: {object_name: (query, projection)} as built by parse_query for this catalog
+    :param max_time_ms:
+    :param comment:
+    :param parallelism: max number of tile queries in flight
+    :param tile_size: [deg]
+    :param max_positions: max number of cones per $or query
+    :return: {object_name: [documents]} or None if the queries cannot be batched
+    """
+    object_names = list(object_queries.keys())
+
+    positions = []
+    catalog_filter, projection = None, None
+    for obj in object_names:
+        _query, _projection = object_queries[obj]
+        _query = dict(_query)
+        center, radius = _query.pop('coordinates.radec_geojson')['$geoWithin']['$centerSphere']
+        positions.append((center[0], center[1], radius))
+        # catalog filter and projection are shared by all objects
+        if catalog_filter is None:
+            catalog_filter, projection = _query, _projection
+        elif (_query != catalog_filter) or (_projection != projection):
+            return None
+
+    position_lon, position_lat, radii = map(np.array, zip(*positions))
+    if not np.all(radii == radii[0]):
+        return None
+    radius = float(radii[0])
+
+    # make sure the coordinates needed for the assignment are returned
+    projection = dict(projection)
+    strip_coordinates = False
+    if len(projection) > 0:
+        coordinate_keys = [k for k in projection if (k == 'coordinates') or k.startswith('coordinates.radec_geojson')]
+        inclusion = any(bool(v) for k, v in projection.items() if (k != '_id') and not isinstance(v, dict))
+        if inclusion and (len(coordinate_keys) == 0):
+            projection['coordinates.radec_geojson'] = 1
+            strip_coordinates = True
+        elif (not inclusion) and (len(coordinate_keys) > 0):
+            # coordinates are explicitly excluded
+            return None
+
+    async def find_tile(tile):
+        cones = [{'coordinates.radec_geojson': {'$geoWithin': {'$centerSphere': [[position_lon[i], position_lat[i]],
+                                                                                 radius]}}}
+                 for i in tile]
+        tile_query = {'$or': cones} if len(catalog_filter) == 0 else {'$and': [{'$or': cones}, catalog_filter]}
+        if len(projection) > 0:
+            _select = db[catalog].find(tile_query, projection, max_time_ms=max_time_ms, comment=comment)
+        else:
+            _select = db[catalog].find(tile_query, max_time_ms=max_time_ms, comment=comment)
+        return await _select.to_list(length=None)
+
+    tiles = sky_tiles(position_lon, position_lat, tile_size=tile_size, max_positions=max_positions)
+    selects = await gather_with_concurrency(parallelism, *(find_tile(tile) for tile in tiles))
+
+    result = {obj: [] for obj in object_names}
+    for tile, docs in zip(tiles, selects):
+        docs = [doc for doc in docs if 'radec_geojson' in doc.get('coordinates', {})]
+        if len(docs) == 0:
+            continue
+        lon, lat = np.array([doc['coordinates']['radec_geojson']['coordinates'] for doc in docs]).T
+        matches = cone_search_matches(lon, lat, position_lon[tile], position_lat[tile], radius)
+
+        if strip_coordinates:
+            for doc in docs:
+                doc['coordinates'].pop('radec_geojson')
+                if len(doc['coordinates']) == 0:
+                    doc.pop('coordinates')
+
+        for ti, i in enumerate(tile):
+            result[object_names[i]] = [docs[di] for di in np.flatnonzero(matches[:, ti])]
+
+    return result
+
+
 async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = False):
 
     db = mongo
 
-    if save:
-        # mark query as enqueued:
-        await db.queries.insert_one(task_doc)
-
     result = dict()
     query_result = dict()
 
@@ -1027,6 +1401,8 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
         else int(config['misc']['max_time_ms'])
     assert max_time_ms >= 1, 'bad max_time_ms, must be int>=1'
 
+    tic = time.time()
+
     try:
 
         # cone search:
@@ -1036,22 +1412,51 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
             kwargs = {kk: vv for kk, vv in query['kwargs'].items() if kk in known_kwargs}
             kwargs['comment'] = str(query['user'])
 
-            # iterate over catalogs as they represent
+            # max number of per-object queries in flight
+            parallelism = int(query['kwargs'].get('parallelism', config['misc']['cone_search_parallelism']))
+            assert parallelism >= 1, 'bad parallelism, must be int>=1'
+
+            async def find_object(catalog, obj):
+                # project?
+                if len(query['query'][catalog][obj][1]) > 0:
+                    _select = db[catalog].find(query['query'][catalog][obj][0],
+                                               query['query'][catalog][obj][1],
+                                               max_time_ms=max_time_ms, **kwargs)
+                # return the whole documents by default
+                else:
+                    _select = db[catalog].find(query['query'][catalog][obj][0],
+                                               max_time_ms=max_time_ms, **kwargs)
+                return await _select.to_list(length=None)
+
+            # 'batched' engine: one query per sky tile with client-side assignment of documents to objects.
+            # skip/limit/sort/hint apply per object, so fall back to per-object queries if any are set
+            engine = query['kwargs'].get('cone_search_engine', config['misc']['cone_search_engine'])
+            assert engine in ('batched', 'per_object'), f'unknown cone_search_engine {engine}'
+            batched = (engine == 'batched') and not any(kk in kwargs for kk in ('skip', 'hint', 'limit', 'sort'))
+
             for catalog in query['query']:
                 query_result[catalog] = dict()
-                # iterate over objects:
-                for obj in query['query'][catalog]:
-                    # project?
-                    if len(query['query'][catalog][obj][1]) > 0:
-                        _select = db[catalog].find(query['query'][catalog][obj][0],
-                                                   query['query'][catalog][obj][1],
-                                                   max_time_ms=max_time_ms, **kwargs)
-                    # return the whole documents by default
-                    else:
-                        _select = db[catalog].find(query['query'][catalog][obj][0],
-                                                   max_time_ms=max_time_ms, **kwargs)
-                    # mongodb does not allow having dots in field names -> replace with underscores
-                    query_result[catalog][obj.replace('.', '_')] = await _select.to_list(length=None)
+
+            catalog_objects = []
+            for catalog in query['query']:
+                if batched and (len(query['query'][catalog]) > 1):
+                    catalog_result = await cone_search_batched(db, catalog, query['query'][catalog],
+                                                               max_time_ms=max_time_ms, comment=kwargs['comment'],
+                                                               parallelism=parallelism)
+                    if catalog_result is not None:
+                        for obj, _select in catalog_result.items():
+                            # mongodb does not allow having dots in field names -> replace with underscores
+                            query_result[catalog][obj.replace('.', '_')] = _select
+                        continue
+                catalog_objects += [(catalog, obj) for obj in query['query'][catalog]]
+
+            # iterate over the remaining catalogs and objects, running the queries concurrently
+            selects = await gather_with_concurrency(parallelism,
+                                                    *(find_object(catalog, obj) for catalog, obj in catalog_objects))
+
+            for (catalog, obj), _select in zip(catalog_objects, selects):
+                # mongodb does not allow having dots in field names -> replace with underscores
+                query_result[catalog][obj.replace('.', '_')] = _select
 
         # convenience general search subtypes:
         elif query['query_type'] == 'find':
@@ -1061,15 +1466,28 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
             kwargs = {kk: vv for kk, vv in query['kwargs'].items() if kk in known_kwargs}
             kwargs['comment'] = str(query['user'])
 
+            _filter = query['query']['filter']
+            _projection = query['query']['projection']
+
+            # keyset pagination?
+            page = keyset_page(query) if 'page_size' in query['kwargs'] else None
+            if page is not None:
+                _filter = {'$and': [_filter, page['filter']]} if len(page['filter']) > 0 else _filter
+                _projection = page['projection']
+                kwargs.pop('skip', None)
+                kwargs['sort'] = page['sort']
+                # one extra document tells if there is a next page
+                kwargs['limit'] = page['page_size'] + 1
+
             # project?
-            if len(query['query']['projection']) > 0:
+            if len(_projection) > 0:
 
-                _select = db[query['query']['catalog']].find(query['query']['filter'],
-                                                             query['query']['projection'],
+                _select = db[query['query']['catalog']].find(_filter,
+                                                             _projection,
                                                              max_time_ms=max_time_ms, **kwargs)
             # return the whole documents by default
             else:
-                _select = db[query['query']['catalog']].find(query['query']['filter'],
+                _select = db[query['query']['catalog']].find(_filter,
                                                              max_time_ms=max_time_ms, **kwargs)
 
             if isinstance(_select, int) or isinstance(_select, float) or isinstance(_select, tuple) or \
@@ -1078,6 +1496,10 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
             else:
                 query_result['query_result'] = await _select.to_list(length=None)
 
+            if page is not None:
+                query_result['query_result'], query_result['next_cursor'] = \
+                    keyset_next(page, query_result['query_result'])
+
         elif query['query_type'] == 'find_one':
             # print(query)
 
@@ -1109,31 +1531,44 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
             kwargs = {kk: vv for kk, vv in query['kwargs'].items() if kk in known_kwargs}
             kwargs['comment'] = str(query['user'])
 
-            _select = db[query['query']['catalog']].aggregate(query['query']['pipeline'],
+            _pipeline = query['query']['pipeline']
+
+            # keyset pagination over the pipeline output?
+            page = keyset_page(query) if 'page_size' in query['kwargs'] else None
+            if page is not None:
+                _pipeline = list(_pipeline) + [{'$sort': dict(page['sort'])}] + \
+                    ([{'$match': page['filter']}] if len(page['filter']) > 0 else []) + \
+                    [{'$limit': page['page_size'] + 1}]
+
+            _select = db[query['query']['catalog']].aggregate(_pipeline,
                                                               allowDiskUse=True,
                                                               maxTimeMS=max_time_ms)
 
             query_result['query_result'] = await _select.to_list(length=None)
 
+            if page is not None:
+                query_result['query_result'], query_result['next_cursor'] = \
+                    keyset_next(page, query_result['query_result'])
+
         elif query['query_type'] == 'general_search':
-            # just evaluate. I know that's dangerous, but...
-            qq = bytes(query['query'], 'utf-8').decode('unicode_escape')
+            # run compiled plan. find/aggregate/find_one/count_documents plans without extra options
+            # are routed to the convenience query types in parse_query
+            plan = compile_general_search(query['query'])
 
-            _select = eval(qq)
-            # _select = eval(query['query'])
-            # _select = literal_eval(qq)
+            params = plan['params']
+            if plan['method'] in ('find', 'find_one'):
+                params['max_time_ms'] = max_time_ms
+            elif plan['method'] != 'index_information':
+                params['maxTimeMS'] = max_time_ms
+            if plan['method'] == 'aggregate':
+                params['allowDiskUse'] = params.get('allowDiskUse', True)
 
-            if ('.find_one(' in qq) or ('.count_documents(' in qq)  or ('.estimated_document_count(' in qq) \
-                    or ('.index_information(' in qq) or ('.distinct(' in qq):
-                _select = await _select
+            _select = getattr(db[plan['catalog']], plan['method'])(**params)
 
-            # make it look like json
-            # print(list(_select))
-            if isinstance(_select, int) or isinstance(_select, float) or isinstance(_select, tuple) or \
-                    isinstance(_select, list) or isinstance(_select, dict) or (_select is None):
-                query_result['query_result'] = _select
-            else:
+            if plan['method'] in ('find', 'aggregate'):
                 query_result['query_result'] = await _select.to_list(length=None)
+            else:
+                query_result['query_result'] = await _select
 
         elif query['query_type'] == 'info':
             # collection/catalog info
@@ -1170,6 +1605,35 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
                 stats = await db.command('dbstats')
                 query_result['query_result'] = stats
 
+            elif query['query']['command'] == 'slow_queries':
+                # worst offenders from the slow query log, by total time spent
+                assert query['user'] == config['server']['admin_username'], 'slow_queries is admin-only'
+
+                limit = int(query['query'].get('limit', 20))
+                pipeline = [{'$match': {'type': 'slow_query'}},
+                            {'$sort': {'created': -1}},
+                            {'$group': {'_id': '$query_hash',
+                                        'count': {'$sum': 1},
+                                        'total_ms': {'$sum': '$elapsed_ms'},
+                                        'avg_ms': {'$avg': '$elapsed_ms'},
+                                        'max_ms': {'$max': '$elapsed_ms'},
+                                        'n_results': {'$first': '$n_results'},
+                                        'collscan': {'$max': '$collscan'},
+                                        'plan_stages': {'$first': '$plan_stages'},
+                                        'plan_indexes': {'$first': '$plan_indexes'},
+                                        'users': {'$addToSet': '$user'},
+                                        'query_type': {'$first': '$query_type'},
+                                        'collections': {'$first': '$collections'},
+                                        'query': {'$first': '$query'},
+                                        'last_seen': {'$first': '$created'}}},
+                            {'$sort': {'total_ms': -1}},
+                            {'$limit': limit}]
+
+                stats = db[config['database']['collection_stats']].aggregate(pipeline, allowDiskUse=True)
+                query_result['query_result'] = await stats.to_list(length=None)
+
+        log_slow_query(db, query, (time.time() - tic) * 1e3, query_result_count(query['query_type'], query_result))
+
         # success!
         result['status'] = 'done'
 
@@ -1212,6 +1676,9 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
         _err = traceback.format_exc()
         print(_err)
 
+        # queries killed after max_time_ms are the ones we want to know about the most
+        log_slow_query(db, query, (time.time() - tic) * 1e3, status='failed')
+
         # book-keeping:
         if save:
             # save task result with error message:
@@ -1249,6 +1716,440 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
         raise Exception('Query failed')
 
 
+async def execute_query_stream(mongo, task_reduced, response, chunk_size: int = 65536):
+    """
+        Execute query writing the results to a prepared web.StreamResponse as newline-delimited json
+        while the cursor is being read, so that memory use and time-to-first-byte do not depend on result size.
+
+        Every line is a json object:
+            {"data": doc} for find/aggregate,
+            {"catalog": catalog, "object": obj, "data": doc} for cone_search,
+            {"data": query_result} for the query types that do not return a cursor.
+        The last line is {"status": "done", "count": n} or {"status": "failed", "msg": traceback}
+
+    :param mongo:
+    :param task_reduced:
+    :param response: prepared web.StreamResponse
+    :param chunk_size: flush to the client every chunk_size characters
+    :return:
+    """
+    db = mongo
+
+    query = task_reduced
+
+    # by default, long-running queries will be killed after config['misc']['max_time_ms'] ms
+    max_time_ms = int(query['kwargs']['max_time_ms']) if 'max_time_ms' in query['kwargs'] \
+        else int(config['misc']['max_time_ms'])
+    assert max_time_ms >= 1, 'bad max_time_ms, must be int>=1'
+
+    # number of documents to fetch from mongo per round trip; this is what bounds memory use
+    batch_size = int(query['kwargs'].get('batch_size', 1000))
+    assert batch_size >= 1, 'bad batch_size, must be int>=1'
+
+    chunk = []
+    chunk_length = 0
+    count = 0
+
+    tic = time.time()
+    # the other query types are logged by execute_query
+    log_slow = query['query_type'] in ('cone_search', 'find', 'aggregate')
+
+    async def flush():
+        nonlocal chunk, chunk_length
+        if len(chunk) > 0:
+            await response.write(''.join(chunk).encode('utf-8'))
+            chunk, chunk_length = [], 0
+
+    async def emit(record):
+        nonlocal chunk_length, count
+        line = dumps(record) + '\n'
+        chunk.append(line)
+        chunk_length += len(line)
+        count += 1
+        # send the first record right away, then in chunks
+        if (count == 1) or (chunk_length >= chunk_size):
+            await flush()
+
+    try:
+        if query['query_type'] == 'cone_search':
+
+            known_kwargs = ('skip', 'hint', 'limit', 'sort')
+            kwargs = {kk: vv for kk, vv in query['kwargs'].items() if kk in known_kwargs}
+            kwargs['comment'] = str(query['user'])
+
+            for catalog in query['query']:
+                for obj in query['query'][catalog]:
+                    if len(query['query'][catalog][obj][1]) > 0:
+                        _select = db[catalog].find(query['query'][catalog][obj][0],
+                                                   query['query'][catalog][obj][1],
+                                                   max_time_ms=max_time_ms, batch_size=batch_size, **kwargs)
+                    else:
+                        _select = db[catalog].find(query['query'][catalog][obj][0],
+                                                   max_time_ms=max_time_ms, batch_size=batch_size, **kwargs)
+                    async for doc in _select:
+                        await emit({'catalog': catalog, 'object': obj.replace('.', '_'), 'data': doc})
+
+        elif query['query_type'] == 'find':
+
+            known_kwargs = ('skip', 'hint', 'limit', 'sort')
+            kwargs = {kk: vv for kk, vv in query['kwargs'].items() if kk in known_kwargs}
+            kwargs['comment'] = str(query['user'])
+
+            if len(query['query']['projection']) > 0:
+                _select = db[query['query']['catalog']].find(query['query']['filter'],
+                                                             query['query']['projection'],
+                                                             max_time_ms=max_time_ms, batch_size=batch_size,
+                                                             **kwargs)
+            else:
+                _select = db[query['query']['catalog']].find(query['query']['filter'],
+                                                             max_time_ms=max_time_ms, batch_size=batch_size,
+                                                             **kwargs)
+            async for doc in _select:
+                await emit({'data': doc})
+
+        elif query['query_type'] == 'aggregate':
+
+            _select = db[query['query']['catalog']].aggregate(query['query']['pipeline'],
+                                                              allowDiskUse=True,
+                                                              maxTimeMS=max_time_ms,
+                                                              batchSize=batch_size,
+                                                              comment=str(query['user']))
+            async for doc in _select:
+                await emit({'data': doc})
+
+        else:
+            # nothing to stream, execute as usual and send the result as a single record
+            _, result = await execute_query(mongo, '', task_reduced, {}, save=False)
+            if result['status'] != 'done':
+                raise Exception(result.get('msg', 'Query failed'))
+            await emit({'data': result['result_data'].get('query_result', None)})
+
+        if log_slow:
+            log_slow_query(db, query, (time.time() - tic) * 1e3, count)
+
+        await emit({'status': 'done', 'count': count})
+
+    except Exception as e:
+        print(f'Got error: {str(e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        if log_slow:
+            log_slow_query(db, query, (time.time() - tic) * 1e3, count, status='failed')
+        await emit({'status': 'failed', 'msg': _err})
+
+    await flush()
+
+
+# binary encodings of /query results
+query_result_formats = ('json', 'msgpack', 'arrow')
+# Arrow IPC streams are tables, so only query types returning lists of documents can be encoded as such
+arrow_query_types = ('find', 'find_one', 'aggregate', 'cone_search')
+
+
+def msgpack_default(obj):
+    """
+        Encode types msgpack does not know about: numpy arrays go as ext type 1 holding [dtype, shape, raw bytes]
+    :param obj:
+    :return:
+    """
+    if isinstance(obj, np.ndarray):
+        return msgpack.ExtType(1, msgpack.packb([obj.dtype.str, list(obj.shape), obj.tobytes()],
+                                                use_bin_type=True))
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, datetime.datetime):
+        # naive datetimes coming from the db are in UTC
+        return msgpack.Timestamp.from_datetime(obj if obj.tzinfo is not None
+                                               else obj.replace(tzinfo=datetime.timezone.utc))
+    return str(obj)
+
+
+def query_result_rows(query_type, result_data):
+    """
+        Flatten the result data of a find/find_one/aggregate/cone_search query into a list of documents.
+        cone_search matches get the catalog and object names in the _catalog and _object fields
+    :param query_type:
+    :param result_data: {'query_result': ...} or, for cone_search, {catalog: {object: [docs]}}
+    :return:
+    """
+    if query_type == 'cone_search':
+        return [dict(doc, _catalog=catalog, _object=obj)
+                for catalog, objects in result_data.items()
+                for obj, docs in objects.items()
+                for doc in docs]
+    query_result = result_data['query_result']
+    if query_type == 'find_one':
+        return [query_result] if query_result is not None else []
+    return list(query_result)
+
+
+def query_response(query_type, result, fmt: str = 'json'):
+    """
+        Encode query result as extended json, msgpack, or an Arrow IPC stream.
+        In binary formats, lc.data and spec.data records are converted into typed numeric columns.
+        Arrow tables have one row per document; the rest of the result goes to the schema metadata
+    :param query_type:
+    :param result:
+    :param fmt: 'json' | 'msgpack' | 'arrow'
+    :return:
+    """
+    if (fmt == 'json') or (result['status'] != 'done'):
+        return web.json_response({'message': 'success', 'result': result}, status=200, dumps=dumps)
+
+    result_data = result['result_data']
+
+    if fmt == 'msgpack':
+        if query_type == 'cone_search':
+            result_data = {catalog: {obj: [columnar_series(doc) for doc in docs] for obj, docs in objects.items()}
+                           for catalog, objects in result_data.items()}
+        elif query_type == 'find_one':
+            result_data = dict(result_data, query_result=columnar_series(result_data['query_result']))
+        elif query_type in arrow_query_types:
+            result_data = dict(result_data,
+                               query_result=[columnar_series(doc) for doc in result_data['query_result']])
+
+        body = msgpack.packb({'message': 'success', 'result': dict(result, result_data=result_data)},
+                             default=msgpack_default, use_bin_type=True)
+
+        return web.Response(body=body, status=200, content_type='application/x-msgpack')
+
+    rows = [plain_types(columnar_series(doc)) for doc in query_result_rows(query_type, result_data)]
+    table = pa.Table.from_pylist(rows)
+    meta = {k: v for k, v in result.items() if k != 'result_data'}
+    meta['result_data'] = {k: v for k, v in result_data.items() if k != 'query_result'} \
+        if query_type != 'cone_search' else dict()
+    table = table.replace_schema_metadata({'zvm': dumps(meta)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return web.Response(body=sink.getvalue().to_pybytes(), status=200,
+                        content_type='application/vnd.apache.arrow.stream')
+
+
+def query_result_file(task_doc):
+    """
+        Get path to the result of a saved query
+    :param task_doc: queries collection entry
+    :return:
+    """
+    return os.path.join(config['path']['path_queries'], task_doc['user'], f'{task_doc["task_id"]}.result.json')
+
+
+def remove_query_files(task_doc):
+    """
+        Remove task and result files of a saved query
+    :param task_doc: queries collection entry
+    :return:
+    """
+    if task_doc['task'] is None:
+        return
+    for f in (task_doc['task'], query_result_file(task_doc)):
+        try:
+            if (f is not None) and os.path.exists(f):
+                os.remove(f)
+        except Exception as e:
+            print(f'Failed to remove {f}: {str(e)}')
+
+
+class QueryQueueFull(Exception):
+    pass
+
+
+class QueryQueue(object):
+    """
+        Background executor for enqueued queries.
+
+        Enqueued queries live in the queries collection and are claimed atomically
+        by a bounded pool of workers, so a query enqueued by one app process may be run by any other.
+        Status transitions: enqueued -> running -> done | failed
+
+        A claimed query is leased to its worker for lease seconds and the lease is renewed while the query runs;
+        if the process running it dies, the query is claimed again once the lease expires.
+        Batch jobs (e.g. period_search_job.py) renew their own leases and are marked as failed if they stop doing so
+    """
+    def __init__(self, mongo, num_workers: int = 2, max_queued_per_user: int = 10,
+                 poll_interval: float = 1.0, cleanup_interval: float = 3600.0, lease: float = 60.0):
+        self.mongo = mongo
+        self.num_workers = num_workers
+        self.max_queued_per_user = max_queued_per_user
+        self.poll_interval = poll_interval
+        self.cleanup_interval = cleanup_interval
+        self.lease = lease
+
+        self.worker_id = f'{os.getpid()}.{uid(length=8)}'
+        self.workers = []
+        # task_id -> asyncio.Task for the queries being executed by this process
+        self.running = dict()
+        # wake up idle workers when a query is enqueued by this process
+        self.wakeup = asyncio.Event()
+
+    async def start(self):
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.num_workers)]
+        self.workers.append(asyncio.ensure_future(self.cleanup()))
+
+    async def stop(self):
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+        # hand interrupted queries over to other processes
+        await self.mongo.queries.update_many({'worker': self.worker_id, 'status': 'running'},
+                                             {'$set': {'status': 'enqueued', 'last_modified': utc_now()},
+                                              '$unset': {'worker': '', 'lease_until': ''}})
+
+    async def enqueue(self, task_doc):
+        """
+            Register query in the db
+        :param task_doc: as generated by parse_query
+        :return: query status
+        """
+        existing = await self.mongo.queries.find_one({'user': task_doc['user'], 'task_id': task_doc['task_id']},
+                                                     {'status': 1})
+        if existing is not None:
+            if existing['status'] != 'failed':
+                return existing['status']
+            # re-run failed query
+            await self.mongo.queries.delete_one({'_id': existing['_id']})
+
+        num_queued = await self.mongo.queries.count_documents({'user': task_doc['user'],
+                                                               'status': {'$in': ['enqueued', 'running']}})
+        if num_queued >= self.max_queued_per_user:
+            raise QueryQueueFull(f'user {task_doc["user"]} already has {num_queued} queries in the queue')
+
+        try:
+            await self.mongo.queries.insert_one(task_doc)
+        except pymongo.errors.DuplicateKeyError:
+            # enqueued concurrently by another request
+            existing = await self.mongo.queries.find_one({'user': task_doc['user'], 'task_id': task_doc['task_id']},
+                                                         {'status': 1})
+            return existing['status'] if existing is not None else task_doc['status']
+        self.wakeup.set()
+
+        return task_doc['status']
+
+    def cancel(self, task_id):
+        """
+            Stop executing query if it is being run by this process
+        :param task_id:
+        :return:
+        """
+        task = self.running.get(task_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def claim(self):
+        """
+            Atomically grab the oldest enqueued query or a running one whose worker's lease has expired
+        :return:
+        """
+        now = utc_now()
+        return await self.mongo.queries.find_one_and_update({'$or': [{'status': 'enqueued'},
+                                                                     {'status': 'running',
+                                                                      'task': {'$ne': None},
+                                                                      'lease_until': {'$lt': now}}]},
+                                                            {'$set': {'status': 'running',
+                                                                      'worker': self.worker_id,
+                                                                      'lease_until': now + datetime.timedelta(
+                                                                          seconds=self.lease),
+                                                                      'last_modified': now}},
+                                                            sort=[('created', 1)],
+                                                            return_document=pymongo.ReturnDocument.AFTER)
+
+    async def renew(self, task_doc):
+        """
+            Extend the lease on a query being run by this worker
+        :param task_doc:
+        :return: False if the query is gone or has been claimed by another worker
+        """
+        update = await self.mongo.queries.update_one({'_id': task_doc['_id'], 'worker': self.worker_id},
+                                                     {'$set': {'lease_until': utc_now() + datetime.timedelta(
+                                                         seconds=self.lease)}})
+        return update.matched_count > 0
+
+    async def run(self, task_doc):
+        try:
+            async with aiofiles.open(task_doc['task'], 'r') as f_task_file:
+                task = loads(await f_task_file.read())
+            _, task_reduced, _ = parse_query(task, save=False)
+            # marks query as done or failed when finished
+            await execute_query(self.mongo, task_doc['task_id'], task_reduced, task_doc, save=True)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            print(f'Query {task_doc["task_id"]} failed: {str(e)}')
+            await self.mongo.queries.update_one({'_id': task_doc['_id'], 'status': 'running'},
+                                                {'$set': {'status': 'failed', 'last_modified': utc_now()}})
+
+        # deleted while running?
+        if await self.mongo.queries.count_documents({'_id': task_doc['_id']}) == 0:
+            remove_query_files(task_doc)
+
+    async def worker(self):
+        while True:
+            try:
+                task_doc = await self.claim()
+            except Exception as e:
+                print(f'Failed to claim query: {str(e)}')
+                task_doc = None
+
+            if task_doc is None:
+                # nothing to do, wait for new queries
+                self.wakeup.clear()
+                try:
+                    async with timeout(self.poll_interval):
+                        await self.wakeup.wait()
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.ensure_future(self.run(task_doc))
+            self.running[task_doc['task_id']] = task
+            try:
+                # does not raise if the query gets cancelled
+                done, _ = await asyncio.wait([task], timeout=self.lease / 3)
+                while len(done) == 0:
+                    try:
+                        renewed = await self.renew(task_doc)
+                    except Exception as e:
+                        print(f'Failed to renew lease on query {task_doc["task_id"]}: {str(e)}')
+                        renewed = True
+                    if not renewed:
+                        print(f'Lost lease on query {task_doc["task_id"]}, stopping')
+                        task.cancel()
+                    done, _ = await asyncio.wait([task], timeout=self.lease / 3)
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            finally:
+                self.running.pop(task_doc['task_id'], None)
+
+    async def cleanup(self):
+        """
+            Periodically remove expired queries and their files and fail batch jobs that stopped renewing their lease
+        :return:
+        """
+        while True:
+            try:
+                await self.mongo.queries.update_many({'status': 'running', 'task': None,
+                                                      'lease_until': {'$lt': utc_now()}},
+                                                     {'$set': {'status': 'failed',
+                                                               'message': 'job stopped without finishing',
+                                                               'last_modified': utc_now()}})
+
+                async for task_doc in self.mongo.queries.find({'expires': {'$lt': utc_now()},
+                                                               'status': {'$in': ['done', 'failed']}}):
+                    await self.mongo.queries.delete_one({'_id': task_doc['_id']})
+                    remove_query_files(task_doc)
+            except Exception as e:
+                print(f'Failed to clean up expired queries: {str(e)}')
+
+            await asyncio.sleep(self.cleanup_interval)
+
+
 @routes.put('/query')
 @login_required
 async def query_handler(request):
@@ -1284,7 +2185,13 @@ async def query_handler(request):
             f'query_type {_query["query_type"]} not in {str(known_query_types)}'
 
         _query['user'] = user
-        save = False  # query scheduling is disabled as unnecessary for the Variable Marshal (compare to Kowalski)
+
+        # by default, queries are not registered in the db and are executed right away.
+        # enqueue_only: register query, execute it in the background and return its id right away
+        # save: register query, execute it and store the result on disk awaiting completion
+        kwargs = _query.get('kwargs', dict())
+        enqueue_only = kwargs.get('enqueue_only', False)
+        save = enqueue_only or kwargs.get('save', False)
 
         # tic = time.time()
         task_hash, task_reduced, task_doc = parse_query(_query, save=save)
@@ -1292,12 +2199,63 @@ async def query_handler(request):
         # print(f'parsing task took {toc-tic} seconds')
         # print(task_hash, task_reduced, task_doc)
 
-        # execute query:
-        task_hash, result = await execute_query(request.app['mongo'], task_hash, task_reduced, task_doc, save)
+        # result encoding
+        fmt = kwargs.get('format', 'json')
+        assert fmt in query_result_formats, f'format {fmt} not in {str(query_result_formats)}'
+        assert (fmt != 'arrow') or (_query['query_type'] in arrow_query_types), \
+            f'format arrow only supported for query types {str(arrow_query_types)}'
+
+        if enqueue_only:
+            status = await request.app['query_queue'].enqueue(task_doc)
+
+            return web.json_response({'message': 'success', 'status': status, 'query_id': task_hash}, status=200)
+
+        # stream results as newline-delimited json?
+        if (not save) and task_reduced['kwargs'].get('stream', False):
+            async with request.app['admission'].slot(user):
+                response = web.StreamResponse(status=200, headers={'Content-Type': 'application/x-ndjson'})
+                await response.prepare(request)
+                await execute_query_stream(request.app['mongo'], task_reduced, response)
+                await response.write_eof()
+
+            return response
+
+        # serve read-only queries from cache if requested
+        cache = (not save) and task_reduced['kwargs'].get('cache', False) and \
+            (task_reduced['query_type'] in ('find', 'find_one', 'count_documents', 'aggregate', 'cone_search', 'info'))
+        if cache:
+            cache_key = compute_hash(dumps(task_reduced))
+            # read before the query is executed so that writes made in the meantime invalidate its result
+            versions = await collection_versions(request.app['mongo'], query_collections(task_reduced))
+            result = request.app['query_cache'].get(cache_key, versions=versions)
+            if result is not None:
+                return query_response(task_reduced['query_type'], result, fmt)
+
+        # execute query once admitted:
+        async with request.app['admission'].slot(user):
+            if save:
+                # mark query as running, replacing a previous run of the same query:
+                task_doc['status'] = 'running'
+                await request.app['mongo'].queries.replace_one({'user': task_doc['user'],
+                                                                'task_id': task_doc['task_id']},
+                                                               task_doc, upsert=True)
+
+            task_hash, result = await execute_query(request.app['mongo'], task_hash, task_reduced, task_doc, save)
+
+        if cache and (result['status'] == 'done'):
+            request.app['query_cache'].put(cache_key, result, collections=query_collections(task_reduced),
+                                           versions=versions)
 
         # print(result)
 
-        return web.json_response({'message': 'success', 'result': result}, status=200, dumps=dumps)
+        return query_response(task_reduced['query_type'], result, fmt)
+
+    except QueryQueueFull as _e:
+        return web.json_response({'message': f'failure: {str(_e)}'}, status=429)
+
+    except AdmissionRejected as _e:
+        return web.json_response({'message': f'failure: {str(_e)}'}, status=429,
+                                 headers={'Retry-After': str(_e.retry_after)})
 
     except Exception as _e:
         print(f'Got error: {str(_e)}')
@@ -1306,24 +2264,157 @@ async def query_handler(request):
         return web.json_response({'message': f'failure: {_err}'}, status=500)
 
 
-''' Label sources '''
-
-
-@routes.get('/label')
+@routes.get('/metrics')
 @login_required
-async def label_get_handler(request):
+async def metrics_handler(request):
     """
-        Labeling interface
+        Serve /query admission control, query cache, rendering, PS1 cutout, prefetch and Kowalski metrics of this worker process (admin only)
     :param request:
     :return:
     """
-    # get session:
-    session = await get_session(request)
-    user = session['user_id']
+    user = request.get('user', None)
+    # try session if None:
+    if user is None:
+        session = await get_session(request)
+        user = session['user_id']
 
-    try:
-        users = await request.app['mongo'].users.find({}, {'_id': 1}).to_list(length=None)
-        users = sorted([uu['_id'] for uu in users])
+    # only admin can access this
+    if user == config['server']['admin_username']:
+        query_cache = request.app['query_cache']
+        metrics = {'pid': os.getpid(),
+                   'admission': request.app['admission'].metrics(),
+                   'query_cache': {'size': len(query_cache),
+                                   'hits': query_cache.hits,
+                                   'misses': query_cache.misses},
+                   # hits and misses are per process, bytes in use are an estimate for the shared cache dir
+                   'render_cache': request.app['render_cache'].metrics(),
+                   'render_service': request.app['render_service'].metrics(),
+                   'ps1': request.app['ps1'].metrics(),
+                   'prefetch': request.app['prefetch'].metrics(),
+                   'kowalski': request.app['kowalski'].metrics()}
+
+        return web.json_response({'message': 'success', 'metrics': metrics}, status=200)
+
+    else:
+        return web.json_response({'message': '403 Forbidden'}, status=403)
+
+
+async def get_query_doc(request):
+    """
+        Get the queries collection entry for the task_id in the request if it belongs to the user
+    :param request:
+    :return: user, request json, query doc or None
+    """
+    user = request.get('user', None)
+    # try session if None:
+    if user is None:
+        session = await get_session(request)
+        user = session['user_id']
+
+    _r = await request.json()
+
+    task_filter = {'task_id': str(_r['task_id'])}
+    # admin can access everyone's queries
+    if user != config['server']['admin_username']:
+        task_filter['user'] = user
+
+    doc = await request.app['mongo'].queries.find_one(task_filter)
+
+    return user, _r, doc
+
+
+@routes.post('/query')
+@login_required
+async def query_get_handler(request):
+    """
+        Get task or result of an enqueued/saved query by its id
+    :param request:
+    :return:
+    """
+    try:
+        user, _r, doc = await get_query_doc(request)
+
+        if doc is None:
+            return web.json_response({'message': 'failure: query not found'}, status=404)
+
+        part = _r.get('part', 'result')
+        assert part in ('task', 'result'), f'part {part} not in {str(("task", "result"))}'
+
+        # batch jobs (e.g. period_search_job.py) have no task/result files
+        if part == 'task':
+            task_file = doc['task']
+        else:
+            task_file = query_result_file(doc) if doc['task'] is not None else None
+
+        # the files may be huge: pass them on without de-serializing
+        data = 'null'
+        if ((part == 'task') or (doc['status'] in ('done', 'failed'))) and \
+                (task_file is not None) and os.path.exists(task_file):
+            async with aiofiles.open(task_file, 'r') as f_task_file:
+                data = await f_task_file.read()
+
+        header = {'message': 'success', 'task_id': doc['task_id'], 'status': doc['status'],
+                  'created': doc['created'], 'last_modified': doc['last_modified']}
+        if 'progress' in doc:
+            header['progress'] = doc['progress']
+
+        return web.Response(text=f'{dumps(header)[:-1]}, "{part}": {data}}}',
+                            content_type='application/json', status=200)
+
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
+@routes.delete('/query')
+@login_required
+async def query_delete_handler(request):
+    """
+        Cancel (if necessary) and delete enqueued/saved query by its id
+    :param request:
+    :return:
+    """
+    try:
+        user, _r, doc = await get_query_doc(request)
+
+        if doc is None:
+            return web.json_response({'message': 'failure: query not found'}, status=404)
+
+        await request.app['mongo'].queries.delete_one({'_id': doc['_id']})
+        # if the query is being executed by this process, stop it.
+        # otherwise, the process running it will clean up once it is done
+        request.app['query_queue'].cancel(doc['task_id'])
+        remove_query_files(doc)
+
+        return web.json_response({'message': 'success'}, status=200)
+
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
+''' Label sources '''
+
+
+@routes.get('/label')
+@login_required
+async def label_get_handler(request):
+    """
+        Labeling interface
+    :param request:
+    :return:
+    """
+    # get session:
+    session = await get_session(request)
+    user = session['user_id']
+
+    try:
+        users = await request.app['mongo'].users.find({}, {'_id': 1}).to_list(length=None)
+        users = sorted([uu['_id'] for uu in users])
 
         programs = await request.app['mongo'].programs.find({}, {'_id': 1}).to_list(length=None)
         programs = sorted([pp['_id'] for pp in programs])
@@ -1365,7 +2456,7 @@ async def label_get_handler(request):
                 sources = await request.app['mongo'].sources.find(filt,
                                                                   {'xmatch.ZTF_alerts': 0,
                                                                    'history': 0,
-                                                                   'spec.data': 0}).limit(int(number)). \
+                                                                   'spec.data': 0, 'lc.data': 0}).limit(int(number)). \
                     sort([('created', -1)]).to_list(length=None)
                 # print(sources)
             else:
@@ -1381,7 +2472,8 @@ async def label_get_handler(request):
                 source_ids = [sid['_id'] for sid in source_ids]
 
                 pipeline = [{'$match': {'_id': {'$in': source_ids}}},
-                            {'$project': {'xmatch.ZTF_alerts': 0, 'history': 0, 'spec.data': 0}}]
+                            {'$project': {'xmatch.ZTF_alerts': 0, 'history': 0,
+                                          'spec.data': 0, 'lc.data': 0}}]
                 _select = request.app['mongo'].sources.aggregate(pipeline,
                                                                  allowDiskUse=True,
                                                                  maxTimeMS=30000)
@@ -1459,6 +2551,22 @@ async def label_get_handler(request):
 ''' sources API '''
 
 
+def lc_summary(source):
+    """
+        Summarize lc[].stats of a source for the sources table: total number of points and
+        the largest robust amplitude among its light curves
+    :param source:
+    :return:
+    """
+    stats = [lc['stats'] for lc in source.get('lc', []) if 'stats' in lc]
+    amplitudes = [s['amplitude_robust'] for s in stats if s.get('amplitude_robust', None) is not None]
+
+    source['n_points'] = sum(s.get('n', 0) for s in stats) if len(stats) > 0 else None
+    source['amplitude'] = round(max(amplitudes), 3) if len(amplitudes) > 0 else None
+
+    return source
+
+
 @routes.get('/sources')
 @login_required
 async def sources_get_handler(request):
@@ -1487,6 +2595,7 @@ async def sources_get_handler(request):
                                                           {'coordinates': 0,
                                                            'spec.data': 0, 'lc.data': 0}).limit(50).\
             sort([('created', -1)]).to_list(length=None)
+        sources = [lc_summary(source) for source in sources]
 
         users = await request.app['mongo'].users.find({}, {'_id': 1}).to_list(length=None)
         users = sorted([uu['_id'] for uu in users])
@@ -1641,6 +2750,7 @@ async def sources_post_handler(request):
                                                               {'coordinates.radec_str': 0,
                                                                'spec.data': 0, 'lc.data': 0}). \
                 sort([('created', -1)]).to_list(length=None)
+            sources = [lc_summary(source) for source in sources]
 
             context = {'logo': config['server']['logo'],
                        'user': session['user_id'],
@@ -1682,6 +2792,72 @@ async def sources_post_handler(request):
         return response
 
 
+# part of every ETag so that browsers revalidate pages and images after the server,
+# the modules that render and prepare the data, the templates, the HR diagram background, or the config are updated
+deployment_tag = hashlib.md5(b''.join([path.read_bytes() for path in
+                                       [pathlib.Path(__file__).parent / name
+                                        for name in ('server.py', 'render.py', 'hr_diagram.py', 'ps1.py', 'utils.py',
+                                                     'static/img/hr_plot.png')] +
+                                       sorted(pathlib.Path(__file__).parent.glob('templates/*.html'))] +
+                                      [json.dumps(config, sort_keys=True, default=str).encode('utf-8')])).hexdigest()
+
+
+def validators_for(_id, last_modified, path_qs, *parts):
+    """
+        Get ETag and Last-Modified for a representation of a saved source
+    :param _id: source _id
+    :param last_modified: source last_modified
+    :param path_qs: requested path and query
+    :param parts: extra parts the representation depends on
+    :return: response headers, empty if last_modified is not set
+    """
+    if not isinstance(last_modified, datetime.datetime):
+        return dict()
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=pytz.utc)
+
+    tag = hashlib.md5()
+    for part in (deployment_tag, _id, last_modified.isoformat(), path_qs) + parts:
+        tag.update(str(part).encode('utf-8'))
+        tag.update(b'\0')
+
+    # generated images are not byte-for-byte reproducible, hence weak validators
+    return {'ETag': f'W/"{tag.hexdigest()}"',
+            'Last-Modified': format_datetime(last_modified.astimezone(datetime.timezone.utc), usegmt=True),
+            'Cache-Control': 'private, no-cache'}
+
+
+async def source_validators(request, *parts):
+    """
+        Get ETag and Last-Modified for a representation of a saved source with a projection-only lookup
+        of its last_modified. The ETag also depends on the requested path and query and on extra parts
+        (e.g. the user for pages)
+    :param request:
+    :param parts:
+    :return: response headers, empty if the source does not exist or has no last_modified
+    """
+    _id = request.match_info['source_id']
+
+    source = await request.app['mongo'].sources.find_one({'_id': _id}, {'last_modified': 1})
+    last_modified = source.get('last_modified', None) if source is not None else None
+
+    return validators_for(_id, last_modified, request.path_qs, *parts)
+
+
+def not_modified(request, validators):
+    """
+        Check if client's copy is current, i.e. If-None-Match matches the ETag in validators
+    :param request:
+    :param validators: output of source_validators
+    :return:
+    """
+    if ('ETag' not in validators) or ('If-None-Match' not in request.headers):
+        return False
+    etags = [etag.strip() for etag in request.headers['If-None-Match'].split(',')]
+    # weak comparison
+    return ('*' in etags) or (validators['ETag'][2:] in [etag[2:] if etag.startswith('W/') else etag for etag in etags])
+
+
 @routes.get('/sources/{source_id}')
 @login_required
 async def source_get_handler(request):
@@ -1695,112 +2871,41 @@ async def source_get_handler(request):
 
     _id = request.match_info['source_id']
 
-    source = await request.app['mongo'].sources.find_one({'_id': _id})
-    source = loads(dumps(source))
-    # print(source)
-
     frmt = request.query.get('format', 'web')
     # print(frmt)
 
     if frmt == 'json':
-        return web.json_response(source, status=200, dumps=dumps)
+        validators = await source_validators(request)
+        if not_modified(request, validators):
+            return web.Response(status=304, headers=validators)
+
+        source = await request.app['mongo'].sources.find_one({'_id': _id})
+        source = loads(dumps(source))
+        # light curves and spectra are always served as lists of data points
+        for series in ('lc', 'spec'):
+            for entry in source.get(series, []):
+                entry['data'] = series_records(entry)
+                entry.pop('data_format', None)
+        return web.json_response(source, status=200, dumps=dumps, headers=validators)
+
+    # the page also shows the user and the programs
+    programs_modified = await request.app['mongo'].programs.find({}, {'last_modified': 1}).to_list(length=None)
+    validators = await source_validators(request, session['user_id'], dumps(programs_modified))
+    if not_modified(request, validators):
+        return web.Response(status=304, headers=validators)
+
+    # for the web, render the page without the photometry and spectra,
+    # the panels fetch them from /sources/{source_id}/lc/{lc_id} and /sources/{source_id}/spec/{spec_id}
+    source = await request.app['mongo'].sources.find_one({'_id': _id}, {'lc.data': 0, 'spec.data': 0})
+    source = loads(dumps(source))
 
-    # for the web, reformat/compute data fields:
-    # light curves
-    bad_lc = []
+    # light curve display colors
     lc_color_indexes = dict()
-    for ilc, lc in enumerate(source['lc']):
-        try:
-            if lc['lc_type'] == 'temporal':
-                # convert to pandas dataframe and replace nans with zeros:
-                df = pd.DataFrame(lc['data']).fillna(0)
-
-                # fixme?
-                if 'mjd' not in df:
-                    df['mjd'] = df['hjd'] - 2400000.5
-                if 'hjd' not in df:
-                    df['hjd'] = df['mjd'] + 2400000.5
-
-                if 'datetime' not in df:
-                    df['datetime'] = df['mjd'].apply(lambda x: mjd_to_datetime(x))
-                # strings for plotly:
-                if 'dt' not in df:
-                    df['dt'] = df['datetime'].apply(lambda x: x.strftime('%Y-%m-%d %H:%M:%S'))
-
-                df.sort_values(by=['mjd'], inplace=True)
-
-                if 'jd' not in df:
-                    df['jd'] = df['mjd'] + 2400000.5
-
-                # fractional days ago
-                t_utc = datetime.datetime.utcnow()
-                df['days_ago'] = df['datetime'].apply(lambda x: (t_utc - x).total_seconds()/86400.)
-
-                # print(df['programid'])
-
-                # convert back to dict:
-                lc['data'] = df.to_dict('records')
-
-                # for field in ('mag', 'magerr', 'mag_llim', 'mag_ulim', 'mjd', 'hjd', 'jd', 'dt', 'days_ago'):
-                #     lc[field] = df[field].values.tolist() if field in df else []
-
-                # pre-process for plotly:
-                # display color:
-                lc_color_indexes[lc['filter']] = lc_color_indexes[lc['filter']] + 1 \
-                    if lc['filter'] in lc_color_indexes else 0
-                lc['color'] = lc_colors(lc['filter'], lc_color_indexes[lc['filter']])
-
-                lc__ = {'lc_det': {'dt': [], 'days_ago': [], 'jd': [], 'mjd': [], 'hjd': [], 'mag': [], 'magerr': []},
-                        'lc_nodet_u': {'dt': [], 'days_ago': [], 'jd': [], 'mjd': [], 'hjd': [], 'mag_ulim': []},
-                        'lc_nodet_l': {'dt': [], 'days_ago': [], 'jd': [], 'mjd': [], 'hjd': [], 'mag_llim': []}}
-                for dp in lc['data']:
-                    if ('mag_ulim' in dp) and (dp['mag_ulim'] > 0.01):
-                        for kk in ('dt', 'days_ago', 'jd', 'mjd', 'hjd', 'mag_ulim'):
-                            lc__['lc_nodet_u'][kk].append(dp[kk])
-                    if ('mag_llim' in dp) and (dp['mag_llim'] > 0.01):
-                        for kk in ('dt', 'days_ago', 'jd', 'mjd', 'hjd', 'mag_llim'):
-                            lc__['lc_nodet_l'][kk].append(dp[kk])
-                    if ('mag' in dp) and (dp['mag'] > 0.01):
-                        for kk in ('dt', 'days_ago', 'jd', 'mjd', 'hjd', 'mag', 'magerr'):
-                            lc__['lc_det'][kk].append(dp[kk])
-                lc['data'] = lc__
-
-        except Exception as e:
-            print(str(e))
-            _err = traceback.format_exc()
-            print(_err)
-            bad_lc.append(ilc)
-
-    for blc in bad_lc[::-1]:
-        source['lc'].pop(blc)
-
-    # spectra
-    bad_spec = []
-    for ispec, spec in enumerate(source['spec']):
-        try:
-            # convert to pandas dataframe and replace nans with zeros:
-            df = pd.DataFrame(spec['data']).fillna(0)
-            # don't need this anymore:
-            spec.pop('data', None)
-
-            # todo: transform data if necessary, e.g. convert to same units etc
-            # df['dt'] = df['mjd'].apply(lambda x: mjd_to_datetime(x).strftime('%Y-%m-%d %H:%M:%S'))
-
-            df['wavelength'] = df['wavelength'].apply(lambda x: float(x))
-            df.sort_values(by=['wavelength'], inplace=True)
-
-            # print(df)
-
-            for field in ('wavelength', 'flux', 'fluxerr'):
-                spec[field] = df[field].values.tolist() if field in df else []
-                spec[field] = [float(ee) for ee in spec[field]]
-
-        except Exception as e:
-            print(str(e))
-            bad_spec.append(ispec)
-
-    for bspec in bad_spec[::-1]:
-        source['spec'].pop(bspec)
+    for lc in source['lc']:
+        if lc['lc_type'] == 'temporal':
+            lc_color_indexes[lc['filter']] = lc_color_indexes[lc['filter']] + 1 \
+                if lc['filter'] in lc_color_indexes else 0
+            lc['color'] = lc_colors(lc['filter'], lc_color_indexes[lc['filter']])
 
     # source types and tags:
     source_types = config['misc']['source_types']
@@ -1809,21 +2914,141 @@ async def source_get_handler(request):
     # get ZVM programs:
     programs = await request.app['mongo'].programs.find({}, {'last_modified': 0}).to_list(length=None)
 
+    try:
+        max_points = lc_max_points(request.query)
+    except ValueError:
+        max_points = int(config['misc']['lc_max_points'])
+
     context = {'logo': config['server']['logo'],
                'user': session['user_id'],
                'source': source,
                'source_types': source_types,
                'source_flags': source_flags,
                'programs': programs,
+               'lc_max_points': max_points,
                'cone_search_radius': config['kowalski']['cross_match']['cone_search_radius'],
                'cone_search_unit': config['kowalski']['cross_match']['cone_search_unit']
                }
     response = aiohttp_jinja2.render_template('template-source.html',
                                               request,
                                               context)
+    response.headers.update(validators)
     return response
 
 
+def lc_max_points(_r):
+    """
+        Get the number of points to decimate the light curves in each filter to from GET params,
+        clamped to [1, config['misc']['lc_max_points']]
+    :param _r: GET params
+    :return: max number of points
+    """
+    try:
+        max_points = int(_r.get('max_points', config['misc']['lc_max_points']))
+    except ValueError:
+        raise ValueError('bad max_points, must be int')
+
+    return min(max(max_points, 1), int(config['misc']['lc_max_points']))
+
+
+@routes.get('/sources/{source_id}/lc/{lc_id}')
+@login_required
+async def source_lc_data_get_handler(request):
+    """
+        Serve single light curve of a saved source as a list of data points,
+        or split into detections and non-detections for plotting if ?format=web.
+        Detections are then decimated to about ?max_points together with those of the other light curves
+        in the same filter
+    :param request:
+    :return:
+    """
+    _id = request.match_info['source_id']
+    lc_id = request.match_info['lc_id']
+
+    frmt = request.query.get('format', 'json')
+
+    try:
+        validators = await source_validators(request)
+        if not_modified(request, validators):
+            return web.Response(status=304, headers=validators)
+
+        # only pull the requested light curve out of the source document
+        source = await request.app['mongo'].sources.find_one({'_id': _id, 'lc._id': lc_id},
+                                                             {'lc': {'$elemMatch': {'_id': lc_id}}})
+        if source is None:
+            return web.json_response({'message': f'failure: light curve {lc_id} of {_id} not found'}, status=404)
+
+        lc = loads(dumps(source['lc'][0]))
+
+        if frmt == 'web':
+            try:
+                max_points = lc_max_points(request.query)
+            except ValueError as _e:
+                return web.json_response({'message': f'failure: {str(_e)}'}, status=400)
+            # light curves are decimated merged by filter, as they are plotted
+            others = await request.app['mongo'].sources.aggregate([
+                {'$match': {'_id': _id}},
+                {'$project': {'lc': {'$filter': {'input': '$lc',
+                                                 'cond': {'$and': [{'$eq': ['$$this.filter', lc['filter']]},
+                                                                   {'$ne': ['$$this._id', lc_id]}]}}}}}
+            ]).to_list(length=None)
+            others = [series_columns(other) for other in others[0]['lc']] if len(others) > 0 else []
+            lc['data'] = lc_plotly_data(series_columns(lc), max_points=max_points, others=others)
+        else:
+            lc['data'] = series_records(lc)
+        lc.pop('data_format', None)
+
+        return web.json_response(lc, status=200, dumps=dumps, headers=validators)
+
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
+@routes.get('/sources/{source_id}/spec/{spec_id}')
+@login_required
+async def source_spec_data_get_handler(request):
+    """
+        Serve single spectrum of a saved source as a list of data points,
+        or as wavelength-sorted wavelength, flux, and fluxerr lists for plotting if ?format=web
+    :param request:
+    :return:
+    """
+    _id = request.match_info['source_id']
+    spec_id = request.match_info['spec_id']
+
+    frmt = request.query.get('format', 'json')
+
+    try:
+        validators = await source_validators(request)
+        if not_modified(request, validators):
+            return web.Response(status=304, headers=validators)
+
+        source = await request.app['mongo'].sources.find_one({'_id': _id, 'spec._id': spec_id},
+                                                             {'spec': {'$elemMatch': {'_id': spec_id}}})
+        if source is None:
+            return web.json_response({'message': f'failure: spectrum {spec_id} of {_id} not found'}, status=404)
+
+        spec = loads(dumps(source['spec'][0]))
+
+        if frmt == 'web':
+            spec.update(spec_plotly_data(series_columns(spec)))
+            spec.pop('data', None)
+        else:
+            spec['data'] = series_records(spec)
+        spec.pop('data_format', None)
+
+        return web.json_response(spec, status=200, dumps=dumps, headers=validators)
+
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
 @routes.get('/sources/{source_id}/images/ps1')
 @login_required
 async def source_cutout_get_handler(request):
@@ -1837,25 +3062,52 @@ async def source_cutout_get_handler(request):
 
     _id = request.match_info['source_id']
 
+    validators = await source_validators(request)
+    if not_modified(request, validators):
+        return web.Response(status=304, headers=validators)
+
     source = await request.app['mongo'].sources.find({'_id': _id}, {'ra': 1, 'dec': 1}).to_list(length=None)
     source = loads(dumps(source[0]))
 
     try:
-        ps1_url = get_rgb_ps_stamp_url(source['ra'], source['dec'], timeout=1.5)
-        # print(ps1_url)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(ps1_url) as resp:
-                if resp.status == 200:
-                    buff = io.BytesIO()
-                    buff.write(await resp.read())
-                    buff.seek(0)
-                    return web.Response(body=buff, content_type='image/png')
+        png = await request.app['ps1'].get(source['ra'], source['dec'])
+        if len(png) > 0:
+            return web.Response(body=png, content_type='image/png', headers=validators)
     except Exception as e:
-        print(e)
+        print(f'Got error fetching PS1 cutout for {_id}: {repr(e)}')
 
     return web.Response(body=io.BytesIO(), content_type='image/png')
 
 
+def hr_marker(source):
+    """
+        Get position of a source on the HR diagram from its nearest Gaia DR2 match
+    :param source: with ra, dec and xmatch.Gaia_DR2
+    :return: BP-RP, absolute G; None, None if there is no good Gaia match
+    """
+    # don't mark anything if there is no good Gaia match
+    bp_rp, abs_g = None, None
+
+    if len(source.get('xmatch', dict()).get('Gaia_DR2', [])) > 0:
+
+        # pick the nearest match:
+        ii = np.argmin([great_circle_distance(source['dec']*np.pi/180, source['ra']*np.pi/180,
+                                              *radec_str2rad(*dd['coordinates']['radec_str'])[::-1])
+                        for dd in source['xmatch']['Gaia_DR2']])
+
+        xmatch = source['xmatch']['Gaia_DR2'][ii]
+
+        g = xmatch.get('phot_g_mean_mag', None)
+        bp = xmatch.get('phot_bp_mean_mag', None)
+        rp = xmatch.get('phot_rp_mean_mag', None)
+        p = xmatch.get('parallax', None)
+
+        if g and bp and rp and p:
+            bp_rp, abs_g = bp - rp, g + 5*np.log10(p/1000) + 5
+
+    return bp_rp, abs_g
+
+
 @routes.get('/sources/{source_id}/images/hr')
 @login_required
 async def source_hr_get_handler(request):
@@ -1869,59 +3121,33 @@ async def source_hr_get_handler(request):
 
     _id = request.match_info['source_id']
 
+    validators = await source_validators(request)
+    if not_modified(request, validators):
+        return web.Response(status=304, headers=validators)
+
+    if 'ETag' in validators:
+        png = request.app['render_cache'].get(_id, validators['ETag'])
+        if png is not None:
+            return web.Response(body=png, content_type='image/png', headers=validators)
+
     source = await request.app['mongo'].sources.find({'_id': _id},
                                                      {'ra': 1, 'dec': 1, 'xmatch.Gaia_DR2': 1}).to_list(length=None)
     source = loads(dumps(source[0]))
 
     # print(source)
 
-    if len(source['xmatch']['Gaia_DR2']) > 0:
-
-        # pick the nearest match:
-        ii = np.argmin([great_circle_distance(source['dec']*np.pi/180, source['ra']*np.pi/180,
-                                              *radec_str2rad(*dd['coordinates']['radec_str'])[::-1])
-                        for dd in source['xmatch']['Gaia_DR2']])
-
-        xmatch = source['xmatch']['Gaia_DR2'][ii]
-
-        g = xmatch.get('phot_g_mean_mag', None)
-        bp = xmatch.get('phot_bp_mean_mag', None)
-        rp = xmatch.get('phot_rp_mean_mag', None)
-        p = xmatch.get('parallax', None)
+    bp_rp, abs_g = hr_marker(source)
 
-        if g and bp and rp and p:
-            try:
-                img = plt.imread('/app/static/img/hr_plot.png')
-                buff = io.BytesIO()
-
-                fig = plt.figure(figsize=(4, 4), dpi=200)
-                ax = fig.add_subplot(111)
-                ax.plot(bp-rp, g + 5*np.log10(p/1000) + 5, 'o', markersize=8, c='#f22f29')
-                ax.imshow(img, extent=[-1, 5, 17, -5])
-                ax.set_aspect(1 / 4)
-                ax.set_ylabel('G')
-                ax.set_xlabel('BP-RP')
-                plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-                plt.savefig(buff, dpi=200, bbox_inches='tight')
-                buff.seek(0)
-                plt.close('all')
-                return web.Response(body=buff, content_type='image/png')
-            except Exception as e:
-                print(e)
+    try:
+        png = await request.app['render_service'].render(render_hr, bp_rp, abs_g)
+        # the empty diagram is prebuilt in the render workers, no need to keep a copy per source
+        if ('ETag' in validators) and (bp_rp is not None):
+            request.app['render_cache'].put(_id, validators['ETag'], png)
+        return web.Response(body=png, content_type='image/png', headers=validators)
+    except Exception as e:
+        print(f'Got error rendering HR diagram for {_id}: {repr(e)}')
 
-    img = plt.imread('/app/static/img/hr_plot.png')
-    buff = io.BytesIO()
-    fig = plt.figure(figsize=(4, 4), dpi=200)
-    ax = fig.add_subplot(111)
-    ax.imshow(img, extent=[-1, 5, 17, -5])
-    ax.set_aspect(1 / 4)
-    ax.set_ylabel('G')
-    ax.set_xlabel('BP-RP')
-    plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-    plt.savefig(buff, dpi=200, bbox_inches='tight')
-    buff.seek(0)
-    plt.close('all')
-    return web.Response(body=buff, content_type='image/png')
+    return web.Response(body=io.BytesIO(), content_type='image/png')
 
 
 @routes.get('/api/images/hr')
@@ -1944,6 +3170,9 @@ async def hr_get_handler(request):
     dec = _r.get('dec', None)
     sep = _r.get('sep', 5)
 
+    # don't mark anything if no good candidates are found
+    bp_rp, abs_g = None, None
+
     if (ra is not None) and (dec is not None):
         ra = float(ra)
         dec = float(dec)
@@ -1966,7 +3195,7 @@ async def hr_get_handler(request):
                                  },
                                  }
 
-        resp = request.app['kowalski'].query(kowalski_query_xmatch)
+        resp = await request.app['kowalski'].query(kowalski_query_xmatch)
         xmatch = resp.get('data', dict()).get('Gaia_DR2', dict()).get('source', dict())
         print(xmatch)
 
@@ -1985,60 +3214,23 @@ async def hr_get_handler(request):
             p = xmatch.get('parallax', None)
 
             if g and bp and rp and p:
-                try:
-                    img = plt.imread('/app/static/img/hr_plot.png')
-                    buff = io.BytesIO()
-
-                    fig = plt.figure(figsize=(4, 4), dpi=200)
-                    ax = fig.add_subplot(111)
-                    ax.plot(bp-rp, g + 5*np.log10(p/1000) + 5, 'o', markersize=8, c='#f22f29')
-                    ax.imshow(img, extent=[-1, 5, 17, -5])
-                    ax.set_aspect(1 / 4)
-                    ax.set_ylabel('G')
-                    ax.set_xlabel('BP-RP')
-                    plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-                    plt.savefig(buff, dpi=200, bbox_inches='tight')
-                    buff.seek(0)
-                    plt.close('all')
-                    return web.Response(body=buff, content_type='image/png')
-                except Exception as e:
-                    print(e)
+                bp_rp, abs_g = bp - rp, g + 5*np.log10(p/1000) + 5
 
-    img = plt.imread('/app/static/img/hr_plot.png')
-    buff = io.BytesIO()
-    fig = plt.figure(figsize=(4, 4), dpi=200)
-    ax = fig.add_subplot(111)
-    ax.imshow(img, extent=[-1, 5, 17, -5])
-    ax.set_aspect(1 / 4)
-    ax.set_ylabel('G')
-    ax.set_xlabel('BP-RP')
-    plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-    plt.savefig(buff, dpi=200, bbox_inches='tight')
-    buff.seek(0)
-    plt.close('all')
-    return web.Response(body=buff, content_type='image/png')
+    try:
+        png = await request.app['render_service'].render(render_hr, bp_rp, abs_g)
+        return web.Response(body=png, content_type='image/png')
+    except Exception as e:
+        print(f'Got error rendering HR diagram: {repr(e)}')
 
+    return web.Response(body=io.BytesIO(), content_type='image/png')
 
-@routes.get('/sources/{source_id}/images/lc')
-@login_required
-async def source_lc_get_handler(request):
+
+def lc_plot_params(_r):
     """
-        Serve light curve plot for a source
-    :param request:
-    :return:
+        Get light curve plot parameters from GET params
+    :param _r: GET params
+    :return: kwargs for render_lc
     """
-    # get session:
-    session = await get_session(request)
-
-    _id = request.match_info['source_id']
-
-    source = await request.app['mongo'].sources.find({'_id': _id}, {'lc': 1}).to_list(length=None)
-    source = loads(dumps(source[0]))
-    # print(source)
-
-    # GET params:
-    _r = request.rel_url.query
-
     # aspect:
     w = float(_r.get('w', 10))
     h = float(_r.get('h', 4))
@@ -2061,136 +3253,49 @@ async def source_lc_get_handler(request):
             period /= 24
     plot_twice = _r.get('t', False)
 
-    if len(source['lc']) > 0:
-        try:
-            buff = io.BytesIO()
-
-            fig = plt.figure(figsize=(w, h), dpi=200)
+    # decimate light curves to about max_points per filter and data subset:
+    max_points = lc_max_points(_r)
 
-            if not hist:
-                ax_plc = fig.add_subplot(111)
-            else:
-                # definitions for the axes
-                left, width = 0.1, 0.65
-                bottom, height = 0.1, 0.65
-                spacing = 0.005
-
-                rect_scatter = [left, bottom, width, height]
-                # rect_histx = [left, bottom + height + spacing, width, 0.2]
-                rect_histy = [left + width + spacing, bottom, 0.2, height]
-
-                ax_plc = plt.axes(rect_scatter)
-                ax_plc.tick_params(direction='in', top=True, right=True)
-                ax_histy = plt.axes(rect_histy)
-                ax_histy.tick_params(direction='in', labelleft=False)
-
-            if period is None:
-                ax_plc.title.set_text(f'Photometric light curve for {source["_id"]}')
-            else:
-                # r"$\bf{"
-                ax_plc.title.set_text(f'Phase-folded light curve for {source["_id"]} with ' r"$\bf{"
-                                      f'p={period}\:{units}' "}$")
+    return {'w': w, 'h': h, 'hist': hist, 'bins': bins, 'period': period, 'units': units,
+            'plot_twice': plot_twice, 'max_points': max_points}
 
-            lc_color_indexes = dict()
 
-            for lc in source['lc']:
-                filt = lc['filter']
-                lc_color_indexes[filt] = lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
-                c = lc_colors(filt, lc_color_indexes[filt])
-
-                df_plc = pd.DataFrame.from_records(lc['data'])
-                # display(df_plc)
-
-                if 'mjd' not in df_plc:
-                    df_plc['mjd'] = df_plc['hjd'] - 2400000.5
-                if 'hjd' not in df_plc:
-                    df_plc['hjd'] = df_plc['mjd'] + 2400000.5
-
-                if period is None:
-                    # filter out unreleased MSIP data or only use it for QA
-                    # w_msip = (df_plc['programid'] != 1) | (df_plc['hjd'] <= t_cut_msip)
-                    # w_msip = (df_plc['programid'] == 1) & (df_plc['hjd'] <= t_cut_msip)
-
-                    # w_good = w_msip & (df_plc['catflags'] == 0)
-                    if 'catflags' in df_plc:
-                        w_good = df_plc['catflags'] == 0
-                        if np.sum(w_good) > 0:
-                            t = df_plc.loc[w_good, 'hjd']
-                            mag = df_plc.loc[w_good, 'mag']
-                            mag_error = df_plc.loc[w_good, 'magerr']
-
-                            ax_plc.errorbar(t, mag, yerr=mag_error, elinewidth=0.4,
-                                            marker='.', c=c, lw=0, label=f'filter: {filt}')
-
-                        # w_not_so_good = w_msip & (df_plc['catflags'] != 0)
-                        w_not_so_good = df_plc['catflags'] != 0
-                        if np.sum(w_not_so_good) > 0:
-                            t = df_plc.loc[w_not_so_good, 'hjd']
-                            mag = df_plc.loc[w_not_so_good, 'mag']
-                            mag_error = df_plc.loc[w_not_so_good, 'magerr']
-
-                            ax_plc.errorbar(t, mag, yerr=mag_error, elinewidth=0.4,
-                                            marker='x', alpha=0.5, c=c, lw=0, label=f'filter: {filt}, flagged')
-                    else:
-                        w_det = df_plc['mag'] != 0
-                        t = df_plc.loc[w_det, 'hjd']
-                        mag = df_plc.loc[w_det, 'mag']
-                        mag_error = df_plc.loc[w_det, 'magerr']
+@routes.get('/sources/{source_id}/images/lc')
+@login_required
+async def source_lc_get_handler(request):
+    """
+        Serve light curve plot for a source
+    :param request:
+    :return:
+    """
+    # get session:
+    session = await get_session(request)
 
-                        ax_plc.errorbar(t, mag, yerr=mag_error, elinewidth=0.4,
-                                        marker='.', c=c, lw=0, label=f'filter: {filt}')
+    _id = request.match_info['source_id']
 
-                else:
-                    # phase-folded lc:
-                    if 'catflags' in df_plc:
-                        w_det = (df_plc['mag'] != 0) & (df_plc['catflags'] == 0)
-                    else:
-                        w_det = df_plc['mag'] != 0
-
-                    df_plc['phase'] = df_plc['hjd'].apply(lambda x: (x / period) % 1)
-
-                    t = df_plc.loc[w_det, 'phase'] if not plot_twice else np.hstack(
-                        (df_plc.loc[w_det, 'phase'].values, df_plc.loc[w_det, 'phase'].values + 1))
-                    mag = df_plc.loc[w_det, 'mag'] if not plot_twice else np.hstack((df_plc.loc[w_det, 'mag'].values,
-                                                                                     df_plc.loc[w_det, 'mag'].values))
-                    mag_error = df_plc.loc[w_det, 'magerr'].values if not plot_twice else \
-                        np.hstack((df_plc.loc[w_det, 'magerr'].values, df_plc.loc[w_det, 'magerr'].values))
-
-                    ax_plc.errorbar(t, mag, yerr=mag_error, elinewidth=0.4,
-                                    marker='.', c=c, lw=0, label=f'filter: {filt}')
-
-                if hist:
-                    if period is not None:
-                        if 'catflags' in df_plc:
-                            w_det = (df_plc['mag'] != 0) & (df_plc['catflags'] == 0)
-                        else:
-                            w_det = df_plc['mag'] != 0
-                    else:
-                        w_det = df_plc['mag'] != 0
-                    mag = df_plc.loc[w_det, 'mag']
-                    ax_histy.hist(mag, bins=bins, color=c, alpha=0.5, label=f'filter: {filt}', orientation='horizontal')
-
-            ax_plc.invert_yaxis()
-            # if t_format == 'days_ago':
-            #     ax_plc.invert_xaxis()
-            ax_plc.grid(True, lw=0.3)
-            # ax_plc.set_xlabel(t_format)
-            ax_plc.set_ylabel('mag')
-
-            if not hist:
-                ax_plc.legend(bbox_to_anchor=(1, 1), loc='upper left', ncol=1, fontsize='x-small')
-                plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-            else:
-                ax_histy.invert_yaxis()
-                ax_histy.grid(True, lw=0.3)
-                ax_histy.legend(bbox_to_anchor=(1, 1), loc='upper left', ncol=1, fontsize='x-small')
-
-            plt.savefig(buff, dpi=200, bbox_inches='tight')
-            buff.seek(0)
-            plt.close('all')
-            return web.Response(body=buff, content_type='image/png')
+    validators = await source_validators(request)
+    if not_modified(request, validators):
+        return web.Response(status=304, headers=validators)
+
+    # rendered images are cached on disk under their ETag, which changes with the source and the GET params
+    if 'ETag' in validators:
+        png = request.app['render_cache'].get(_id, validators['ETag'])
+        if png is not None:
+            return web.Response(body=png, content_type='image/png', headers=validators)
+
+    source = await request.app['mongo'].sources.find({'_id': _id}, {'lc': 1}).to_list(length=None)
+    source = loads(dumps(source[0]))
+    # print(source)
+
+    if len(source['lc']) > 0:
+        try:
+            png = await request.app['render_service'].render(render_lc, source['_id'], source['lc'],
+                                                             **lc_plot_params(request.rel_url.query))
+            if 'ETag' in validators:
+                request.app['render_cache'].put(_id, validators['ETag'], png)
+            return web.Response(body=png, content_type='image/png', headers=validators)
         except Exception as e:
-            print(e)
+            print(f'Got error rendering light curve for {_id}: {repr(e)}')
 
     buff = io.BytesIO()
     # buff.write(base64.b64decode(b"R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"))
@@ -2212,6 +3317,16 @@ async def source_maghist_get_handler(request):
 
     _id = request.match_info['source_id']
 
+    validators = await source_validators(request)
+    if not_modified(request, validators):
+        return web.Response(status=304, headers=validators)
+
+    # rendered images are cached on disk under their ETag, which changes with the source and the GET params
+    if 'ETag' in validators:
+        png = request.app['render_cache'].get(_id, validators['ETag'])
+        if png is not None:
+            return web.Response(body=png, content_type='image/png', headers=validators)
+
     source = await request.app['mongo'].sources.find({'_id': _id}, {'lc': 1}).to_list(length=None)
     source = loads(dumps(source[0]))
     # print(source)
@@ -2229,54 +3344,364 @@ async def source_maghist_get_handler(request):
 
     if len(source['lc']) > 0:
         try:
-            buff = io.BytesIO()
+            png = await request.app['render_service'].render(render_maghist, source['_id'], source['lc'],
+                                                             w=w, h=h, bins=bins)
+            if 'ETag' in validators:
+                request.app['render_cache'].put(_id, validators['ETag'], png)
+            return web.Response(body=png, content_type='image/png', headers=validators)
+        except Exception as e:
+            print(f'Got error rendering magnitude histogram for {_id}: {repr(e)}')
+
+    buff = io.BytesIO()
+    return web.Response(body=buff, content_type='image/png')
+
+
+@routes.post('/images/sparklines')
+@login_required
+async def sparklines_post_handler(request):
+    """
+        Serve light curve thumbnails for a list of sources as one PNG sprite sheet:
+        thumbnail i occupies rows i * h to (i + 1) * h, sources without light curves are left blank
+    :param request:
+    :return:
+    """
+    try:
+        _r = await request.json()
 
-            fig = plt.figure(figsize=(w, h), dpi=200)
-            ax_plc = fig.add_subplot(111)
-            ax_plc.title.set_text(f'Histogram of magnitudes for {source["_id"]}')
+        source_ids = [str(_id) for _id in _r['source_ids']]
+        max_sources = int(config['misc']['sparklines_max_sources'])
+        assert len(source_ids) <= max_sources, f'at most {max_sources} sources per request'
+        w = int(_r.get('w', 120))
+        h = int(_r.get('h', 24))
+        assert (0 < w <= 1000) and (0 < h <= 200), 'thumbnail size out of range'
 
-            lc_color_indexes = dict()
+        # fetch only what is plotted, whatever the storage layout
+        cursor = request.app['mongo'].sources.find({'_id': {'$in': source_ids}},
+                                                   {'lc.filter': 1, 'lc.data_format': 1, 'lc.data.hjd': 1,
+                                                    'lc.data.mjd': 1, 'lc.data.mag': 1, 'lc.data.catflags': 1})
+        lcs = {source['_id']: source.get('lc', []) async for source in cursor}
 
-            for lc in source['lc']:
-                filt = lc['filter']
-                lc_color_indexes[filt] = lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
-                c = lc_colors(filt, lc_color_indexes[filt])
+        png = await request.app['render_service'].render(render_sparklines, [lcs.get(_id, []) for _id in source_ids],
+                                                         w=w, h=h)
+
+        return web.Response(body=png, content_type='image/png',
+                            headers={'X-Sprite-Width': str(w), 'X-Sprite-Height': str(h),
+                                     'Cache-Control': 'private, no-cache'})
+
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
+''' warm caches for saved sources in the background '''
 
-                df_plc = pd.DataFrame.from_records(lc['data'])
-                # display(df_plc)
 
-                if 'mjd' not in df_plc:
-                    df_plc['mjd'] = df_plc['hjd'] - 2400000.5
-                if 'hjd' not in df_plc:
-                    df_plc['hjd'] = df_plc['mjd'] + 2400000.5
+async def prefetch_source(app, _id):
+    """
+        Fetch PS1 cutout and render HR diagram and light curve plots for a saved source,
+        storing them where the image handlers will look for them
+    :param app:
+    :param _id: source _id
+    :return:
+    """
+    source = await app['mongo'].sources.find_one({'_id': _id}, {'ra': 1, 'dec': 1, 'last_modified': 1,
+                                                                 'lc': 1, 'xmatch.Gaia_DR2': 1})
+    if source is None:
+        return
+
+    # the cutout cache is keyed by position, not by source
+    if (source.get('ra', None) is not None) and (source.get('dec', None) is not None):
+        await app['ps1'].get(source['ra'], source['dec'])
+
+    # plots are cached under the ETag of the request that will ask for them
+    def etag(path_qs):
+        return validators_for(_id, source.get('last_modified', None), path_qs).get('ETag', None)
+
+    hr_etag = etag(f'/sources/{_id}/images/hr')
+    bp_rp, abs_g = hr_marker(source)
+    if (hr_etag is not None) and (bp_rp is not None) and (app['render_cache'].get(_id, hr_etag) is None):
+        png = await app['render_service'].render(render_hr, bp_rp, abs_g)
+        app['render_cache'].put(_id, hr_etag, png)
+
+    if len(source.get('lc', [])) > 0:
+        for qs in config['misc']['prefetch_lc_plots']:
+            lc_etag = etag(f'/sources/{_id}/images/lc?{qs}')
+            if (lc_etag is not None) and (app['render_cache'].get(_id, lc_etag) is None):
+                png = await app['render_service'].render(render_lc, _id, source['lc'],
+                                                         **lc_plot_params(dict(parse_qsl(qs))))
+                app['render_cache'].put(_id, lc_etag, png)
+
+
+class PrefetchQueue(object):
+    """
+        Background queue of saved sources to warm caches for, see prefetch_source.
 
-                if 'catflags' in df_plc:
-                    w_det = (df_plc['mag'] != 0) & (df_plc['catflags'] == 0)
+        This is best effort: the queue lives in the memory of the app process and is bounded, sources that do not fit
+        are dropped and simply rendered on first view. A bounded pool of workers takes sources off the queue;
+        when prefetching fails or takes longer than slow_threshold seconds (e.g. STScI is slow),
+        the workers back off exponentially up to max_backoff seconds and speed up again once things recover
+    """
+    def __init__(self, app, num_workers: int = 2, max_queued: int = 10000,
+                 slow_threshold: float = 5.0, max_backoff: float = 60.0):
+        self.app = app
+        self.num_workers = num_workers
+        self.slow_threshold = slow_threshold
+        self.max_backoff = max_backoff
+
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.workers = []
+        self.backoff = 0.0
+
+        # metrics
+        self.done = 0
+        self.failed = 0
+        self.dropped = 0
+
+    async def start(self):
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.num_workers)]
+
+    async def stop(self):
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def enqueue(self, _id):
+        """
+            Add source to the queue without waiting
+        :return: False if the queue is full and the source was dropped
+        """
+        try:
+            self.queue.put_nowait(_id)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def worker(self):
+        while True:
+            _id = await self.queue.get()
+            try:
+                if self.backoff > 0:
+                    await asyncio.sleep(self.backoff)
+
+                tic = time.time()
+                try:
+                    await prefetch_source(self.app, _id)
+                    self.done += 1
+                    slow = time.time() - tic > self.slow_threshold
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f'Failed to prefetch {_id}: {repr(e)}')
+                    self.failed += 1
+                    slow = True
+
+                if slow:
+                    self.backoff = min(max(2 * self.backoff, 1.0), self.max_backoff)
                 else:
-                    w_det = df_plc['mag'] != 0
+                    self.backoff = self.backoff / 2 if self.backoff > 1.0 else 0.0
+
+            finally:
+                self.queue.task_done()
+
+    def metrics(self):
+        return {'queued': self.queue.qsize(),
+                'done': self.done,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'backoff': self.backoff}
+
+
+@routes.post('/programs/{program_id}/prefetch')
+@login_required
+async def program_prefetch_handler(request):
+    """
+        Warm caches for all sources of a program, e.g. before a labeling campaign (admin only)
+    :param request:
+    :return:
+    """
+    user = request.get('user', None)
+    # try session if None:
+    if user is None:
+        session = await get_session(request)
+        user = session['user_id']
 
-                mag = df_plc.loc[w_det, 'mag']
+    if user != config['server']['admin_username']:
+        return web.json_response({'message': '403 Forbidden'}, status=403)
 
-                ax_plc.hist(mag, bins=bins, color=c, alpha=0.5, label=f'filter: {filt}')
+    try:
+        program_id = int(request.match_info['program_id'])
 
-            ax_plc.grid(True, lw=0.3)
-            ax_plc.set_xlabel('mag')
-            ax_plc.legend(loc='best', ncol=1, fontsize='x-small')
+        prefetch = request.app['prefetch']
+        cursor = request.app['mongo'].sources.find({'zvm_program_id': program_id}, {'_id': 1})
+        num_enqueued = 0
+        async for source in cursor:
+            if not prefetch.enqueue(source['_id']):
+                break
+            num_enqueued += 1
 
-            plt.tight_layout(pad=0, h_pad=0, w_pad=0)
+        num_sources = await request.app['mongo'].sources.count_documents({'zvm_program_id': program_id})
 
-            plt.savefig(buff, dpi=200, bbox_inches='tight')
-            buff.seek(0)
-            plt.close('all')
-            return web.Response(body=buff, content_type='image/png')
-        except Exception as e:
-            print(e)
+        return web.json_response({'message': 'success',
+                                  'result': {'zvm_program_id': program_id,
+                                             'num_sources': num_sources,
+                                             'num_enqueued': num_enqueued}}, status=200)
 
-    buff = io.BytesIO()
-    return web.Response(body=buff, content_type='image/png')
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
+def period_search_params(_r):
+    """
+        Get period search parameters from request, with defaults from config
+    :param _r: GET params or json body
+    :return: kwargs for period_search
+    """
+    defaults = config['misc']['period_search']
+
+    params = {'method': str(_r.get('method', defaults['method'])).lower(),
+              'f_min': float(_r.get('f_min', defaults['f_min'])),
+              'f_max': float(_r.get('f_max', defaults['f_max'])),
+              'n_freq': int(_r.get('n_freq', defaults['n_freq'])),
+              'n_peaks': int(_r.get('n_peaks', defaults['n_peaks'])),
+              'min_points': int(_r.get('min_points', defaults['min_points']))}
+
+    assert params['method'] in period_search_methods, \
+        f"method {params['method']} not in {period_search_methods}"
+    assert 0 < params['f_min'] < params['f_max'], 'bad frequency range'
+    assert 2 <= params['n_freq'] <= int(defaults['max_n_freq']), \
+        f"n_freq must be between 2 and {defaults['max_n_freq']}"
+
+    return params
+
+
+async def source_period_search(request, _r):
+    """
+        Run period search on the light curves of a saved source in the process pool
+    :param request:
+    :param _r: GET params or json body
+    :return: parameters and results as returned by period_search, None if source not found
+    """
+    _id = request.match_info['source_id']
+
+    params = period_search_params(_r)
+    periodogram_points = int(_r.get('periodogram_points', config['misc']['period_search']['periodogram_points']))
+
+    source = await request.app['mongo'].sources.find_one({'_id': _id}, {'lc': 1})
+    if source is None:
+        return None
+
+    loop = asyncio.get_event_loop()
+    results = await loop.run_in_executor(request.app['process_pool'],
+                                         functools.partial(period_search, source['lc'],
+                                                           periodogram_points=periodogram_points, **params))
+
+    return {**params, 'results': results}
+
+
+@routes.get('/sources/{source_id}/periodogram')
+@login_required
+async def source_periodogram_get_handler(request):
+    """
+        Run period search on the light curves of a saved source, merged by filter.
+        GET params: method (ls, ce, or bls), f_min and f_max [1/day], n_freq, n_peaks, min_points,
+        periodogram_points (0 to only get the peaks); defaults in config['misc']['period_search']
+    :param request:
+    :return:
+    """
+    try:
+        period_search_ = await source_period_search(request, request.query)
+        if period_search_ is None:
+            return web.json_response({'message': 'failure: source not found'}, status=404)
+
+        return web.json_response({'message': 'success', 'period_search': period_search_}, status=200)
+
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
+@routes.post('/sources/{source_id}/periodogram')
+@login_required
+@invalidates_query_cache('sources')
+async def source_periodogram_post_handler(request):
+    """
+        Run period search on the light curves of a saved source, merged by filter,
+        and store the peaks in source['period_search'][method] if 'save' is set.
+        Takes the same parameters as GET as json
+    :param request:
+    :return:
+    """
+    # get session:
+    session = await get_session(request)
+    user = session['user_id']
+
+    try:
+        _r = await request.json()
+
+        period_search_ = await source_period_search(request, _r)
+        if period_search_ is None:
+            return web.json_response({'message': 'failure: source not found'}, status=404)
+
+        if _r.get('save', False):
+            _id = request.match_info['source_id']
+            time_tag = utc_now()
+
+            doc = {**period_search_,
+                   'results': [{k: v for k, v in result.items() if k != 'periodogram'}
+                               for result in period_search_['results']],
+                   'user': user,
+                   'created': time_tag}
+
+            best = ', '.join(f"{result['filter']}: {result['peaks'][0]['period']:.6f} Days"
+                             for result in doc['results'] if len(result['peaks']) > 0)
+            h = {'note_type': 'period_search',
+                 'time_tag': time_tag,
+                 'user': user,
+                 'note': f"{doc['method']} {best}"}
+
+            await request.app['mongo'].sources.update_one({'_id': _id},
+                                                          {'$set': {f"period_search.{doc['method']}": doc,
+                                                                    'last_modified': time_tag},
+                                                           '$push': {'history': h}})
+
+        return web.json_response({'message': 'success', 'period_search': period_search_}, status=200)
+
+    except Exception as _e:
+        print(f'Got error: {str(_e)}')
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({'message': f'failure: {_err}'}, status=500)
+
+
+def storage_layout(entry):
+    """
+        Convert light curve or spectrum data to the storage layout set in config['misc']['lc_storage_format']:
+        'records' - list of data points, 'columnar' - typed columns, see utils.pack_columns
+    :param entry: element of source['lc'] or source['spec']
+    :return:
+    """
+    if (config['misc']['lc_storage_format'] == 'columnar') and (entry.get('data_format', 'records') != 'columnar'):
+        entry['data'] = pack_columns(entry['data'])
+        entry['data_format'] = 'columnar'
+    return entry
 
 
-def cross_match(kowalski, ra, dec):
+async def cross_match(kowalski, ra, dec):
+    """
+        Cross-match position against the catalogs in config['kowalski']['cross_match']
+    :param kowalski: KowalskiGateway
+    :param ra: [deg]
+    :param dec: [deg]
+    :return: {catalog: [matches]}
+    """
     kowalski_query_xmatch = {"query_type": "cone_search",
                              "query": {
                                  "object_coordinates": {
@@ -2288,7 +3713,7 @@ def cross_match(kowalski, ra, dec):
                              }
     # print(kowalski_query_xmatch)
 
-    resp = kowalski.query(kowalski_query_xmatch)
+    resp = await kowalski.query(kowalski_query_xmatch)
     xmatch = resp['data']
 
     # reformat for ingestion (we queried only one sky position):
@@ -2301,6 +3726,7 @@ def cross_match(kowalski, ra, dec):
 
 @routes.put('/sources')
 @login_required
+@invalidates_query_cache('sources')
 async def sources_put_handler(request):
     """
         Save ZTF source to own db assigning a unique id and adding to a program,
@@ -2351,7 +3777,7 @@ async def sources_put_handler(request):
                 }
             }
 
-            resp = request.app['kowalski'].query(kowalski_query)
+            resp = await request.app['kowalski'].query(kowalski_query)
             ztf_source = resp['data'][0]
 
         else:
@@ -2407,7 +3833,7 @@ async def sources_put_handler(request):
         doc['labels'] = []
 
         # cross match:
-        xmatch = cross_match(kowalski=request.app['kowalski'], ra=doc['ra'], dec=doc['dec'])
+        xmatch = await cross_match(kowalski=request.app['kowalski'], ra=doc['ra'], dec=doc['dec'])
         # print(xmatch)
         doc['xmatch'] = xmatch
 
@@ -2434,7 +3860,8 @@ async def sources_put_handler(request):
                   'filter': ztf_source['filter'],
                   'lc_type': 'temporal',
                   'data': ztf_source['data']}
-            doc['lc'] = [lc]
+            lc['stats'] = lc_stats(lc['data'])
+            doc['lc'] = [storage_layout(lc)]
         else:
             doc['lc'] = []
 
@@ -2466,7 +3893,7 @@ async def sources_put_handler(request):
                 }
             # print(query_merge)
 
-            resp = request.app['kowalski'].query(query_merge)
+            resp = await request.app['kowalski'].query(query_merge)
             kk = list(resp['data'][config['kowalski']['coll_sources']].keys())[0]
             sources_merge = resp['data'][config['kowalski']['coll_sources']][kk]
             # print(sources_merge)
@@ -2488,7 +3915,8 @@ async def sources_put_handler(request):
                       'lc_type': 'temporal',
                       'data': source_merge['data']}
 
-                doc['lc'].append(lc)
+                lc['stats'] = lc_stats(lc['data'])
+                doc['lc'].append(storage_layout(lc))
 
         doc['created_by'] = user
         time_tag = utc_now()
@@ -2510,6 +3938,9 @@ async def sources_put_handler(request):
                 except pymongo.errors.DuplicateKeyError as e:
                     continue
 
+        # warm PS1 cutout and plot caches before anyone opens the source
+        request.app['prefetch'].enqueue(doc['_id'])
+
         if return_result:
             return web.json_response({'message': 'success', 'result': doc}, status=200, dumps=dumps)
         else:
@@ -2520,15 +3951,6 @@ async def sources_put_handler(request):
         _err = traceback.format_exc()
         print(str(_err))
 
-        try:
-            if not request.app['kowalski'].ping():
-                print('Apparently lost connection to Kowalski, trying to reset')
-                request.app['kowalski'] = Kowalski(username=config['kowalski']['username'],
-                                                   password=config['kowalski']['password'])
-                print('Success')
-        except Exception as __e:
-            print(str(__e))
-
         return web.json_response({'message': f'ingestion failed {str(_e)}'}, status=200)
 
 
@@ -2539,6 +3961,7 @@ class MyMultipartReader(multipart.MultipartReader):
 
 @routes.post('/sources/{source_id}')
 @login_required
+@invalidates_query_cache('sources')
 async def source_post_handler(request):
     """
         Update saved source
@@ -2598,7 +4021,7 @@ async def source_post_handler(request):
                     }
                 }
 
-                resp = request.app['kowalski'].query(kowalski_query)
+                resp = await request.app['kowalski'].query(kowalski_query)
                 ztf_source = resp['data'][0]
 
                 # filter lc for MSIP data
@@ -2618,6 +4041,8 @@ async def source_post_handler(request):
                       'filter': ztf_source['filter'],
                       'lc_type': 'temporal',
                       'data': ztf_source['data']}
+                lc['stats'] = lc_stats(lc['data'])
+                storage_layout(lc)
 
                 # make history
                 time_tag = utc_now()
@@ -2658,6 +4083,9 @@ async def source_post_handler(request):
                             if (kk in dp) and (not isinstance(dp[kk], float)):
                                 dp[kk] = float(dp[kk])
 
+                    lc['stats'] = lc_stats(lc['data'])
+                    storage_layout(lc)
+
                     # make history
                     time_tag = utc_now()
                     h = {'note_type': 'lc',
@@ -2710,6 +4138,8 @@ async def source_post_handler(request):
                     for kk in ('wavelength', 'flux', 'fluxerr'):
                         assert kk in dp, f'{kk} key not set for data point #{idp + 1}'
 
+                storage_layout(spectrum)
+
                 # make history
                 time_tag = utc_now()
                 h = {'note_type': 'spec',
@@ -2849,7 +4279,7 @@ async def source_post_handler(request):
 
             elif _r['action'] == 'run_cross_match':
 
-                xmatch = cross_match(kowalski=request.app['kowalski'], ra=source['ra'], dec=source['dec'])
+                xmatch = await cross_match(kowalski=request.app['kowalski'], ra=source['ra'], dec=source['dec'])
 
                 # make history
                 time_tag = utc_now()
@@ -2909,6 +4339,7 @@ async def source_post_handler(request):
 
 @routes.delete('/sources/{source_id}')
 @login_required
+@invalidates_query_cache('sources')
 async def source_delete_handler(request):
     """
         Update saved source
@@ -2929,6 +4360,7 @@ async def source_delete_handler(request):
         _id = request.match_info['source_id']
 
         await request.app['mongo'].sources.delete_one({'_id': _id})
+        request.app['render_cache'].invalidate(_id)
 
         # todo: delete associated data (e.g. finding chart)
 
@@ -3027,7 +4459,7 @@ async def search_post_handler(request):
             }
         }
 
-        resp = request.app['kowalski'].query(kowalski_query)
+        resp = await request.app['kowalski'].query(kowalski_query)
         # print(resp)
 
         source_keys = list(resp['data'][config['kowalski']['coll_sources']].keys())
@@ -3090,15 +4522,6 @@ async def search_post_handler(request):
     except Exception as _e:
         print(f'Querying Kowalski failed: {str(_e)}')
 
-        try:
-            if not request.app['kowalski'].ping():
-                print('Apparently lost connection to Kowalski, trying to reset')
-                request.app['kowalski'] = Kowalski(username=config['kowalski']['username'],
-                                                   password=config['kowalski']['password'])
-                print('Success')
-        except Exception as __e:
-            print(str(__e))
-
         context = {'logo': config['server']['logo'],
                    'user': session['user_id'],
                    'programs': [],
@@ -3192,6 +4615,22 @@ async def app_factory():
     # store mongo connection
     app['mongo'] = mongo
 
+    # query result cache
+    app['query_cache'] = QueryCache(max_size=int(config['misc']['query_cache_max_size']),
+                                    ttl=float(config['misc']['query_cache_ttl']))
+
+    # rendered images
+    app['render_cache'] = DiskCache(config['path']['path_render_cache'],
+                                    max_bytes=int(config['misc']['render_cache_max_bytes']))
+
+    # admission control for /query
+    app['admission'] = AdmissionController(max_concurrent=int(config['misc']['max_concurrent_queries']),
+                                           max_concurrent_per_user=int(
+                                               config['misc']['max_concurrent_queries_per_user']),
+                                           max_queued=int(config['misc']['max_admission_queue']),
+                                           max_wait=float(config['misc']['max_admission_wait']),
+                                           weights=config['misc']['admission_weights'])
+
     # indices
     await app['mongo'].sources.create_index([('coordinates.radec_geojson', '2dsphere'),
                                              ('_id', 1)], background=True)
@@ -3204,6 +4643,18 @@ async def app_factory():
                                              ('_id', 1)], background=True)
     await app['mongo'].sources.create_index([('labels.label', 1)], background=True)
     await app['mongo'].sources.create_index([('lc.id', 1)], background=True)
+    await app['mongo'].sources.create_index([('lc.stats.amplitude_robust', 1)], background=True)
+    await app['mongo'].sources.create_index([('lc.stats.mag_rms', 1)], background=True)
+    await app['mongo'].sources.create_index([('lc.stats.n', 1)], background=True)
+    try:
+        await app['mongo'].queries.create_index([('task_id', 1), ('user', 1)], unique=True, background=True)
+    except pymongo.errors.OperationFailure:
+        # replace the non-unique index created by earlier versions
+        await app['mongo'].queries.drop_index([('task_id', 1), ('user', 1)])
+        await app['mongo'].queries.create_index([('task_id', 1), ('user', 1)], unique=True, background=True)
+    await app['mongo'].queries.create_index([('status', 1), ('created', 1)], background=True)
+    await app['mongo'][config['database']['collection_stats']].create_index([('type', 1), ('created', -1)],
+                                                                            background=True)
 
     # graciously close mongo client on shutdown
     async def close_mongo(app):
@@ -3211,10 +4662,79 @@ async def app_factory():
 
     app.on_cleanup.append(close_mongo)
 
-    # Kowalski connection:
-    app['kowalski'] = Kowalski(protocol=config['kowalski']['protocol'],
-                               host=config['kowalski']['host'], port=config['kowalski']['port'],
-                               username=config['kowalski']['username'], password=config['kowalski']['password'])
+    # background executor for enqueued queries
+    app['query_queue'] = QueryQueue(app['mongo'],
+                                    num_workers=int(config['misc']['query_workers']),
+                                    max_queued_per_user=int(config['misc']['max_queued_queries_per_user']),
+                                    lease=float(config['misc']['query_lease']))
+
+    async def start_query_queue(app):
+        await app['query_queue'].start()
+
+    async def stop_query_queue(app):
+        await app['query_queue'].stop()
+
+    app.on_startup.append(start_query_queue)
+    app.on_shutdown.append(stop_query_queue)
+
+    # process pool for CPU-bound work (e.g. period search) that would otherwise block the event loop
+    app['process_pool'] = ProcessPoolExecutor(max_workers=int(config['misc']['process_pool_workers']))
+
+    async def shutdown_process_pool(app):
+        app['process_pool'].shutdown(wait=False)
+
+    app.on_cleanup.append(shutdown_process_pool)
+
+    # matplotlib plots are rendered in a separate bounded pool so that they do not compete with period searches
+    app['render_service'] = RenderService(max_workers=int(config['misc']['render_workers']),
+                                          max_concurrent=int(config['misc']['max_concurrent_renders']),
+                                          timeout=float(config['misc']['render_timeout']))
+
+    async def shutdown_render_service(app):
+        app['render_service'].shutdown()
+
+    app.on_cleanup.append(shutdown_render_service)
+
+    # PS1 cutouts, fetched over a shared client session and cached on disk
+    app['ps1'] = PS1Cutouts(DiskCache(config['path']['path_ps1_cache'],
+                                      max_bytes=int(config['misc']['ps1_cache_max_bytes'])),
+                            timeout=float(config['misc']['ps1_timeout']),
+                            max_concurrent=int(config['misc']['ps1_max_concurrent']))
+    await app['ps1'].start()
+
+    async def close_ps1(app):
+        await app['ps1'].close()
+
+    app.on_cleanup.append(close_ps1)
+
+    # background cache warming for saved sources
+    app['prefetch'] = PrefetchQueue(app,
+                                    num_workers=int(config['misc']['prefetch_workers']),
+                                    max_queued=int(config['misc']['prefetch_max_queued']),
+                                    slow_threshold=float(config['misc']['prefetch_slow_threshold']),
+                                    max_backoff=float(config['misc']['prefetch_max_backoff']))
+
+    async def start_prefetch(app):
+        await app['prefetch'].start()
+
+    async def stop_prefetch(app):
+        await app['prefetch'].stop()
+
+    app.on_startup.append(start_prefetch)
+    app.on_shutdown.append(stop_prefetch)
+
+    # Kowalski connections, used from a thread pool so that queries do not block the event loop
+    app['kowalski'] = KowalskiGateway(protocol=config['kowalski']['protocol'],
+                                      host=config['kowalski']['host'], port=config['kowalski']['port'],
+                                      username=config['kowalski']['username'],
+                                      password=config['kowalski']['password'],
+                                      max_workers=int(config['kowalski']['max_workers']),
+                                      timeout=float(config['kowalski']['timeout']))
+
+    async def shutdown_kowalski(app):
+        app['kowalski'].shutdown()
+
+    app.on_cleanup.append(shutdown_kowalski)
 
     # set up JWT for user authentication/authorization
     app['JWT'] = {'JWT_SECRET': config['server']['JWT_SECRET_KEY'],
@@ -3332,6 +4852,1039 @@ class TestAPIs(object):
         result = await resp.json()
         assert result['message'] == 'success'
 
+    # test running enqueued queries in the background
+    async def test_query_queue(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        async def wait_until_done(task_id):
+            for _ in range(100):
+                resp = await client.post('/query', json={'task_id': task_id}, headers=headers, timeout=1)
+                assert resp.status == 200
+                result = await resp.json()
+                if result['status'] in ('done', 'failed'):
+                    return result
+                await asyncio.sleep(0.1)
+            raise AssertionError(f'query {task_id} not done')
+
+        qu = {"query_type": "find_one",
+              "query": {"catalog": "programs", "filter": {'_id': 1}, "projection": {'_id': 1}},
+              "kwargs": {"enqueue_only": True, "_id": random_alphanumeric_str(32)}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        result = await resp.json()
+        assert result['status'] == 'enqueued'
+        task_id = result['query_id']
+
+        try:
+            result = await wait_until_done(task_id)
+            assert result['status'] == 'done'
+            assert result['result']['query_result'] == {'_id': 1}
+
+            # enqueueing the same query again does not duplicate it
+            resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+            assert (await resp.json())['status'] == 'done'
+            assert await client.app['mongo'].queries.count_documents({'task_id': task_id}) == 1
+
+            # a query left running by a dead worker is picked up again once its lease expires
+            await client.app['mongo'].queries.update_one({'task_id': task_id},
+                                                         {'$set': {'status': 'running', 'worker': 'dead',
+                                                                   'lease_until': utc_now() -
+                                                                   datetime.timedelta(seconds=1)}})
+            result = await wait_until_done(task_id)
+            assert result['status'] == 'done'
+            doc = await client.app['mongo'].queries.find_one({'task_id': task_id})
+            assert doc['worker'] == client.app['query_queue'].worker_id
+
+        finally:
+            resp = await client.delete('/query', json={'task_id': task_id}, headers=headers, timeout=1)
+            assert resp.status == 200
+
+    # test admission control of /query
+    async def test_admission_control(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        gate = asyncio.Event()
+        order = []
+
+        async def hold(admission, user):
+            async with admission.slot(user):
+                await gate.wait()
+
+        async def run(admission, user):
+            async with admission.slot(user):
+                order.append(user)
+
+        # a light user is not starved by a heavy one
+        admission = AdmissionController(max_concurrent=1, max_concurrent_per_user=1, max_queued=100, max_wait=5)
+        blocker = asyncio.ensure_future(hold(admission, 'heavy'))
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(run(admission, 'heavy')) for _ in range(4)] + \
+                [asyncio.ensure_future(run(admission, 'light')) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert admission.metrics()['queued_per_user'] == {'heavy': 4, 'light': 2}
+        gate.set()
+        await asyncio.gather(blocker, *tasks)
+        assert order == ['light', 'heavy', 'light', 'heavy', 'heavy', 'heavy']
+        assert admission.running == 0
+
+        # per-user cap
+        gate.clear()
+        admission = AdmissionController(max_concurrent=4, max_concurrent_per_user=2, max_queued=100, max_wait=5)
+        tasks = [asyncio.ensure_future(hold(admission, user)) for user in ('a', 'a', 'a', 'b')]
+        await asyncio.sleep(0)
+        assert admission.metrics()['running_per_user'] == {'a': 2, 'b': 1}
+        assert admission.metrics()['queued_per_user'] == {'a': 1}
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert admission.running == 0
+
+        # cancelled waiters do not take slots, whether they were admitted in the meantime or not
+        for admitted in (False, True):
+            gate.clear()
+            admission = AdmissionController(max_concurrent=1, max_concurrent_per_user=1, max_queued=100, max_wait=5)
+            blocker = asyncio.ensure_future(hold(admission, 'a'))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(hold(admission, 'b'))
+            await asyncio.sleep(0)
+            if admitted:
+                gate.set()
+                await blocker
+            waiter.cancel()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                pass
+            gate.set()
+            await blocker
+            assert admission.running == 0
+            assert len(admission.queue) == 0
+            async with admission.slot('c'):
+                assert admission.running == 1
+
+        # requests that do not fit into the queue or wait too long are rejected
+        gate.clear()
+        admission = AdmissionController(max_concurrent=1, max_concurrent_per_user=1, max_queued=1, max_wait=0.1)
+        blocker = asyncio.ensure_future(hold(admission, 'a'))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(run(admission, 'b'))
+        await asyncio.sleep(0)
+        for task in (run(admission, 'c'), waiter):
+            try:
+                await task
+                assert False, 'request not rejected'
+            except AdmissionRejected as _e:
+                assert _e.retry_after >= 1
+        assert admission.rejected == 2
+        assert len(admission.queue) == 0
+        gate.set()
+        await blocker
+
+        # rejected /query requests get Retry-After
+        client.app['admission'].max_queued = 0
+        qu = {"query_type": "find_one",
+              "query": {"catalog": "programs", "filter": {}}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 429
+        assert int(resp.headers['Retry-After']) >= 1
+
+    # test admission control metrics
+    async def test_metrics(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        qu = {"query_type": "find_one",
+              "query": {"catalog": "programs", "filter": {}}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+
+        resp = await client.get('/metrics', headers=headers, timeout=1)
+        assert resp.status == 200
+        result = await resp.json()
+        assert result['metrics']['admission']['admitted'] >= 1
+        assert result['metrics']['admission']['running'] == 0
+
+    # test timing out Kowalski calls
+    async def test_kowalski_timeout(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        resp = await client.get('/metrics', headers=headers, timeout=1)
+        assert resp.status == 200
+        before = (await resp.json())['metrics']
+
+        # a hung Kowalski call times out without blocking the event loop
+        class SlowKowalski(object):
+            def query(self, query):
+                time.sleep(0.5)
+                return {'status': 'success'}
+
+        client.app['kowalski'].client = lambda: SlowKowalski()
+        tic = time.time()
+        try:
+            await client.app['kowalski'].query({'query_type': 'info'}, _timeout=0.1)
+            assert False, 'Kowalski query did not time out'
+        except asyncio.TimeoutError:
+            pass
+        assert time.time() - tic < 0.5
+
+        resp = await client.get('/metrics', headers=headers, timeout=1)
+        assert resp.status == 200
+        after = (await resp.json())['metrics']
+        assert after['kowalski']['timeouts'] == before['kowalski']['timeouts'] + 1
+        assert after['kowalski']['calls'] == before['kowalski']['calls'] + 1
+
+    # test the penquins client used by the Kowalski gateway
+    async def test_kowalski_gateway(self, aiohttp_server):
+        queries = []
+
+        async def auth(request):
+            return web.json_response({'status': 'success', 'token': 'test_token'})
+
+        async def query(request):
+            queries.append(request.headers.get('Authorization', None))
+            # the first query hangs
+            if len(queries) == 1:
+                await asyncio.sleep(3)
+            return web.json_response({'status': 'success', 'data': {'n': len(queries)}})
+
+        kowalski = web.Application()
+        kowalski.router.add_post('/api/auth', auth)
+        kowalski.router.add_post('/api/queries', query)
+        kowalski_server = await aiohttp_server(kowalski)
+
+        gateway = KowalskiGateway(protocol='http', host='localhost', port=kowalski_server.port,
+                                  username='test', password='test', max_workers=1, timeout=1)
+        try:
+            # the client's request times out and is retried before the call does
+            tic = time.time()
+            resp = await gateway.query({'query_type': 'info', 'query': {'command': 'catalog_names'}}, _timeout=2.5)
+            assert time.time() - tic < 2.5
+            assert resp['data'] == {'n': 2}
+            assert queries == ['test_token', 'test_token']
+            assert gateway.metrics()['timeouts'] == 0
+            assert gateway.metrics()['failures'] == 0
+
+        finally:
+            gateway.shutdown()
+
+    # test serving plots from the render cache
+    async def test_render_cache(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        resp = await client.get('/metrics', headers=headers, timeout=1)
+        assert resp.status == 200
+        before = (await resp.json())['metrics']
+
+        # the second request for the same plot is served from the render cache
+        _id = f'test_{random_alphanumeric_str(8)}'
+        lc_data = [{'mjd': 58500.0 + i, 'mag': 17.0 + 0.1 * (i % 3), 'magerr': 0.02} for i in range(10)]
+        await client.app['mongo'].sources.insert_one({'_id': _id,
+                                                      'lc': [{'_id': 'lc_1', 'lc_type': 'temporal',
+                                                              'filter': 'zg', 'data': lc_data}],
+                                                      'last_modified': utc_now()})
+        try:
+            bodies = []
+            for _ in range(2):
+                resp = await client.get(f'/sources/{_id}/images/lc', headers=headers, timeout=10)
+                assert resp.status == 200
+                bodies.append(await resp.read())
+            assert len(bodies[0]) > 0
+            assert bodies[0] == bodies[1]
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+            client.app['render_cache'].invalidate(_id)
+
+        resp = await client.get('/metrics', headers=headers, timeout=1)
+        assert resp.status == 200
+        after = (await resp.json())['metrics']
+        assert after['render_cache']['hits'] == before['render_cache']['hits'] + 1
+        assert after['render_cache']['misses'] == before['render_cache']['misses'] + 1
+
+    # test rendering plots in worker processes
+    async def test_render_service(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        resp = await client.get('/metrics', headers=headers, timeout=1)
+        assert resp.status == 200
+        before = (await resp.json())['metrics']
+
+        _id = f'test_{random_alphanumeric_str(8)}'
+        lc_data = [{'mjd': 58500.0 + i, 'mag': 17.0 + 0.1 * (i % 3), 'magerr': 0.02} for i in range(10)]
+        await client.app['mongo'].sources.insert_one({'_id': _id,
+                                                      'lc': [{'_id': 'lc_1', 'lc_type': 'temporal',
+                                                              'filter': 'zg', 'data': lc_data}],
+                                                      'last_modified': utc_now()})
+        try:
+            resp = await client.get(f'/sources/{_id}/images/maghist', headers=headers, timeout=10)
+            assert resp.status == 200
+            assert len(await resp.read()) > 0
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+            client.app['render_cache'].invalidate(_id)
+
+        resp = await client.get('/metrics', headers=headers, timeout=1)
+        assert resp.status == 200
+        after = (await resp.json())['metrics']
+        assert after['render_service']['rendered'] == before['render_service']['rendered'] + 1
+        assert after['render_service']['in_flight'] == 0
+
+        # a render that timed out keeps its slot until the worker process is done with it
+        render_service = RenderService(max_workers=1, max_concurrent=1, timeout=0.5)
+        try:
+            # warm up the worker process
+            await render_service.render(time.sleep, 0)
+            try:
+                await render_service.render(time.sleep, 1)
+                assert False, 'render did not time out'
+            except asyncio.TimeoutError:
+                pass
+            assert render_service.timed_out == 1
+            assert render_service.in_flight == 0
+            assert render_service.semaphore.locked()
+            await asyncio.sleep(1)
+            assert not render_service.semaphore.locked()
+        finally:
+            render_service.shutdown()
+
+    # test caching of query results
+    async def test_query_cache(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        query_cache = client.app['query_cache']
+        prefix = f'test_{random_alphanumeric_str(8)}'
+
+        async def count(catalog='sources'):
+            qu = {"query_type": "count_documents",
+                  "query": {"catalog": catalog, "filter": {'_id': {'$regex': f'^{prefix}'}}},
+                  "kwargs": {"cache": True}
+                  }
+            resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+            assert resp.status == 200
+            result = await resp.json()
+            assert result['result']['status'] == 'done'
+            return result['result']['result_data']['query_result']
+
+        async def kowalski_query(query, _timeout=None):
+            # nothing to cross-match with
+            return {'data': {}}
+
+        client.app['kowalski'].query = kowalski_query
+
+        try:
+            assert await count() == 0
+            hits = query_cache.hits
+            assert await count() == 0
+            assert query_cache.hits == hits + 1
+
+            # a write made by another process is picked up once it bumps the collection version
+            await client.app['mongo'].sources.insert_one({'_id': f'{prefix}_1'})
+            assert await count() == 0
+            await bump_collection_version(client.app['mongo'], 'sources')
+            assert await count() == 1
+
+            # saving a source invalidates the results that depend on the sources
+            resp = await client.put('/sources', json={'ra': 10.0, 'dec': 20.0, 'zvm_program_id': 1,
+                                                      'naming': 'random', 'prefix': prefix,
+                                                      'return_result': False},
+                                    headers=headers, timeout=5)
+            assert resp.status == 200
+            assert (await resp.json())['message'] == 'success'
+            assert await count() == 2
+
+            # entries expire after ttl
+            query_cache.ttl = 0.1
+            query_cache.invalidate()
+            assert await count() == 2
+            misses = query_cache.misses
+            await asyncio.sleep(0.2)
+            assert await count() == 2
+            assert query_cache.misses == misses + 1
+
+            # the least recently used entry is evicted
+            query_cache.ttl = 60
+            query_cache.max_size = 2
+            await count('sources')
+            await count('programs')
+            await count('sources')
+            await count('queries')
+            assert len(query_cache) == 2
+            hits = query_cache.hits
+            await count('sources')
+            assert query_cache.hits == hits + 1
+            misses = query_cache.misses
+            await count('programs')
+            assert query_cache.misses == misses + 1
+
+        finally:
+            await client.app['mongo'].sources.delete_many({'_id': {'$regex': f'^{prefix}'}})
+
+    # test single light curve and spectrum endpoints
+    async def test_source_series(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        _id = f'test_{random_alphanumeric_str(8)}'
+        lc_data = [{'mjd': 58500.0 + i, 'mag': 17.0 + 0.1 * (i % 3), 'magerr': 0.02} for i in range(10)]
+        doc = {'_id': _id,
+               'lc': [{'_id': 'lc_1', 'lc_type': 'temporal', 'filter': 'zg', 'data': lc_data},
+                      {'_id': 'lc_2', 'lc_type': 'temporal', 'filter': 'zr', 'data_format': 'columnar',
+                       'data': pack_columns(lc_data)}],
+               'spec': [{'_id': 'spec_1', 'data': [{'wavelength': 5000.0 + i, 'flux': 1.0} for i in range(5)][::-1]}]}
+        await client.app['mongo'].sources.insert_one(doc)
+
+        try:
+            for lc_id in ('lc_1', 'lc_2'):
+                resp = await client.get(f'/sources/{_id}/lc/{lc_id}', headers=headers, timeout=1)
+                assert resp.status == 200
+                lc = await resp.json()
+                assert lc['_id'] == lc_id
+                assert lc['data'] == lc_data
+
+                resp = await client.get(f'/sources/{_id}/lc/{lc_id}', params={'format': 'web', 'max_points': 4},
+                                        headers=headers, timeout=1)
+                assert resp.status == 200
+                lc = await resp.json()
+                assert 0 < len(lc['data']['lc_det']['mag']) < len(lc_data)
+
+                resp = await client.get(f'/sources/{_id}/lc/{lc_id}', params={'format': 'web', 'max_points': 'all'},
+                                        headers=headers, timeout=1)
+                assert resp.status == 400
+
+            # no way around the cap
+            resp = await client.get(f'/sources/{_id}/lc/lc_1', params={'format': 'web', 'max_points': 0},
+                                    headers=headers, timeout=1)
+            assert resp.status == 200
+            lc = await resp.json()
+            assert 0 < len(lc['data']['lc_det']['mag']) < len(lc_data)
+
+            # light curves in the same filter are decimated together
+            await client.app['mongo'].sources.update_one({'_id': _id},
+                                                         {'$push': {'lc': {'_id': 'lc_4', 'lc_type': 'temporal',
+                                                                           'filter': 'zg', 'data': lc_data}}})
+            n_det = 0
+            for lc_id in ('lc_1', 'lc_4'):
+                resp = await client.get(f'/sources/{_id}/lc/{lc_id}', params={'format': 'web', 'max_points': 4},
+                                        headers=headers, timeout=1)
+                assert resp.status == 200
+                n_det += len((await resp.json())['data']['lc_det']['mag'])
+            assert n_det == 4
+
+            resp = await client.get(f'/sources/{_id}/spec/spec_1', params={'format': 'web'},
+                                    headers=headers, timeout=1)
+            assert resp.status == 200
+            spec = await resp.json()
+            assert spec['wavelength'] == sorted(spec['wavelength'])
+
+            resp = await client.get(f'/sources/{_id}/lc/lc_3', headers=headers, timeout=1)
+            assert resp.status == 404
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+
+    # test light curve statistics stored with uploaded and merged light curves
+    async def test_source_lc_stats(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        hjd = 2458500.0 + np.sort(np.random.uniform(0, 300, 50))
+        lc_data = [{'hjd': t, 'mag': 17 + 0.2 * np.sin(t), 'magerr': 0.02, 'catflags': 0 if i % 5 else 4,
+                    'programid': 2} for i, t in enumerate(hjd)]
+        stats = lc_stats(lc_data)
+        assert stats['n'] == 50
+        assert stats['n_flagged'] == 10
+        # same for columnar data
+        assert lc_stats(series_columns({'data_format': 'columnar', 'data': pack_columns(lc_data)})) == stats
+
+        async def kowalski_query(query, _timeout=None):
+            return {'data': [{'_id': 123456, 'ra': 10.0, 'dec': 20.0, 'filter': 1, 'data': lc_data}]}
+
+        client.app['kowalski'].query = kowalski_query
+
+        _id = f'test_{random_alphanumeric_str(8)}'
+        await client.app['mongo'].sources.insert_one({'_id': _id, 'lc': [], 'spec': [], 'history': []})
+
+        try:
+            resp = await client.post(f'/sources/{_id}',
+                                     json={'action': 'upload_lc',
+                                           'data': {'telescope': 'P48', 'instrument': 'other', 'filter': 1,
+                                                    'id': 1, 'lc_type': 'temporal', 'data': lc_data}},
+                                     headers=headers, timeout=5)
+            assert resp.status == 200
+            resp = await client.post(f'/sources/{_id}', json={'action': 'merge', '_id': 123456},
+                                     headers=headers, timeout=5)
+            assert resp.status == 200
+
+            source = await client.app['mongo'].sources.find_one({'_id': _id})
+            assert [lc['instrument'] for lc in source['lc']] == ['other', 'ZTF']
+            for lc in source['lc']:
+                assert lc['stats'] == stats
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+
+    # test conditional GET for sources
+    async def test_source_conditional_get(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        _id = f'test_{random_alphanumeric_str(8)}'
+        await client.app['mongo'].sources.insert_one({'_id': _id, 'lc': [], 'spec': [],
+                                                      'last_modified': utc_now()})
+
+        try:
+            resp = await client.get(f'/sources/{_id}', params={'format': 'json'}, headers=headers, timeout=1)
+            assert resp.status == 200
+            etag = resp.headers['ETag']
+            assert 'Last-Modified' in resp.headers
+
+            resp = await client.get(f'/sources/{_id}', params={'format': 'json'},
+                                    headers={**headers, 'If-None-Match': etag}, timeout=1)
+            assert resp.status == 304
+
+            # representations are validated separately
+            resp = await client.get(f'/sources/{_id}', params={'format': 'json', 'v': 1},
+                                    headers={**headers, 'If-None-Match': etag}, timeout=1)
+            assert resp.status == 200
+
+            # source updates invalidate
+            await client.app['mongo'].sources.update_one({'_id': _id},
+                                                         {'$set': {'last_modified': utc_now() +
+                                                                   datetime.timedelta(seconds=1)}})
+            resp = await client.get(f'/sources/{_id}', params={'format': 'json'},
+                                    headers={**headers, 'If-None-Match': etag}, timeout=1)
+            assert resp.status == 200
+            assert resp.headers['ETag'] != etag
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+
+    # test PS1 cutouts against a local stand-in for STScI
+    async def test_source_ps1(self, aiohttp_client, aiohttp_server):
+        calls = {'filenames': 0, 'fitscut': 0}
+        png = b'\x89PNG\r\n\x1a\n' + os.urandom(64)
+
+        async def filenames(request):
+            calls['filenames'] += 1
+            await asyncio.sleep(0.5)
+            rows = [f"2 3 {request.query['ra']} {request.query['dec']} {f} 58000.0 stack "
+                    f"/rings.v3.skycell/1234/056/rings.v3.skycell.1234.056.stk.{f}.unconv.fits "
+                    f"rings.v3.skycell.1234.056.stk.{f}.unconv.fits 0" for f in 'grizy']
+            return web.Response(text='\n'.join(['projcell subcell ra dec filter mjd type filename shortname badflag']
+                                               + rows))
+
+        async def fitscut(request):
+            calls['fitscut'] += 1
+            assert '.y.' in request.query['red']
+            return web.Response(body=png, content_type='image/png')
+
+        stsci = web.Application()
+        stsci.router.add_get('/ps1filenames.py', filenames)
+        stsci.router.add_get('/fitscut.cgi', fitscut)
+        stsci_server = await aiohttp_server(stsci)
+
+        client = await aiohttp_client(await app_factory())
+        client.app['ps1'].source = str(stsci_server.make_url('/'))
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        # random position so that nothing is cached from previous runs
+        _id = f'test_{random_alphanumeric_str(8)}'
+        await client.app['mongo'].sources.insert_one({'_id': _id, 'ra': np.random.uniform(0, 360),
+                                                      'dec': np.random.uniform(-30, 90),
+                                                      'last_modified': utc_now()})
+
+        try:
+            # identical concurrent requests are coalesced
+            responses = await asyncio.gather(*[client.get(f'/sources/{_id}/images/ps1', headers=headers, timeout=5)
+                                       for _ in range(3)])
+            for resp in responses:
+                assert resp.status == 200
+                assert await resp.read() == png
+            assert calls == {'filenames': 1, 'fitscut': 1}
+
+            # then served from disk
+            resp = await client.get(f'/sources/{_id}/images/ps1', headers=headers, timeout=1)
+            assert resp.status == 200
+            assert await resp.read() == png
+            assert calls == {'filenames': 1, 'fitscut': 1}
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+
+    # test warming caches for a program
+    async def test_program_prefetch(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        program_id = random.randint(10**6, 10**7)
+        lc_data = [{'hjd': 2458200.0 + i, 'mag': 17.0 + 0.1 * np.sin(i), 'magerr': 0.02, 'catflags': 0}
+                   for i in range(50)]
+        _id = f'test_{random_alphanumeric_str(8)}'
+        await client.app['mongo'].sources.insert_one({'_id': _id, 'zvm_program_id': program_id,
+                                                      'lc': [{'_id': 'lc_1', 'filter': 'zg', 'data': lc_data}],
+                                                      'last_modified': utc_now()})
+
+        try:
+            resp = await client.post(f'/programs/{program_id}/prefetch', headers=headers, timeout=1)
+            assert resp.status == 200
+            result = await resp.json()
+            assert result['result']['num_enqueued'] == 1
+
+            await asyncio.wait_for(client.app['prefetch'].queue.join(), 30)
+            assert client.app['prefetch'].done >= 1
+
+            # served from the render cache
+            hits = client.app['render_cache'].hits
+            path = '/sources/{}/images/lc?{}'.format(_id, config['misc']['prefetch_lc_plots'][0])
+            resp = await client.get(path, headers=headers, timeout=1)
+            assert resp.status == 200
+            assert client.app['render_cache'].hits == hits + 1
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+
+    # test batch light curve thumbnails
+    async def test_sparklines(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        lc_data = [{'hjd': 2458200.0 + i, 'mag': 17.0 + 0.1 * np.sin(i), 'magerr': 0.02, 'catflags': 0}
+                   for i in range(50)]
+        _ids = [f'test_{random_alphanumeric_str(8)}' for _ in range(2)]
+        await client.app['mongo'].sources.insert_many([
+            {'_id': _ids[0], 'lc': [{'_id': 'lc_1', 'filter': 'zg', 'data': lc_data}]},
+            {'_id': _ids[1], 'lc': [{'_id': 'lc_1', 'filter': 'zr', 'data_format': 'columnar',
+                                     'data': pack_columns(lc_data)}]}])
+
+        try:
+            # unknown sources get blank thumbnails
+            resp = await client.post('/images/sparklines', json={'source_ids': _ids + ['nope'], 'w': 100, 'h': 20},
+                                     headers=headers, timeout=5)
+            assert resp.status == 200
+            assert resp.content_type == 'image/png'
+            assert resp.headers['X-Sprite-Height'] == '20'
+            png = await resp.read()
+            # PNG IHDR: width and height
+            assert int.from_bytes(png[16:20], 'big') == 100
+            assert int.from_bytes(png[20:24], 'big') == 60
+
+            resp = await client.post('/images/sparklines',
+                                     json={'source_ids': ['nope'] * (config['misc']['sparklines_max_sources'] + 1)},
+                                     headers=headers, timeout=5)
+            assert resp.status == 500
+
+        finally:
+            await client.app['mongo'].sources.delete_many({'_id': {'$in': _ids}})
+
+    # test period search
+    async def test_source_periodogram(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        period = 0.3123
+        hjd = 2458200.0 + np.sort(np.random.uniform(0, 500, 300))
+        mag = 17 + 0.3 * np.sin(2 * np.pi * hjd / period) + np.random.normal(0, 0.02, 300)
+        lc_data = [{'hjd': t, 'mag': m, 'magerr': 0.02, 'catflags': 0} for t, m in zip(hjd, mag)]
+
+        _id = f'test_{random_alphanumeric_str(8)}'
+        await client.app['mongo'].sources.insert_one({'_id': _id, 'history': [],
+                                                      'lc': [{'_id': 'lc_1', 'lc_type': 'temporal', 'filter': 'zg',
+                                                              'data': lc_data[:150]},
+                                                             {'_id': 'lc_2', 'lc_type': 'temporal', 'filter': 'zg',
+                                                              'data_format': 'columnar',
+                                                              'data': pack_columns(lc_data[150:])}]})
+
+        try:
+            resp = await client.get(f'/sources/{_id}/periodogram', params={'f_max': 10, 'n_freq': 100000},
+                                    headers=headers, timeout=10)
+            assert resp.status == 200
+            result = await resp.json()
+            results = result['period_search']['results']
+            # both light curves merged
+            assert len(results) == 1
+            assert results[0]['n'] == 300
+            assert abs(results[0]['peaks'][0]['period'] - period) < 1e-3
+            assert len(results[0]['periodogram']['power']) > 0
+
+            resp = await client.post(f'/sources/{_id}/periodogram',
+                                     json={'method': 'ce', 'f_max': 10, 'n_freq': 100000, 'save': True},
+                                     headers=headers, timeout=10)
+            assert resp.status == 200
+            source = await client.app['mongo'].sources.find_one({'_id': _id})
+            assert abs(source['period_search']['ce']['results'][0]['peaks'][0]['period'] - period) < 1e-3
+
+            resp = await client.get(f'/sources/{_id}/periodogram', params={'method': 'fft'},
+                                    headers=headers, timeout=10)
+            assert resp.status == 500
+
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+
+    # test keyset pagination over a sort key with null and missing values
+    async def test_query_keyset_pagination(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        catalog = f'test_{random_alphanumeric_str(8)}'
+        docs = [{'_id': f'doc_{i:02d}', 'mag': [None, 15.5, 14, 15.5][i % 4]} for i in range(12)] + \
+               [{'_id': f'doc_{i:02d}'} for i in range(12, 17)]
+        # mongodb sorts null and missing values before numbers
+        order = sorted(docs, key=lambda d: (d.get('mag', None) is not None, d.get('mag', None) or 0, d['_id']))
+
+        try:
+            await client.app['mongo'][catalog].insert_many(docs)
+
+            for sort_direction, expected in ((1, order), (-1, order[::-1])):
+                for page_size in (1, 3, 4):
+                    qu = {"query_type": "find",
+                          "query": {"catalog": catalog, "filter": {}, "projection": {'_id': 1}},
+                          "kwargs": {"page_size": page_size, "sort_key": "mag", "sort_direction": sort_direction}
+                          }
+                    ids = []
+                    while True:
+                        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+                        assert resp.status == 200
+                        result = await resp.json()
+                        assert result['result']['status'] == 'done'
+                        ids += [doc['_id'] for doc in result['result']['result_data']['query_result']]
+                        if result['result']['result_data']['next_cursor'] is None:
+                            break
+                        qu['kwargs']['cursor'] = result['result']['result_data']['next_cursor']
+
+                    assert ids == [doc['_id'] for doc in expected]
+
+        finally:
+            await client.app['mongo'][catalog].drop()
+
+    # test that batched cone search returns the same matches as per-object queries
+    async def test_query_cone_search_batched(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        catalog = f'test_{random_alphanumeric_str(8)}'
+        radius = 10 * np.pi / 180.0 / 3600.
+
+        def offset(ra, dec, distance, bearing):
+            # point at distance [rad] from (ra, dec) [deg] along bearing [rad], as geojson-friendly lon, lat
+            lat1, lon1 = dec * np.pi / 180, ra * np.pi / 180
+            lat2 = np.arcsin(np.sin(lat1) * np.cos(distance) + np.cos(lat1) * np.sin(distance) * np.cos(bearing))
+            lon2 = lon1 + np.arctan2(np.sin(bearing) * np.sin(distance) * np.cos(lat1),
+                                     np.cos(distance) - np.sin(lat1) * np.sin(lat2))
+            return (lon2 * 180 / np.pi) % 360 - 180, lat2 * 180 / np.pi
+
+        rng = np.random.RandomState(42)
+        # a crowded patch where cones overlap, plus positions next to ra = 0 and the pole
+        objects = {f'obj_{i}': (120 + rng.uniform(0, 0.01), 30 + rng.uniform(0, 0.01)) for i in range(20)}
+        objects['obj_ra0'] = (0.0001, -10)
+        objects['obj_pole'] = (45, 89.9999)
+
+        docs, expected = [], {obj: set() for obj in objects}
+        for obj, (ra, dec) in objects.items():
+            # just inside and just outside of the cone, and some around it
+            distances = np.hstack([radius * (1 - 1e-6) * np.ones(4), radius * (1 + 1e-6) * np.ones(4),
+                                   rng.uniform(0, 2 * radius, 8)])
+            for distance in distances:
+                lon, lat = offset(ra, dec, distance, rng.uniform(0, 2 * np.pi))
+                docs.append({'_id': f'{obj}_{len(docs)}',
+                             'coordinates': {'radec_geojson': {'type': 'Point', 'coordinates': [lon, lat]}}})
+        for doc in docs:
+            lon, lat = doc['coordinates']['radec_geojson']['coordinates']
+            for obj, (ra, dec) in objects.items():
+                if great_circle_distance(dec * np.pi / 180, (ra - 180) * np.pi / 180,
+                                         lat * np.pi / 180, lon * np.pi / 180) <= radius:
+                    expected[obj].add(doc['_id'])
+
+        try:
+            await client.app['mongo'][catalog].create_index([('coordinates.radec_geojson', '2dsphere')])
+            await client.app['mongo'][catalog].insert_many(docs)
+
+            results = dict()
+            for engine in ('per_object', 'batched'):
+                qu = {"query_type": "cone_search",
+                      "object_coordinates": {"radec": objects, "cone_search_radius": 10,
+                                             "cone_search_unit": "arcsec"},
+                      "catalogs": {catalog: {"filter": {}, "projection": {'_id': 1}}},
+                      "kwargs": {"cone_search_engine": engine}
+                      }
+                resp = await client.put('/query', json=qu, headers=headers, timeout=5)
+                assert resp.status == 200
+                result = await resp.json()
+                assert result['result']['status'] == 'done'
+                results[engine] = {obj: {doc['_id'] for doc in _select} for obj, _select in
+                                   result['result']['result_data']['query_result'][catalog].items()}
+
+            for obj in objects:
+                assert results['batched'][obj] == results['per_object'][obj] == expected[obj]
+
+        finally:
+            await client.app['mongo'][catalog].drop()
+
+    # test general_search query language
+    async def test_query_general_search(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        # compiled to a find query
+        qu = {"query_type": "general_search",
+              "query": "db['programs'].find({'_id': {'$gte': 1}}, {'_id': 1}).sort('_id', 1).limit(1)"
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        result = await resp.json()
+        assert result['result']['status'] == 'done'
+        assert result['result']['result_data']['query_result'] == [{'_id': 1}]
+
+        # executed as general_search
+        qu = {"query_type": "general_search",
+              "query": "db['programs'].distinct('_id')"
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        result = await resp.json()
+        assert 1 in result['result']['result_data']['query_result']
+
+        # non-ascii literals are passed through as is
+        _id = f'test_{random_alphanumeric_str(8)}'
+        await client.app['mongo'].sources.insert_one({'_id': _id, 'labels': ['Céphéide']})
+        try:
+            qu = {"query_type": "general_search",
+                  "query": f"db['sources'].find({{'_id': '{_id}', 'labels': 'Céphéide'}}, {{'labels': 1}})"
+                  }
+            resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+            assert resp.status == 200
+            result = await resp.json()
+            assert result['result']['result_data']['query_result'] == [{'_id': _id, 'labels': ['Céphéide']}]
+        finally:
+            await client.app['mongo'].sources.delete_one({'_id': _id})
+
+        # not in the grammar
+        for query in ("db['programs'].drop()",
+                      "db['programs'].find({}).delete()",
+                      "__import__('os').getcwd()"):
+            resp = await client.put('/query', json={"query_type": "general_search", "query": query},
+                                    headers=headers, timeout=1)
+            assert resp.status == 500
+
+    # test streaming query API
+    async def test_query_stream(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        qu = {"query_type": "find",
+              "query": {"catalog": "programs", "filter": {}, "projection": {'_id': 1}},
+              "kwargs": {"stream": True}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        assert resp.headers['Content-Type'].startswith('application/x-ndjson')
+
+        lines = [loads(line) for line in (await resp.text()).splitlines() if len(line) > 0]
+        # master program is always there
+        assert {'data': {'_id': 1}} in lines
+        assert lines[-1]['status'] == 'done'
+        assert lines[-1]['count'] == len(lines) - 1
+
+    async def test_query_format(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        qu = {"query_type": "find",
+              "query": {"catalog": "programs", "filter": {}, "projection": {'_id': 1}},
+              "kwargs": {"format": "msgpack"}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        assert resp.headers['Content-Type'].startswith('application/x-msgpack')
+        result = msgpack.unpackb(await resp.read(), raw=False)
+        assert result['result']['status'] == 'done'
+        assert {'_id': 1} in result['result']['result_data']['query_result']
+
+        qu['kwargs']['format'] = 'arrow'
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        assert resp.headers['Content-Type'].startswith('application/vnd.apache.arrow.stream')
+        table = pa.ipc.open_stream(await resp.read()).read_all()
+        assert 1 in table.column('_id').to_pylist()
+
+        # arrow is for tabular results only
+        qu = {"query_type": "count_documents",
+              "query": {"catalog": "programs", "filter": {}},
+              "kwargs": {"format": "arrow"}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 500
+
+    async def test_query_slow_queries(self, aiohttp_client, monkeypatch):
+        client = await aiohttp_client(await app_factory())
+
+        auth = await client.post(f'/auth',
+                                 json={"username": config['server']['admin_username'],
+                                       "password": config['server']['admin_password']})
+        assert auth.status == 200
+        credentials = await auth.json()
+        headers = {'Authorization': credentials['token']}
+
+        # every query is slow now
+        monkeypatch.setitem(config['misc'], 'slow_query_threshold_ms', 1e-6)
+        stats = client.app['mongo'][config['database']['collection_stats']]
+        name = f'test_{random_alphanumeric_str(8)}'
+
+        qu = {"query_type": "find",
+              "query": {"catalog": "programs", "filter": {'name': name}, "projection": {'_id': 1}}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        assert (await resp.json())['result']['status'] == 'done'
+
+        try:
+            # the record is written in the background
+            await asyncio.gather(*slow_query_tasks)
+            record = await stats.find_one({'type': 'slow_query', 'query': {'$regex': name}})
+            assert record is not None
+            assert record['query_type'] == 'find'
+            assert record['collections'] == ['programs']
+            assert record['elapsed_ms'] > 0
+            assert record['n_results'] == 0
+            assert len(record['plan_stages']) > 0
+            # there is no index on name
+            assert record['collscan'] is True
+
+        finally:
+            await stats.delete_many({'type': 'slow_query', 'query': {'$regex': name}})
+
+        qu = {"query_type": "info",
+              "query": {"command": "slow_queries", "limit": 5}
+              }
+        resp = await client.put('/query', json=qu, headers=headers, timeout=1)
+        assert resp.status == 200
+        result = await resp.json()
+        assert result['result']['status'] == 'done'
+        assert isinstance(result['result']['result_data']['query_result'], list)
+        assert len(result['result']['result_data']['query_result']) <= 5
+
 
 if __name__ == '__main__':
 
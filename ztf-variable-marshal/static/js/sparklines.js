@@ -0,0 +1,61 @@
+/*
+    Light curve thumbnails for many sources with a single request to /images/sparklines:
+    the server returns a sprite sheet with one w x h thumbnail per source, stacked vertically
+    in the order of the requested ids, which are shown as backgrounds of the placeholder elements.
+
+    usage: <div class="sparkline" data-source-id="ZTFJ..."></div>
+           loadSparklines(document.querySelectorAll('.sparkline'), 120, 24);
+
+    each call replaces the previous set of sparklines (pages call it again on every table sort, page or search),
+    so the sprite sheets of the previous set are released and its requests still in flight are ignored.
+*/
+const SPARKLINES_PER_REQUEST = 200;
+
+// object URLs of the sprite sheets of the current set
+let sparklineUrls = [];
+let sparklineGeneration = 0;
+
+function loadSparklines(elements, w, h) {
+    elements = Array.prototype.slice.call(elements);
+
+    sparklineUrls.forEach(function (url) { URL.revokeObjectURL(url); });
+    sparklineUrls = [];
+    sparklineGeneration += 1;
+
+    // the server caps the number of sources per request
+    for (let start = 0; start < elements.length; start += SPARKLINES_PER_REQUEST) {
+        loadSparklineSprite(elements.slice(start, start + SPARKLINES_PER_REQUEST), w, h, sparklineGeneration);
+    }
+}
+
+function loadSparklineSprite(elements, w, h, generation) {
+    let source_ids = elements.map(function (el) { return el.getAttribute('data-source-id'); });
+
+    fetch('/images/sparklines', {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({source_ids: source_ids, w: w, h: h})
+    }).then(function (response) {
+        if (!response.ok) {
+            throw new Error('failed to load sparklines: ' + response.status);
+        }
+        return response.blob();
+    }).then(function (blob) {
+        if (generation !== sparklineGeneration) {
+            // superseded by a later call
+            return;
+        }
+        let url = URL.createObjectURL(blob);
+        sparklineUrls.push(url);
+        elements.forEach(function (el, i) {
+            el.style.width = w + 'px';
+            el.style.height = h + 'px';
+            el.style.backgroundImage = 'url(' + url + ')';
+            el.style.backgroundPosition = '0px ' + (-i * h) + 'px';
+            el.style.backgroundRepeat = 'no-repeat';
+        });
+    }).catch(function (error) {
+        console.log(error);
+    });
+}
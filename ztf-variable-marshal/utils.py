@@ -1,8 +1,14 @@
+import ast
+import asyncio
+import copy
+import functools
 import hashlib
+import os
 import random
 import string
 import secrets
 import math
+import time
 # import aiohttp
 import io
 import requests
@@ -14,8 +20,11 @@ import base64
 import bcrypt
 
 from string import ascii_lowercase
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
 import itertools
 from numba import jit
+from bson import Binary, ObjectId, Decimal128, Int64, Regex
 from bson.json_util import dumps
 
 
@@ -51,6 +60,66 @@ def great_circle_distance(phi1, lambda1, phi2, lambda2):
                       np.sin(phi1) * np.sin(phi2) + np.cos(phi1) * np.cos(phi2) * np.cos(delta_lambda))
 
 
+def sky_tiles(lon, lat, tile_size: float = 1.0, max_positions: int = 256):
+    """
+        Group sky positions into tiles of roughly tile_size x tile_size degrees
+    :param lon: longitudes [deg]
+    :param lat: latitudes [deg]
+    :param tile_size: tile side [deg]
+    :param max_positions: max number of positions per tile; crowded tiles are split
+    :return: list of arrays with indices of positions in each tile
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+
+    if lon.size == 0:
+        return []
+
+    # declination bands, then ra bins of equal area within a band
+    band = np.floor((lat + 90.0) / tile_size)
+    band_center = np.deg2rad(np.clip((band + 0.5) * tile_size - 90.0, -90.0, 90.0))
+    num_ra_bins = np.maximum(1, np.floor(360.0 * np.cos(band_center) / tile_size))
+    ra_bin = np.minimum(np.floor(np.mod(lon + 180.0, 360.0) / 360.0 * num_ra_bins), num_ra_bins - 1)
+
+    keys = band * (np.floor(360.0 / tile_size) + 1) + ra_bin
+    order = np.argsort(keys, kind='stable')
+    _, starts = np.unique(keys[order], return_index=True)
+
+    tiles = []
+    for tile in np.split(order, starts[1:]):
+        tiles += [tile[i:i + max_positions] for i in range(0, len(tile), max_positions)]
+
+    return tiles
+
+
+def cone_search_matches(lon, lat, position_lon, position_lat, radius):
+    """
+        Vectorized cone search assignment
+
+        Uses the same containment test as MongoDB's $centerSphere (an S2 cap): an object is inside if the squared
+        chord between the unit vectors is at most 4 sin^2(radius/2). Results agree with the server up to rounding
+        in sin/cos, i.e. they may only differ for objects within ~1e-15 rad of the cone edge
+    :param lon: object longitudes [deg]
+    :param lat: object latitudes [deg]
+    :param position_lon: cone center longitudes [deg]
+    :param position_lat: cone center latitudes [deg]
+    :param radius: cone search radius [rad]
+    :return: boolean matrix [len(lon), len(position_lon)], True where object lies within radius from cone center
+    """
+    def unit_vectors(_lon, _lat):
+        _lon = np.deg2rad(np.asarray(_lon, dtype=np.float64))
+        _lat = np.deg2rad(np.asarray(_lat, dtype=np.float64))
+        return np.cos(_lon) * np.cos(_lat), np.sin(_lon) * np.cos(_lat), np.sin(_lat)
+
+    x, y, z = (c[:, np.newaxis] for c in unit_vectors(lon, lat))
+    cx, cy, cz = (c[np.newaxis, :] for c in unit_vectors(position_lon, position_lat))
+
+    d = np.sin(0.5 * radius)
+    chord2 = (x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2
+
+    return chord2 <= 2 * (2 * d * d)
+
+
 # @jit(forceobj=True)
 def deg2hms(x):
     """Transform degrees to *hours:minutes:seconds* strings.
@@ -403,6 +472,931 @@ def compute_hash(_task):
     return hsh
 
 
+class QueryCache(object):
+    """
+        Size-bounded LRU cache with a TTL for query results.
+        Entries are tagged with the collections they were computed from for invalidation.
+
+        The cache is per process, so writes made by other processes are tracked with per-collection version counters
+        (kept in the database and bumped on every write): entries remember the versions of their collections
+        at the time they were computed and are dropped on get if any of them has changed since
+    """
+    def __init__(self, max_size: int = 256, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expiration time, collections or None if depends on all of them, versions, value)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def select_versions(collections, versions):
+        if collections is None:
+            return dict(versions)
+        return {collection: versions.get(collection, 0) for collection in collections}
+
+    def get(self, key, versions=None):
+        """
+        :param key:
+        :param versions: current {collection: version}, versions are not checked if None
+        :return: cached value or None
+        """
+        entry = self.entries.get(key, None)
+        if (entry is None) or (entry[0] < time.monotonic()) or \
+                ((versions is not None) and (self.select_versions(entry[1], versions) != entry[2])):
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[3]
+
+    def put(self, key, value, collections=None, versions=None):
+        """
+        :param key:
+        :param value:
+        :param collections: collections value depends on, all of them if None
+        :param versions: {collection: version} read before value was computed
+        :return:
+        """
+        collections = frozenset(collections) if collections is not None else None
+        self.entries[key] = (time.monotonic() + self.ttl,
+                             collections,
+                             self.select_versions(collections, versions or dict()),
+                             value)
+        self.entries.move_to_end(key)
+        # evict least recently used entries
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, collection=None):
+        """
+            Drop entries that depend on collection, or everything if collection is None
+        """
+        if collection is None:
+            self.entries.clear()
+            return
+
+        for key in [k for k, (_, c, _, _) in self.entries.items() if (c is None) or (collection in c)]:
+            del self.entries[key]
+
+
+class DiskCache(object):
+    """
+        Size-bounded LRU cache of small binary blobs (e.g. rendered images) on disk, shared by all app processes.
+        Meant for a local disk or /dev/shm, so file operations are not offloaded from the event loop.
+
+        Files are named <namespace hash>.<key hash>, recency is tracked with the file modification times.
+        Each process keeps an index of the files it knows about; when its estimate of the bytes in use
+        exceeds max_bytes, it rescans the directory and evicts the least recently used files
+        down to low_watermark * max_bytes
+    """
+    def __init__(self, path: str, max_bytes: int = 256 * 2**20, low_watermark: float = 0.8):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+
+        os.makedirs(self.path, exist_ok=True)
+        # file name -> size
+        self.index = dict()
+        self.bytes = 0
+        self.scan()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def file_name(self, namespace, key):
+        return f'{compute_hash(str(namespace))}.{compute_hash(str(key))}'
+
+    def scan(self):
+        """
+            Rebuild index from the directory
+        :return: [(mtime, file name, size)] sorted by mtime
+        """
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+        files.sort()
+
+        self.index = {name: size for _, name, size in files}
+        self.bytes = sum(self.index.values())
+
+        return files
+
+    def evict(self):
+        """
+            Remove least recently used files until bytes in use are below low_watermark * max_bytes
+        """
+        files = self.scan()
+        for _, name, size in files:
+            if self.bytes <= self.low_watermark * self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            self.index.pop(name, None)
+            self.bytes -= size
+
+    def get(self, namespace, key):
+        """
+            Get cached blob, None if not in cache
+        """
+        name = self.file_name(namespace, key)
+        file_path = os.path.join(self.path, name)
+        try:
+            with open(file_path, 'rb') as f:
+                value = f.read()
+            # mark as recently used
+            os.utime(file_path)
+        except FileNotFoundError:
+            self.index.pop(name, None)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def put(self, namespace, key, value: bytes):
+        name = self.file_name(namespace, key)
+        file_path = os.path.join(self.path, name)
+        # write to a temporary file first so that other processes never read partial files
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, file_path)
+
+        self.bytes += len(value) - self.index.get(name, 0)
+        self.index[name] = len(value)
+        if self.bytes > self.max_bytes:
+            self.evict()
+
+    def invalidate(self, namespace):
+        """
+            Drop all entries in namespace
+        """
+        prefix = f'{compute_hash(str(namespace))}.'
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(prefix):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                self.bytes -= self.index.pop(entry.name, 0)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.index),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else None,
+                'evictions': self.evictions}
+
+
+class AdmissionRejected(Exception):
+    """
+        Request could not be admitted; retry_after is the suggested back-off in seconds
+    """
+    def __init__(self, message, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    """
+        Cap the number of concurrently running requests per user and globally.
+
+        Excess requests wait in a weighted fair queue: request i of a user gets the virtual finish tag
+            F_i = max(V, F_{i-1}) + cost / weight(user),
+        where V is the virtual time (start tag of the last admitted request), and whenever a slot frees up
+        the waiting request with the smallest tag whose user is under the per-user cap is admitted.
+        Users firing many requests thus get their tags pushed into the future and cannot starve others.
+        Requests that have waited for max_wait seconds or do not fit into the queue are rejected.
+    """
+    def __init__(self, max_concurrent: int = 64, max_concurrent_per_user: int = 4,
+                 max_queued: int = 1000, max_wait: float = 30.0, weights: dict = None):
+        self.max_concurrent = max_concurrent
+        self.max_concurrent_per_user = max_concurrent_per_user
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.weights = weights if weights is not None else dict()
+
+        self.running = 0
+        self.running_per_user = dict()
+        # waiting requests: [finish tag, sequence number, start tag, user, future]
+        self.queue = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.last_finish = dict()
+
+        # metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        # moving average of the time requests hold a slot, used for Retry-After hints
+        self.service_time = 1.0
+
+    def can_run(self, user):
+        return (self.running < self.max_concurrent) and \
+               (self.running_per_user.get(user, 0) < self.max_concurrent_per_user)
+
+    def retry_after(self):
+        return max(1, int(math.ceil(self.service_time * (len(self.queue) + 1) / self.max_concurrent)))
+
+    def dispatch(self):
+        """
+            Admit waiting requests in the order of their finish tags while there are free slots
+        """
+        for entry in sorted(self.queue):
+            if self.running >= self.max_concurrent:
+                break
+            finish, _, start, user, future = entry
+            if future.done():
+                # cancelled while waiting
+                self.queue.remove(entry)
+            elif self.can_run(user):
+                self.queue.remove(entry)
+                self.virtual_time = max(self.virtual_time, start)
+                self.running += 1
+                self.running_per_user[user] = self.running_per_user.get(user, 0) + 1
+                future.set_result(True)
+
+    def release(self, user, service_time: float):
+        self.running -= 1
+        self.running_per_user[user] -= 1
+        if self.running_per_user[user] == 0:
+            del self.running_per_user[user]
+        self.service_time = 0.9 * self.service_time + 0.1 * service_time
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user, cost: float = 1.0):
+        """
+            Wait for a slot for user's request, use with "async with"
+        :param user:
+        :param cost: relative cost of the request
+        :return:
+        """
+        if len(self.queue) >= self.max_queued:
+            self.rejected += 1
+            raise AdmissionRejected('too many queued requests', retry_after=self.retry_after())
+
+        start = max(self.virtual_time, self.last_finish.get(user, 0.0))
+        finish = start + cost / float(self.weights.get(user, 1.0))
+        self.last_finish[user] = finish
+
+        future = asyncio.get_event_loop().create_future()
+        entry = [finish, next(self.sequence), start, user, future]
+        self.queue.append(entry)
+        self.dispatch()
+
+        tic = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # admitted right before the request got cancelled?
+            if future.done() and not future.cancelled():
+                self.release(user, 0.0)
+            raise
+        finally:
+            if entry in self.queue:
+                self.queue.remove(entry)
+
+        if future.cancelled():
+            self.rejected += 1
+            raise AdmissionRejected(f'request not admitted within {self.max_wait} seconds',
+                                    retry_after=self.retry_after())
+
+        wait_time = time.monotonic() - tic
+        self.admitted += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+
+        tic = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user, time.monotonic() - tic)
+
+    def metrics(self):
+        return {'running': self.running,
+                'queued': len(self.queue),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'wait_time_avg': self.wait_time_total / self.admitted if self.admitted > 0 else 0.0,
+                'wait_time_max': self.wait_time_max,
+                'service_time_avg': self.service_time,
+                'running_per_user': dict(self.running_per_user),
+                'queued_per_user': dict(Counter(entry[3] for entry in self.queue))}
+
+
+async def gather_with_concurrency(n: int, *coros):
+    """
+        Await coroutines concurrently running at most n of them at a time
+    :param n: concurrency cap
+    :param coros: coroutines
+    :return: list of results in the order of coros
+    """
+    semaphore = asyncio.Semaphore(n)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+def records_to_columns(records):
+    """
+        Convert a list of dicts (e.g. light curve data points) into columns:
+        typed numpy arrays for numeric fields and lists for everything else.
+        Missing values in numeric fields are set to nan
+    :param records:
+    :return: dict field name -> column
+    """
+    keys = dict()
+    for record in records:
+        for key in record:
+            keys[key] = None
+
+    columns = dict()
+    for key in keys:
+        values = [record.get(key, None) for record in records]
+        if all((isinstance(v, (int, np.integer)) and not isinstance(v, bool)) for v in values):
+            columns[key] = np.array(values, dtype=np.int64)
+        elif all((v is None) or (isinstance(v, (int, float, np.number)) and not isinstance(v, bool))
+                 for v in values):
+            columns[key] = np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+        else:
+            columns[key] = values
+
+    return columns
+
+
+def pack_columns(records):
+    """
+        Pack a list of data points (e.g. lc['data']) into typed columns for compact storage:
+            {field: {'dtype': numpy dtype str, 'data': bson.Binary or list[, 'missing': bson.Binary]}}
+        Integer fields are stored as raw little-endian bytes of the smallest integer type that fits,
+        floats as float64, booleans as bytes, and everything else as lists.
+        Points that lack a field (or have it set to None) are flagged in the packed 'missing' bit mask
+    :param records:
+    :return:
+    """
+    keys = dict()
+    for record in records:
+        for key in record:
+            keys[key] = None
+
+    packed = dict()
+    for key in keys:
+        values = [record.get(key, None) for record in records]
+        present = np.array([v is not None for v in values], dtype=bool)
+        present_values = [v for v in values if v is not None]
+
+        if all(isinstance(v, (bool, np.bool_)) for v in present_values):
+            column = np.array([bool(v) for v in values], dtype=np.bool_)
+        elif all(isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) and
+                 (-2 ** 63 <= v < 2 ** 63) for v in present_values):
+            column = np.array([v if v is not None else 0 for v in values], dtype=np.int64)
+            for dtype in (np.int8, np.int16, np.int32):
+                if (column.min() >= np.iinfo(dtype).min) and (column.max() <= np.iinfo(dtype).max):
+                    column = column.astype(dtype)
+                    break
+        elif all(isinstance(v, (int, float, np.number)) and not isinstance(v, (bool, np.bool_))
+                 for v in present_values):
+            column = np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+        else:
+            column = None
+
+        if column is not None:
+            column = column.astype(column.dtype.newbyteorder('<'))
+            packed[key] = {'dtype': column.dtype.str, 'data': Binary(column.tobytes())}
+        else:
+            packed[key] = {'dtype': 'object', 'data': values}
+
+        if not present.all():
+            packed[key]['missing'] = Binary(np.packbits(~present).tobytes())
+
+    return packed
+
+
+def unpack_columns(packed):
+    """
+        Unpack columns produced by pack_columns into numpy arrays (lists for non-numeric fields).
+        Missing values are set to nan in numeric columns and to None in lists
+    :param packed:
+    :return: dict field name -> column
+    """
+    columns = dict()
+    for key, column in packed.items():
+        if column['dtype'] == 'object':
+            values = list(column['data'])
+        else:
+            values = np.frombuffer(bytes(column['data']), dtype=np.dtype(column['dtype']))
+        if 'missing' in column:
+            missing = np.unpackbits(np.frombuffer(bytes(column['missing']), dtype=np.uint8))[:len(values)]
+            missing = missing.astype(bool)
+            if isinstance(values, list):
+                values = [None if m else v for v, m in zip(values, missing)]
+            else:
+                values = values.astype(np.float64)
+                values[missing] = np.nan
+        columns[key] = values
+
+    return columns
+
+
+def unpack_records(packed):
+    """
+        Unpack columns produced by pack_columns back into a list of data points
+    :param packed:
+    :return:
+    """
+    n = 0
+    fields = []
+    for key, column in packed.items():
+        if column['dtype'] == 'object':
+            values = list(column['data'])
+        else:
+            values = np.frombuffer(bytes(column['data']), dtype=np.dtype(column['dtype'])).tolist()
+        n = len(values)
+        if 'missing' in column:
+            missing = np.unpackbits(np.frombuffer(bytes(column['missing']), dtype=np.uint8))[:n].astype(bool)
+        else:
+            missing = None
+        fields.append((key, values, missing))
+
+    # fields present in every point first, then the sparse ones
+    dense_keys = [key for key, _, missing in fields if missing is None]
+    records = [dict(zip(dense_keys, values))
+               for values in zip(*[values for _, values, missing in fields if missing is None])]
+    if len(dense_keys) == 0:
+        records = [dict() for _ in range(n)]
+    for key, values, missing in fields:
+        if missing is not None:
+            for i in np.flatnonzero(~missing):
+                records[i][key] = values[i]
+
+    return records
+
+
+def series_columns(entry):
+    """
+        Get data of a light curve or spectrum as columns, whatever the storage layout
+    :param entry: element of source['lc'] or source['spec']
+    :return:
+    """
+    if entry.get('data_format', 'records') == 'columnar':
+        return unpack_columns(entry['data'])
+    return records_to_columns(entry['data'])
+
+
+def series_records(entry):
+    """
+        Get data of a light curve or spectrum as a list of data points, whatever the storage layout
+    :param entry: element of source['lc'] or source['spec']
+    :return:
+    """
+    if entry.get('data_format', 'records') == 'columnar':
+        return unpack_records(entry['data'])
+    return entry['data']
+
+
+def columnar_series(doc):
+    """
+        Return a shallow copy of doc with the data in doc['lc'][]['data'] and doc['spec'][]['data']
+        converted into typed columns, whatever the storage layout. The original doc is left intact
+    :param doc:
+    :return:
+    """
+    if not isinstance(doc, dict):
+        return doc
+    doc = dict(doc)
+    for series in ('lc', 'spec'):
+        if isinstance(doc.get(series, None), list):
+            doc[series] = [{**{k: v for k, v in entry.items() if k != 'data_format'}, 'data': series_columns(entry)}
+                           if isinstance(entry, dict) and isinstance(entry.get('data', None), (list, dict))
+                           else entry
+                           for entry in doc[series]]
+    return doc
+
+
+# MJD 0
+mjd_epoch = np.datetime64('1858-11-17T00:00:00', 'us')
+
+
+def decimate_minmax(x, y, max_points: int, keep=None, outlier_threshold: float = 5.0):
+    """
+        Min/max decimation for plotting: split points ordered by x into equal-count bins and keep
+        the points with the smallest and the largest y in each bin, which preserves the visual envelope.
+        Points flagged in keep and outliers deviating from the median of y by more than outlier_threshold
+        robust standard deviations are always kept
+    :param x:
+    :param y:
+    :param max_points: target number of points; <= 0 to keep everything
+    :param keep: boolean mask of points to always keep
+    :param outlier_threshold:
+    :return: sorted indices of the points to keep
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if (max_points <= 0) or (n <= max_points):
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+
+    median = np.nanmedian(y)
+    mad = np.nanmedian(np.abs(y - median)) * 1.4826
+    if mad > 0:
+        keep |= np.abs(y - median) > outlier_threshold * mad
+    keep |= ~np.isfinite(y)
+
+    n_bins = max(1, (max_points - int(np.sum(keep))) // 2)
+    order = np.argsort(x, kind='stable')
+    if n_bins * 2 >= n:
+        return np.arange(n)
+
+    # sort by bin, then by y: the first and the last point in each bin are its min and max
+    edges = np.linspace(0, n, n_bins + 1).astype(np.int64)
+    bins = np.repeat(np.arange(n_bins), np.diff(edges))
+    by_y = order[np.lexsort((y[order], bins))]
+    selected = np.concatenate((by_y[edges[:-1]], by_y[edges[1:] - 1], np.flatnonzero(keep)))
+
+    return np.unique(selected)
+
+
+def decimate_merged(xs, ys, max_points: int):
+    """
+        Decimate several series together with decimate_minmax as if they were one,
+        e.g. the light curves of a source taken in the same filter
+    :param xs: list of x arrays
+    :param ys: list of y arrays
+    :param max_points: target total number of points; <= 0 to keep everything
+    :return: list of sorted indices of the points to keep in each series
+    """
+    xs = [np.asarray(x, dtype=np.float64) for x in xs]
+    ys = [np.asarray(y, dtype=np.float64) for y in ys]
+    if len(xs) == 0:
+        return []
+
+    index = decimate_minmax(np.concatenate(xs), np.concatenate(ys), max_points)
+    bounds = np.cumsum([0] + [len(x) for x in xs])
+
+    return [index[(index >= start) & (index < stop)] - start for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def lc_detections(data):
+    """
+        Get times [mjd] and magnitudes of the detections in a temporal light curve. Missing values are treated as zeros
+    :param data: list of data points or dict of columns
+    :return: mjd, mag
+    """
+    columns = records_to_columns(data) if isinstance(data, list) else dict(data)
+    if 'mag' not in columns:
+        return np.zeros(0), np.zeros(0)
+
+    def numeric(name):
+        column = np.asarray(columns[name], dtype=np.float64)
+        return np.where(np.isnan(column), 0.0, column)
+
+    mjd_ = numeric('mjd') if 'mjd' in columns else numeric('hjd') - 2400000.5
+    mag = numeric('mag')
+    w_det = mag > 0.01
+
+    return mjd_[w_det], mag[w_det]
+
+
+def lc_plotly_data(data, t_utc: datetime.datetime = None, max_points: int = 0, others=None):
+    """
+        Prepare temporal light curve for plotting: sort by time, compute the time in different representations,
+        and split into detections and upper/lower limits. Missing values are treated as zeros
+    :param data: list of data points or dict of columns
+    :param t_utc: naive utc datetime to count 'days_ago' from, now by default
+    :param max_points: decimate detections down to about max_points with decimate_minmax if > 0;
+                       upper/lower limits are always kept
+    :param others: data of the other light curves taken in the same filter: detections of all of them
+                   are decimated together down to about max_points, and those of data are returned
+    :return: {'lc_det': {'dt': [], 'days_ago': [], 'jd': [], 'mjd': [], 'hjd': [], 'mag': [], 'magerr': []},
+              'lc_nodet_u': {'dt': [], 'days_ago': [], 'jd': [], 'mjd': [], 'hjd': [], 'mag_ulim': []},
+              'lc_nodet_l': {'dt': [], 'days_ago': [], 'jd': [], 'mjd': [], 'hjd': [], 'mag_llim': []}}
+    """
+    columns = records_to_columns(data) if isinstance(data, list) else dict(data)
+
+    def numeric(name):
+        column = np.asarray(columns[name], dtype=np.float64)
+        return np.where(np.isnan(column), 0.0, column)
+
+    mjd_ = numeric('mjd') if 'mjd' in columns else numeric('hjd') - 2400000.5
+    hjd_ = numeric('hjd') if 'hjd' in columns else mjd_ + 2400000.5
+    jd_ = numeric('jd') if 'jd' in columns else mjd_ + 2400000.5
+
+    if 'datetime' in columns:
+        datetime_ = np.array([dt.astimezone(pytz.utc).replace(tzinfo=None) if dt.tzinfo is not None else dt
+                              for dt in columns['datetime']], dtype='datetime64[us]')
+    else:
+        datetime_ = mjd_epoch + np.round(mjd_ * 86400e6).astype('timedelta64[us]')
+
+    # strings for plotly:
+    if 'dt' in columns:
+        dt_ = np.array(columns['dt'], dtype=object)
+    else:
+        dt_ = np.char.replace(np.datetime_as_string(datetime_.astype('datetime64[s]'), unit='s'), 'T', ' ')
+
+    # fractional days ago
+    if t_utc is None:
+        t_utc = datetime.datetime.utcnow()
+    days_ago = (np.datetime64(t_utc, 'us') - datetime_).astype(np.float64) / 86400e6
+
+    fields = {'dt': dt_, 'days_ago': days_ago, 'jd': jd_, 'mjd': mjd_, 'hjd': hjd_}
+    for name in ('mag', 'magerr', 'mag_ulim', 'mag_llim'):
+        if name in columns:
+            fields[name] = numeric(name)
+
+    order = np.argsort(mjd_, kind='stable')
+
+    lc__ = dict()
+    for key, value_field, extra_fields in (('lc_det', 'mag', ('magerr', )),
+                                           ('lc_nodet_u', 'mag_ulim', ()),
+                                           ('lc_nodet_l', 'mag_llim', ())):
+        if value_field in fields:
+            index = order[fields[value_field][order] > 0.01]
+        else:
+            index = order[:0]
+        if key == 'lc_det':
+            detections = [lc_detections(other) for other in (others or [])]
+            index = index[decimate_merged([mjd_[index]] + [mjd for mjd, _ in detections],
+                                          [fields['mag'][index]] + [mag for _, mag in detections],
+                                          max_points)[0]]
+        lc__[key] = {kk: fields[kk][index].tolist() if kk in fields else [0.0] * len(index)
+                     for kk in ('dt', 'days_ago', 'jd', 'mjd', 'hjd', value_field) + extra_fields}
+
+    return lc__
+
+
+def spec_plotly_data(data):
+    """
+        Prepare spectrum for plotting: sort by wavelength. Missing values are treated as zeros
+    :param data: list of data points or dict of columns
+    :return: {'wavelength': [], 'flux': [], 'fluxerr': []}
+    """
+    columns = records_to_columns(data) if isinstance(data, list) else dict(data)
+
+    def numeric(name):
+        column = np.asarray(columns[name], dtype=np.float64)
+        return np.where(np.isnan(column), 0.0, column)
+
+    order = np.argsort(numeric('wavelength'), kind='stable')
+
+    return {field: numeric(field)[order].tolist() if field in columns else []
+            for field in ('wavelength', 'flux', 'fluxerr')}
+
+
+def lc_stats(data):
+    """
+        Compute summary statistics of a temporal light curve to be stored in lc['stats'].
+        Magnitude statistics use good detections only: mag > 0 and catflags == 0 (if catflags are available)
+    :param data: list of data points or dict of columns
+    :return: {'n', 'n_det', 'n_flagged', 'frac_flagged', 'mjd_min', 'mjd_max', 'time_span',
+              'mag_median', 'mag_mean', 'mag_rms', 'amplitude', 'amplitude_robust'}
+    """
+    columns = records_to_columns(data) if isinstance(data, list) else dict(data)
+
+    def numeric(name):
+        column = np.asarray(columns[name], dtype=np.float64)
+        return np.where(np.isnan(column), 0.0, column)
+
+    n = max([len(column) for column in columns.values()], default=0)
+
+    if 'mjd' in columns:
+        mjd_ = np.asarray(columns['mjd'], dtype=np.float64)
+    elif 'hjd' in columns:
+        mjd_ = np.asarray(columns['hjd'], dtype=np.float64) - 2400000.5
+    else:
+        # e.g. folded light curves
+        mjd_ = np.zeros(0)
+    # missing times must not count as mjd 0 in the time range
+    mjd_ = mjd_[np.isfinite(mjd_)]
+    mag = numeric('mag') if 'mag' in columns else np.zeros(n)
+    catflags = numeric('catflags') if 'catflags' in columns else np.zeros(n)
+
+    w_det = mag > 0.01
+    w_flagged = w_det & (catflags != 0)
+    good = mag[w_det & ~w_flagged]
+
+    stats = {'n': int(n),
+             'n_det': int(np.sum(w_det)),
+             'n_flagged': int(np.sum(w_flagged)),
+             'frac_flagged': float(np.sum(w_flagged) / np.sum(w_det)) if np.sum(w_det) > 0 else None,
+             'mjd_min': float(np.min(mjd_)) if len(mjd_) > 0 else None,
+             'mjd_max': float(np.max(mjd_)) if len(mjd_) > 0 else None,
+             'time_span': float(np.max(mjd_) - np.min(mjd_)) if len(mjd_) > 0 else None}
+
+    if len(good) > 0:
+        p_low, median, p_high = np.percentile(good, (5, 50, 95))
+        stats['mag_median'] = float(median)
+        stats['mag_mean'] = float(np.mean(good))
+        stats['mag_rms'] = float(np.std(good))
+        stats['amplitude'] = float(np.max(good) - np.min(good))
+        # less sensitive to outliers:
+        stats['amplitude_robust'] = float(p_high - p_low)
+    else:
+        for key in ('mag_median', 'mag_mean', 'mag_rms', 'amplitude', 'amplitude_robust'):
+            stats[key] = None
+
+    return stats
+
+
+def plain_types(obj):
+    """
+        Recursively convert bson-specific types into plain python types
+    :param obj:
+    :return:
+    """
+    if isinstance(obj, dict):
+        return {k: plain_types(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [plain_types(v) for v in obj]
+    if isinstance(obj, (ObjectId, Regex)):
+        return str(obj)
+    if isinstance(obj, Decimal128):
+        return float(obj.to_decimal())
+    if isinstance(obj, Int64):
+        return int(obj)
+    return obj
+
+
+def plan_summary(explain):
+    """
+        Get the stages and the indexes used by the winning plan(s) in mongodb explain() output
+    :param explain:
+    :return: list of stage names, list of index names
+    """
+    stages, indexes = [], []
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'rejectedPlans':
+                    continue
+                if (key == 'stage') and isinstance(value, str):
+                    stages.append(value)
+                elif (key == 'indexName') and isinstance(value, str) and (value not in indexes):
+                    indexes.append(value)
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain)
+
+    return stages, indexes
+
+
+# general_search grammar: db['collection'].method(literal args)[.sort(...).limit(...).skip(...).hint(...)]
+# method -> (positional parameters, keyword-only parameters)
+general_search_methods = {
+    'find': (('filter', 'projection', 'skip', 'limit'), ('sort', 'hint')),
+    'find_one': (('filter', 'projection'), ('skip', 'sort', 'hint')),
+    'aggregate': (('pipeline', ), ('allowDiskUse', 'batchSize')),
+    'count_documents': (('filter', ), ('skip', 'limit', 'hint')),
+    'distinct': (('key', 'filter'), ()),
+    'estimated_document_count': ((), ()),
+    'index_information': ((), ()),
+}
+# cursor methods that may be chained after find()
+general_search_cursor_methods = {
+    'sort': ('key_or_list', 'direction'),
+    'limit': ('limit', ),
+    'skip': ('skip', ),
+    'hint': ('index', ),
+}
+
+
+def general_search_literal(node):
+    """
+        Evaluate literal expression node; datetime.datetime(...) calls with literal arguments are allowed, too
+    :param node:
+    :return:
+    """
+    if isinstance(node, ast.Dict):
+        return {general_search_literal(k): general_search_literal(v) for k, v in zip(node.keys, node.values)}
+    if isinstance(node, ast.List):
+        return [general_search_literal(v) for v in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(general_search_literal(v) for v in node.elts)
+    if isinstance(node, ast.Call):
+        func = node.func
+        if (isinstance(func, ast.Attribute) and (func.attr == 'datetime') and
+                isinstance(func.value, ast.Name) and (func.value.id == 'datetime')):
+            return datetime.datetime(*[general_search_literal(a) for a in node.args],
+                                     **{kw.arg: general_search_literal(kw.value) for kw in node.keywords})
+        raise ValueError('only datetime.datetime() calls are allowed in arguments')
+    # constants, including negative numbers
+    return ast.literal_eval(node)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_general_search(query: str):
+    """
+        Parse general_search query into a plan: {'catalog': str, 'method': str, 'params': dict}.
+        Plans are cached by query text, use compile_general_search to get a copy safe to modify
+    :param query:
+    :return:
+    """
+    try:
+        tree = ast.parse(query.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f'cannot parse query: {str(e)}')
+
+    # unwind method call chain
+    calls = []
+    node = tree.body
+    while isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        calls.append(node)
+        node = node.func.value
+    calls = calls[::-1]
+
+    # db['collection'] or db.collection
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and (node.value.id == 'db'):
+        _slice = node.slice.value if type(node.slice).__name__ == 'Index' else node.slice
+        catalog = ast.literal_eval(_slice)
+    elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and (node.value.id == 'db'):
+        catalog = node.attr
+    else:
+        raise ValueError("query must start with db['collection']")
+    if (not isinstance(catalog, str)) or (len(catalog) == 0):
+        raise ValueError('bad collection name')
+
+    if len(calls) == 0:
+        raise ValueError('no method called on collection')
+
+    method = calls[0].func.attr
+    if method not in general_search_methods:
+        raise ValueError(f'method {method} not in {str(tuple(general_search_methods.keys()))}')
+
+    positional, keyword_only = general_search_methods[method]
+    if len(calls[0].args) > len(positional):
+        raise ValueError(f'too many arguments to {method}')
+    params = {name: general_search_literal(arg) for name, arg in zip(positional, calls[0].args)}
+    for kw in calls[0].keywords:
+        if kw.arg not in positional + keyword_only:
+            raise ValueError(f'unsupported keyword argument {kw.arg} to {method}')
+        params[kw.arg] = general_search_literal(kw.value)
+
+    for call in calls[1:]:
+        cursor_method = call.func.attr
+        if (method != 'find') or (cursor_method not in general_search_cursor_methods):
+            raise ValueError(f'method {cursor_method} cannot be chained after {method}')
+        if len(call.keywords) > 0:
+            raise ValueError(f'keyword arguments to {cursor_method} not supported')
+        args = [general_search_literal(arg) for arg in call.args]
+        if not (1 <= len(args) <= len(general_search_cursor_methods[cursor_method])):
+            raise ValueError(f'bad number of arguments to {cursor_method}')
+
+        if cursor_method == 'sort':
+            sort = [(args[0], args[1] if len(args) > 1 else 1)] if isinstance(args[0], str) else list(args[0])
+            params['sort'] = list(params.get('sort', [])) + sort
+        elif cursor_method == 'hint':
+            params['hint'] = args[0]
+        else:
+            params[cursor_method] = int(args[0])
+
+    return {'catalog': catalog, 'method': method, 'params': params}
+
+
+def compile_general_search(query: str):
+    """
+        Compile general_search query into a plan: {'catalog': str, 'method': str, 'params': dict},
+        where params are keyword arguments to the (whitelisted) collection method
+    :param query:
+    :return:
+    """
+    return copy.deepcopy(parse_general_search(query))
+
+
 def random_alphanumeric_str(length: int = 8):
     return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(length)).lower()
 
@@ -502,18 +1496,31 @@ PANSTARRS_SOURCE = "http://ps1images.stsci.edu/cgi-bin/"
 # ===================== #
 
 
-def build_panstarrs_link(ra, dec, type="stack"):
+def build_panstarrs_link(ra, dec, type="stack", source=PANSTARRS_SOURCE):
     """ build the link where you will get the ps1 filename information for the given Ra Dec and type. """
-    return PANSTARRS_SOURCE + 'ps1filenames.py?ra=' + str(ra) + '&dec=' + str(dec) + '&type=%s' % type
+    return source + 'ps1filenames.py?ra=' + str(ra) + '&dec=' + str(dec) + '&type=%s' % type
+
+
+def parse_ps_filenames(content, color=("y", "g", "i")):
+    """ pick the file locations for the given colors from a ps1filenames.py response """
+    if len(color) != 3:
+        raise ValueError("color must have exactly 3 entries ('g','r','i','z','y')")
+    d = [l.split(" ")[-2] for l in content.splitlines()[1:]]
+    return np.asarray([[d_ for d_ in d if ".%s." % b in d_] for b in color]).flatten()
 
 
 def get_ps_color_filelocation(ra, dec, color=("y", "g", "i"), timeout=1):
     """  """
     if len(color) != 3:
         raise ValueError("color must have exactly 3 entries ('g','r','i','z','y')")
-    d = [l.split(" ")[-2] for l in requests.get(build_panstarrs_link(ra, dec),
-                                                timeout=timeout).content.decode("utf-8").splitlines()[1:]]
-    return np.asarray([[d_ for d_ in d if ".%s." % b in d_] for b in color]).flatten()
+    return parse_ps_filenames(requests.get(build_panstarrs_link(ra, dec),
+                                           timeout=timeout).content.decode("utf-8"), color=color)
+
+
+def build_rgb_ps_stamp_url(ra, dec, red, blue, green, size=240, source=PANSTARRS_SOURCE):
+    """ build the fitscut link for the given file locations """
+    return source + 'fitscut.cgi?red=' + red + '&blue=' + blue + '&green=' + green + '&x=' + str(
+        ra) + '&y=' + str(dec) + '&size=%d' % size + '&wcs=1&asinh=True&autoscale=99.750000&format=png&download=True'
 
 
 def get_rgb_ps_stamp_url(ra, dec, size=240, color=("y", "g", "i"), timeout=1):
@@ -525,5 +1532,4 @@ def get_rgb_ps_stamp_url(ra, dec, size=240, color=("y", "g", "i"), timeout=1):
     link (str)
     """
     red, blue, green = get_ps_color_filelocation(ra, dec, color=color, timeout=timeout)
-    return PANSTARRS_SOURCE + 'fitscut.cgi?red=' + red + '&blue=' + blue + '&green=' + green + '&x=' + str(
-        ra) + '&y=' + str(dec) + '&size=%d' % size + '&wcs=1&asinh=True&autoscale=99.750000&format=png&download=True'
+    return build_rgb_ps_stamp_url(ra, dec, red, blue, green, size=size)
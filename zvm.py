@@ -2,6 +2,7 @@ import string
 import random
 import traceback
 import os
+import struct
 import time
 from copy import deepcopy
 from typing import Union
@@ -18,6 +19,82 @@ QueryPart = Union['task', 'result']
 Method = Union['get', 'post', 'put', 'patch', 'delete']
 
 
+# numpy dtype (without byte order) -> struct format
+struct_formats = {'f8': 'd', 'f4': 'f', 'i8': 'q', 'i4': 'i', 'i2': 'h', 'i1': 'b', 'u1': 'B', 'b1': '?'}
+
+
+def series_records(entry):
+    """
+        Get light curve or spectrum data (source['lc'][i] or source['spec'][i]) as a list of data points.
+        Data stored in ZVM's 'columnar' layout are unpacked with the struct module, numpy is not required
+    :param entry:
+    :return:
+    """
+    if entry.get('data_format', 'records') != 'columnar':
+        return entry['data']
+
+    n = 0
+    fields = []
+    for key, column in entry['data'].items():
+        if column['dtype'] == 'object':
+            values = list(column['data'])
+        else:
+            fmt = struct_formats[column['dtype'][1:]]
+            values = [value for value, in struct.iter_unpack(f'<{fmt}', bytes(column['data']))]
+        n = len(values)
+        if 'missing' in column:
+            mask = bytes(column['missing'])
+            present = [not ((mask[i >> 3] >> (7 - (i & 7))) & 1) for i in range(n)]
+        else:
+            present = None
+        fields.append((key, values, present))
+
+    records = [dict() for _ in range(n)]
+    for key, values, present in fields:
+        for i, value in enumerate(values):
+            if (present is None) or present[i]:
+                records[i][key] = value
+
+    return records
+
+
+def msgpack_ext_hook(code, data):
+    """
+        Decode msgpack ext types produced by ZVM: type 1 is a numpy array packed as [dtype, shape, raw bytes]
+    """
+    import msgpack
+    if code == 1:
+        import numpy as np
+        dtype, shape, buffer = msgpack.unpackb(data, raw=False)
+        return np.frombuffer(buffer, dtype=np.dtype(dtype)).reshape(shape)
+    return msgpack.ExtType(code, data)
+
+
+def decode_response(resp):
+    """
+        Decode ZVM response according to its Content-Type.
+        msgpack requires msgpack and numpy, Arrow IPC streams require pyarrow.
+        Arrow tables come back as result.result_data.query_result, with the rest of the result
+        restored from the schema metadata
+    :param resp: requests response
+    :return:
+    """
+    content_type = resp.headers.get('Content-Type', '')
+
+    if content_type.startswith('application/x-msgpack'):
+        import msgpack
+        return msgpack.unpackb(resp.content, raw=False, ext_hook=msgpack_ext_hook, timestamp=3)
+
+    if content_type.startswith('application/vnd.apache.arrow.stream'):
+        import pyarrow as pa
+        table = pa.ipc.open_stream(resp.content).read_all()
+        result = loads(table.schema.metadata[b'zvm'].decode('utf-8'))
+        result['result_data']['query_result'] = table.replace_schema_metadata(None)
+        return {'message': 'success', 'result': result}
+
+    return loads(resp.text)
+
+
 class zvm(object):
     """
         zvm :: programmatically interact with ZTF Variable Marshal's API
@@ -149,7 +226,14 @@ class zvm(object):
             return {'status': 'failed', 'message': _err}
 
     def query(self, query, timeout: Num = 5*3600, retries: int = 3):
-
+        """
+            Execute query. Set query['kwargs']['format'] to 'msgpack' or 'arrow' (find, find_one, aggregate,
+            and cone_search only) to get the results in a binary encoding with light curves as numeric columns
+        :param query:
+        :param timeout:
+        :param retries:
+        :return:
+        """
         try:
             _query = deepcopy(query)
 
@@ -179,7 +263,7 @@ class zvm(object):
                 # print(resp.text)
 
                 if resp.status_code == requests.codes.ok:
-                    return loads(resp.text)
+                    return decode_response(resp)
                 else:
                     # bad status code? sleep before retrying, maybe no connections available due to high load
                     time.sleep(0.5)
@@ -189,6 +273,63 @@ class zvm(object):
 
             return {'status': 'failed', 'message': _err}
 
+    def query_stream(self, query, timeout: Num = 5*3600):
+        """
+            Execute query in streaming mode, yielding newline-delimited json records as they arrive.
+            The last record is {'status': 'done', 'count': n} or {'status': 'failed', 'msg': traceback}
+        :param query:
+        :param timeout:
+        :return:
+        """
+        _query = deepcopy(query)
+
+        if 'kwargs' not in _query:
+            _query['kwargs'] = dict()
+        _query['kwargs']['stream'] = True
+
+        with self.session.put(os.path.join(self.base_url, 'query'),
+                              json=_query, headers=self.headers, timeout=timeout, stream=True,
+                              cookies={'jwt_token': self.access_token, 'user_id': self.username}) as resp:
+
+            if resp.status_code != requests.codes.ok:
+                yield {'status': 'failed', 'msg': resp.text}
+                return
+
+            for line in resp.iter_lines():
+                if line:
+                    yield loads(line)
+
+    def query_pages(self, query, page_size: int = 1000, timeout: Num = 5*3600, retries: int = 3):
+        """
+            Page through the results of a find or aggregate query using keyset pagination,
+            yielding one list of documents per page
+        :param query:
+        :param page_size:
+        :param timeout:
+        :param retries:
+        :return:
+        """
+        _query = deepcopy(query)
+
+        if 'kwargs' not in _query:
+            _query['kwargs'] = dict()
+        _query['kwargs']['page_size'] = page_size
+        _query['kwargs'].pop('cursor', None)
+
+        while True:
+            _result = self.query(query=_query, timeout=timeout, retries=retries)
+
+            result = _result.get('result', dict()) if _result is not None else dict()
+            if result.get('status', None) != 'done':
+                raise Exception(f'query failed: {_result}')
+
+            yield result['result_data']['query_result']
+
+            next_cursor = result['result_data'].get('next_cursor', None)
+            if next_cursor is None:
+                break
+            _query['kwargs']['cursor'] = next_cursor
+
     def get_query(self, query_id: str, part: QueryPart = 'result', retries: int = 3):
         """
             Fetch json for task or result by query id